@@ -0,0 +1,27 @@
+import sys
+
+# python -m cropple [サブコマンド]
+# 引数なしで GUI を起動。ヘッドレスのサブコマンドは Tk を読み込まない。
+
+COMMANDS = {
+    "batch": "cropple.batch",
+    "bench": "cropple.bench",
+    "serve": "cropple.serve",
+    "watch": "cropple.watch",
+}
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] in COMMANDS:
+        import importlib
+        return importlib.import_module(COMMANDS[argv[0]]).main(argv[1:])
+    if argv and argv[0] in ("-h", "--help"):
+        print("usage: cropple [" + " | ".join(COMMANDS) + "] ...\n引数なしで GUI を起動します。")
+        return 0
+    from .main import main as gui_main
+    return gui_main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
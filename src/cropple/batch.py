@@ -0,0 +1,234 @@
+from PIL import Image
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from . import core, edits, encode, timing
+
+# GUI を使わずに複数画像へ同じ切り抜き/拡張/回転設定を適用するバッチ処理。
+# 1画像 = 1タスクとしてプロセスプールに投げるので、コア数に応じてスケールする。
+# スクリプトから1枚ずつ何度も呼ばれる使い方に備え、処理が1件 (または -j 1) ならプールを作らずにこのプロセスで処理し、
+# プロセスプール・jpegtran 呼び出し (subprocess)・複数フレーム・帯ごとの書き出し・おすすめ範囲・再実行時の記録のモジュールも使うときまで読み込まない。
+
+OUTPUT_FORMATS = {"png": ".png", "jpg": ".jpg", "jpeg": ".jpg", "webp": ".webp", "gif": ".gif", "tiff": ".tif", "same": None}
+
+
+def collect_input_paths(inputs, recursive=False):
+    # ディレクトリ・glob・ファイルを展開し、対応拡張子の画像だけを重複なく返す
+    paths = []; seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*") if recursive else os.path.join(item, "*")
+            candidates = sorted(glob.glob(pattern, recursive=recursive))
+        elif glob.has_magic(item): candidates = sorted(glob.glob(item, recursive=recursive))
+        else: candidates = [item]
+        for p in candidates:
+            if not os.path.isfile(p) or not p.lower().endswith(core.IMAGE_EXTENSIONS): continue
+            key = os.path.abspath(p)
+            if key in seen: continue
+            seen.add(key); paths.append(p)
+    return paths
+
+
+def build_output_path(src_path, output_dir, output_format="png", suffix=""):
+    stem, src_ext = os.path.splitext(os.path.basename(src_path))
+    ext = OUTPUT_FORMATS.get(output_format) or src_ext.lower()
+    return os.path.join(output_dir, f"{stem}{suffix}{ext}")
+
+
+def process_file(src_path, dst_path, settings, mode="extend", quarter_turns=0, rotation_angle=0.0, memory_budget_mb=None):
+    # ワーカープロセスで実行される1画像分の処理 (pickle できるようモジュール直下に置く)。
+    # memory_budget_mb を指定すると、拡張後の画像が予算を超える場合は帯ごとに書き出す。
+    # mode="smart" は切り抜きモードと同じ比率で、中央ではなく smartcrop が選んだ位置を切り抜く。
+    # jpeg_lossless 設定なら JPEG -> JPEG の回転・切り抜きを可能な限り再エンコードせずに行う (切り抜き位置は MCU 境界へ寄せる)
+    started = time.perf_counter()
+    encoder_settings = encode.encoder_settings_from(settings)
+    with Image.open(src_path) as opened:
+        ops = edits.build_ops(opened.size, settings, "crop" if mode == "smart" else mode, quarter_turns, rotation_angle)
+        # 切り抜き位置は画素を見るまで決まらないので、smart は可逆変換の経路を使わない
+        if mode != "smart" and encoder_settings['jpeg_lossless']:
+            from . import lossless
+            if lossless.is_candidate(src_path, ops, dst_path) and lossless.save_lossless(src_path, ops, dst_path, encoder_settings, snap=True):
+                return src_path, dst_path, time.perf_counter() - started
+        from . import frames
+        if frames.is_animated(opened) and frames.supports_frames(dst_path):
+            # アニメーション GIF・複数ページ TIFF は全フレームに同じ操作を適用する (smart の切り抜き位置は先頭フレームで決める)
+            if mode == "smart" and ops and ops[-1][0] == "crop":
+                from . import smartcrop
+                first = edits.render_ops(core.normalize_image_mode(opened), ops[:-1])
+                ops[-1] = ("crop", smartcrop.suggest_crop_box(first, core.resolve_aspect_ratio(settings, first.size)))
+            frames.save_frames(opened, ops, dst_path, encoder_settings)
+            return src_path, dst_path, time.perf_counter() - started
+        with timing.stage("decode"): opened.load()
+        image = core.normalize_image_mode(opened)
+        extend_op = ops.pop() if ops and ops[-1][0] == "extend" else None
+        smart_crop = mode == "smart" and bool(ops) and ops[-1][0] == "crop"
+        if smart_crop: ops.pop()
+        result = edits.render_ops(image, ops)
+        if smart_crop:
+            from . import smartcrop
+            result = result.crop(smartcrop.suggest_crop_box(result, core.resolve_aspect_ratio(settings, result.size)))
+        if extend_op:
+            _, aspect_tuple, blur_radius_val, position, fill_mode = extend_op
+            from . import stream
+            if stream.should_stream(result.size, aspect_tuple, position, memory_budget_mb):
+                stream.save_extended(result, dst_path, aspect_tuple, blur_radius_val, position, encoder_settings, memory_budget_mb, fill_mode=fill_mode)
+                return src_path, dst_path, time.perf_counter() - started
+            result = edits.apply_op(result, extend_op)
+    encode.save_image(result, dst_path, encoder_settings)
+    return src_path, dst_path, time.perf_counter() - started
+
+
+def _process_file_traced(*args):
+    # --trace 用: ワーカーで区間を記録し、結果と一緒に親プロセスへ返す
+    timing.configure(record=True); timing.reset()
+    with timing.stage("process", path=args[0]): result = process_file(*args)
+    return result, timing.events()
+
+
+def _process_file_timed(*args):
+    # --trace でプールを使わない場合: 区間はこのプロセスに記録されるので、渡す区間はない
+    with timing.stage("process", path=args[0]): return process_file(*args), []
+
+
+def _run_jobs(func, jobs, args, workers):
+    # (入力, func の結果, 例外) を終わった順に返す
+    if workers == 1:
+        for src, dst in jobs:
+            try: yield src, func(src, dst, *args), None
+            except Exception as e: yield src, None, e
+        return
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, src, dst, *args): src for src, dst in jobs}
+        for future in as_completed(futures):
+            try: yield futures[future], future.result(), None
+            except Exception as e: yield futures[future], None, e
+
+
+def load_settings_file(path):
+    # GUI の save_settings が書き出した JSON を読み、欠けているキーは既定値で補う
+    settings = dict(core.DEFAULT_SETTINGS)
+    if path:
+        with open(path, 'r') as f: settings.update(json.load(f))
+    return settings
+
+
+def apply_cli_overrides(settings, args):
+    settings = dict(settings)
+    if args.aspect:
+        if args.aspect in core.ASPECT_PRESETS: settings['aspect_choice'] = args.aspect
+        else:
+            w_str, _, h_str = args.aspect.partition(":")
+            if not core.parse_aspect_ratio(w_str, h_str): raise ValueError(f"アスペクト比の指定が不正です: {args.aspect}")
+            settings['aspect_choice'] = "カスタム"; settings['aspect_w'] = w_str; settings['aspect_h'] = h_str
+    if args.blur_radius is not None: settings['blur_radius'] = args.blur_radius
+    if args.position: settings['extend_position'] = args.position
+    if args.fill: settings['extend_fill'] = args.fill
+    if args.fill_mode: settings['rotation_fill_mode'] = args.fill_mode
+    if args.fill_color: settings['rotation_fill_color'] = args.fill_color
+    for key in encode.ENCODER_DEFAULTS:
+        if getattr(args, key, None) is not None: settings[key] = getattr(args, key)
+    if settings.get('rotation_fill_mode') == "color": core.parse_hex_color(settings['rotation_fill_color'])
+    return settings
+
+
+def run_batch(paths, output_dir, settings, mode="extend", quarter_turns=0, rotation_angle=0.0, output_format="png", suffix="", workers=None, overwrite=False, log=print, memory_budget_mb=None, trace_path=None,
+              manifest_path=None, max_cache_entries=core.DEFAULT_MANIFEST_ENTRIES):
+    # 戻り値: (成功数, 失敗リスト[(path, error)])。trace_path を指定すると段階ごとの所要時間を Chrome トレース形式で書き出す。
+    # manifest_path を指定すると、既存の出力の有無ではなく「入力の内容と設定が前回と同じか」で処理を省く (manifest.py)
+    os.makedirs(output_dir, exist_ok=True)
+    cache = None; key_of_settings = None
+    if manifest_path:
+        from . import manifest
+        cache = manifest.Manifest(manifest_path, max_cache_entries); key_of_settings = manifest.settings_key(settings, mode, quarter_turns, rotation_angle)
+    jobs = []; job_keys = {}
+    for src in paths:
+        dst = build_output_path(src, output_dir, output_format, suffix)
+        if cache is not None:
+            try: job_keys[src] = cache.job_key(src, key_of_settings)
+            except OSError: job_keys[src] = None
+            if not overwrite and job_keys[src] and cache.is_fresh(job_keys[src], dst): log(f"スキップ (入力・設定が前回と同じ): {dst}"); continue
+        elif not overwrite and os.path.exists(dst): log(f"スキップ (出力が既に存在): {dst}"); continue
+        jobs.append((src, dst))
+    if not jobs:
+        if cache is not None: cache.save()
+        return 0, []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    done = 0; failures = []
+    func = process_file
+    if trace_path and workers == 1: timing.configure(record=True); func = _process_file_timed
+    elif trace_path: func = _process_file_traced
+    started = time.perf_counter()
+    try:
+        for src, result, error in _run_jobs(func, jobs, (settings, mode, quarter_turns, rotation_angle, memory_budget_mb), workers):
+            if error is not None: failures.append((src, error)); log(f"[{done + len(failures)}/{len(jobs)}] 失敗: {src}: {error}"); continue
+            if trace_path: result, worker_events = result; timing.add_events(worker_events)
+            _, dst, elapsed = result
+            done += 1; log(f"[{done + len(failures)}/{len(jobs)}] {src} -> {dst} ({elapsed:.2f}s)")
+            if cache is not None and job_keys.get(src): cache.record(job_keys[src], dst); cache.save_if_due()
+    finally:
+        # 中断 (Ctrl+C など) されても、それまでに終わった分を記録して次回はその続きから処理する
+        if cache is not None: cache.save()
+    total = time.perf_counter() - started
+    if trace_path: log(f"トレースを書き出しました: {trace_path} ({timing.export_chrome_trace(trace_path)} 区間)")
+    log(f"完了: {done}件成功, {len(failures)}件失敗, {total:.2f}s ({workers} workers, {done / total if total > 0 else 0:.2f} images/s)")
+    return done, failures
+
+
+def add_processing_arguments(parser):
+    # batch 以外のエントリポイントからも再利用する処理パラメータ
+    parser.add_argument("--settings", help="設定ファイル (.cropple_settings.json 形式)。省略時は既定値")
+    parser.add_argument("--mode", choices=["extend", "crop", "smart"], default="extend", help="拡張モード / 切り抜きモード (中央切り抜き) / 内容に合わせた位置で切り抜き")
+    parser.add_argument("--aspect", help="アスペクト比 (プリセット名または W:H, 例: 16:9, 1:1)")
+    parser.add_argument("--blur-radius", type=int, help="ぼかし半径")
+    parser.add_argument("--position", choices=core.EXTEND_POSITIONS, help="拡張時の画像配置")
+    parser.add_argument("--fill", choices=core.EXTEND_FILL_MODES, help="拡張時の余白の埋め方 (blur: ぼかし / mirror: 折り返し / stretch: 端の引き伸ばし / mean: 平均色)")
+    parser.add_argument("--rotate90", type=int, default=0, help="右90°回転の回数 (負数で左回転)")
+    parser.add_argument("--angle", type=float, default=0.0, help="自由回転の角度 (度, 時計回り)")
+    parser.add_argument("--fill-mode", choices=["color", "transparent"], help="回転時の余白")
+    parser.add_argument("--fill-color", help="回転時の余白色 (#RRGGBB)")
+    parser.add_argument("--png-compress-level", type=int, choices=range(10), metavar="0-9", help="PNG の圧縮レベル (小さいほど高速)")
+    parser.add_argument("--jpeg-quality", type=int, help="JPEG 品質 (1-100)")
+    parser.add_argument("--jpeg-optimize", action="store_true", default=None, help="JPEG のハフマン表を最適化")
+    parser.add_argument("--jpeg-progressive", action="store_true", default=None, help="プログレッシブ JPEG で保存")
+    parser.add_argument("--jpeg-lossless", action="store_true", default=None, help="JPEG の90°回転・切り抜きを再エンコードせずに行う (jpegtran が必要。できない画像は通常の処理)")
+    parser.add_argument("--webp-quality", type=int, help="WebP 品質 (1-100)")
+    parser.add_argument("--webp-method", type=int, choices=range(7), metavar="0-6", help="WebP の圧縮方式 (小さいほど高速)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cropple batch", description="画像をまとめて切り抜き/拡張/回転します。")
+    parser.add_argument("inputs", nargs="+", help="入力ファイル・ディレクトリ・glob パターン")
+    parser.add_argument("-o", "--output-dir", required=True, help="出力ディレクトリ")
+    add_processing_arguments(parser)
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="png", help="出力形式 (same は入力と同じ拡張子)")
+    parser.add_argument("--suffix", default="", help="出力ファイル名に付ける接尾辞")
+    parser.add_argument("-r", "--recursive", action="store_true", help="ディレクトリを再帰的に探索")
+    parser.add_argument("-j", "--workers", type=int, help="ワーカープロセス数 (既定: CPU コア数)")
+    parser.add_argument("--overwrite", action="store_true", help="既存の出力を上書き")
+    parser.add_argument("--incremental", action="store_true", help=f"入力の内容と設定が前回と同じ画像は処理しない (記録: 出力ディレクトリの {core.MANIFEST_NAME})")
+    parser.add_argument("--manifest", metavar="FILE", help="--incremental の記録ファイルの場所 (指定すると --incremental も有効)")
+    parser.add_argument("--cache-entries", type=int, default=core.DEFAULT_MANIFEST_ENTRIES, help="記録する出力の上限 (古いものから捨てる)")
+    parser.add_argument("--trace", metavar="FILE", help="段階ごとの所要時間を Chrome トレース形式 (JSON) で書き出す")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help=f"拡張後の画像がこれを超える場合は帯ごとに書き出して作業メモリを抑える (目安: {core.DEFAULT_MEMORY_BUDGET_MB})")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try: settings = apply_cli_overrides(load_settings_file(args.settings), args)
+    except (OSError, ValueError) as e: print(f"設定エラー: {e}", file=sys.stderr); return 2
+    paths = collect_input_paths(args.inputs, args.recursive)
+    if not paths: print("処理対象の画像が見つかりませんでした。", file=sys.stderr); return 1
+    manifest_path = args.manifest or (os.path.join(args.output_dir, core.MANIFEST_NAME) if args.incremental else None)
+    _, failures = run_batch(paths, args.output_dir, settings, args.mode, args.rotate90, args.angle, args.format, args.suffix, args.workers, args.overwrite, memory_budget_mb=args.memory_budget, trace_path=args.trace,
+                            manifest_path=manifest_path, max_cache_entries=args.cache_entries)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+from PIL import Image
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try: import resource
+except ImportError: resource = None # Windows ではピークメモリを計測しない
+
+from . import core, edits
+from .display import DisplayCache
+
+# 処理のホットパス (拡張・自由回転・表示用縮小) のベンチマーク。
+# 合成画像で計測するので再現性があり、ケースごとに新しいプロセスで実行して
+# 所要時間 (複数回の最小値) とピークメモリ (実行直前の RSS からの増分の最大値) を記録する。
+# 保存済みの結果 (既定はリポジトリの bench/baseline.json) と比較し、閾値を超えて遅く/重くなったケースがあれば終了コード 1。
+# ベースラインは計測したマシンでの値なので、別のマシンでは --save-baseline で取り直してから比較する。
+# startup-* のケースは新しいインタプリタでの起動 (コマンドラインの --help・GUI モジュールの読み込み) にかかる時間を測る。
+
+SIZES_MP = (1, 12, 48, 100)
+DEFAULT_SIZES_MP = (1, 12)
+MODES = ("RGB", "RGBA")
+BLUR_RADII = (0, 20, 70, 100)
+CHEAP_FILL_MODES = ("mirror", "stretch", "mean") # ぼかし以外の余白 (ぼかし半径を使わないので配置 center だけ)
+# 配置ごとに、その方向へ余白ができるアスペクト比を使う (入力は 3:2)
+EXTEND_ASPECT_BY_POSITION = {"center": (1, 1), "top": (1, 1), "bottom": (1, 1), "left": (21, 9), "right": (21, 9)}
+ROTATION_ANGLE = 7.5
+DISPLAY_BOX = (1400, 800)
+# case_id -> python の引数 (スクリプトから何度も呼ばれる経路と、GUI の読み込み)
+STARTUP_COMMANDS = {"startup-batch-help": ["-m", "cropple", "batch", "--help"], "startup-gui-import": ["-c", "import cropple.main"]}
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "bench", "baseline.json")
+TIME_SLACK_SECONDS = 0.005 # これ未満の差は計測誤差として扱う
+MEMORY_SLACK_MB = 2.0
+
+
+def synthetic_image(megapixels, mode="RGB"):
+    # 3:2 の決定的な合成画像。小さなグラデーションを拡大して作るので 100MP でも生成が速い
+    height = int(round((megapixels * 1_000_000 / 1.5) ** 0.5)); width = int(round(height * 1.5))
+    size = (width, height)
+    linear = Image.linear_gradient('L'); radial = Image.radial_gradient('L')
+    bands = [linear.resize(size, core.RESAMPLE_BILINEAR), radial.resize(size, core.RESAMPLE_BILINEAR),
+             linear.transpose(core.ROTATE_90).resize(size, core.RESAMPLE_BILINEAR)]
+    if mode == "RGBA": bands.append(radial.transpose(core.ROTATE_180).resize(size, core.RESAMPLE_BILINEAR))
+    return Image.merge(mode, bands)
+
+
+def build_cases(sizes_mp=DEFAULT_SIZES_MP, modes=MODES, blur_radii=BLUR_RADII):
+    # (case_id, 処理名, 画素数[MP], モード, パラメータ) のリスト
+    cases = []
+    for mp in sizes_mp:
+        for mode in modes:
+            prefix = f"{mp}mp-{mode.lower()}"
+            for position, aspect in EXTEND_ASPECT_BY_POSITION.items():
+                for radius in blur_radii:
+                    cases.append((f"{prefix}-extend-{position}-r{radius}", "extend", mp, mode, {'aspect': aspect, 'position': position, 'blur_radius': radius}))
+            for fill_mode in CHEAP_FILL_MODES:
+                cases.append((f"{prefix}-extend-center-{fill_mode}", "extend", mp, mode, {'aspect': EXTEND_ASPECT_BY_POSITION["center"], 'position': "center", 'blur_radius': 0, 'fill_mode': fill_mode}))
+            cases.append((f"{prefix}-rotate", "rotate", mp, mode, {'angle': ROTATION_ANGLE}))
+            cases.append((f"{prefix}-rotate-crop", "rotate_crop", mp, mode, {'angle': ROTATION_ANGLE}))
+            cases.append((f"{prefix}-display", "display", mp, mode, {}))
+    return cases
+
+
+def build_startup_cases():
+    return [(case_id, "startup", 0, None, {'argv': argv}) for case_id, argv in STARTUP_COMMANDS.items()]
+
+
+def _operation(kind, image, params):
+    if kind == "extend": return lambda: core.extend_image(image, params['aspect'], params['blur_radius'], params['position'], fill_mode=params.get('fill_mode', "blur"))
+    if kind == "rotate": return lambda: core.rotate_free(image, params['angle'])
+    if kind == "rotate_crop":
+        # 回転後に中央の 16:9 を切り抜く (単一アフィン変換の経路)
+        rotate_op = ("rotate", params['angle'], "color", core.DEFAULT_FILL_COLOR)
+        crop_box = core.compute_center_crop_box(edits.geometry_output_size(image.size, [rotate_op]), (16, 9))
+        return lambda: edits.render_ops(image, [rotate_op, ("crop", crop_box)])
+    if kind == "startup":
+        # 実行中の cropple と同じものを読み込ませる。ピークメモリは子プロセスの分なので記録しない
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get('PYTHONPATH')])))
+        return lambda: subprocess.run([sys.executable] + params['argv'], env=env, stdout=subprocess.DEVNULL, check=True)
+    if kind == "display":
+        def display():
+            size = image.size; scale = core.fit_scale(size, DISPLAY_BOX)
+            return DisplayCache().get(image, (max(1, int(size[0] * scale)), max(1, int(size[1] * scale))))
+        return display
+    raise ValueError(f"unknown benchmark operation: {kind!r}")
+
+
+def _current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError): return None
+
+
+def _release_free_memory():
+    # 解放済みのヒープを OS に返し、次の確保が再利用されて RSS に現れない状態を避ける (glibc のみ)
+    gc.collect()
+    try: ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+    except (OSError, AttributeError, TypeError): pass
+
+
+def _reset_peak_rss():
+    # Linux では VmHWM (ピーク RSS) を現在値にリセットできる
+    try:
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+        return True
+    except OSError: return False
+
+
+def _peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) * 1024
+    except (OSError, ValueError): pass
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(case, repeat=3):
+    # 子プロセスで1ケースを実行する。戻り値: (case_id, 秒, ピークメモリ増分[MB] または None)
+    case_id, kind, mp, mode, params = case
+    image = synthetic_image(mp, mode) if mp else None
+    operation = _operation(kind, image, params)
+    best = float('inf'); peak_delta = None
+    for _ in range(repeat):
+        _release_free_memory()
+        can_reset = _reset_peak_rss(); rss_before = _current_rss_bytes()
+        started = time.perf_counter()
+        result = operation()
+        best = min(best, time.perf_counter() - started)
+        peak = _peak_rss_bytes()
+        if can_reset and rss_before is not None and peak is not None:
+            delta = max(0, peak - rss_before) / (1024 * 1024)
+            peak_delta = delta if peak_delta is None else max(peak_delta, delta)
+        del result
+    return case_id, best, None if kind == "startup" else peak_delta
+
+
+def run_cases(cases, repeat=3, log=print):
+    # ケースごとに新しいプロセスを使い、前のケースのメモリが計測に混ざらないようにする
+    results = {}
+    with multiprocessing.get_context("spawn").Pool(processes=1, maxtasksperchild=1) as pool:
+        for case_id, seconds, peak_mb in pool.imap(_run_case_star, [(case, repeat) for case in cases]):
+            results[case_id] = {'seconds': seconds, 'peak_mb': peak_mb}
+            log(f"{case_id:<40} {seconds * 1000:10.1f} ms  {'-' if peak_mb is None else f'{peak_mb:8.1f} MB'}")
+    return results
+
+
+def _run_case_star(args):
+    return run_case(*args)
+
+
+def compare_results(results, baseline, tolerance=0.25, memory_tolerance=0.25):
+    # baseline より tolerance (割合) を超えて悪化したケースのメッセージ一覧
+    regressions = []
+    for case_id, current in results.items():
+        previous = baseline.get('results', {}).get(case_id)
+        if not previous: continue
+        allowed_seconds = previous['seconds'] * (1 + tolerance) + TIME_SLACK_SECONDS
+        if current['seconds'] > allowed_seconds:
+            regressions.append(f"{case_id}: 時間 {previous['seconds'] * 1000:.1f} ms -> {current['seconds'] * 1000:.1f} ms")
+        if current.get('peak_mb') is not None and previous.get('peak_mb') is not None:
+            if current['peak_mb'] > previous['peak_mb'] * (1 + memory_tolerance) + MEMORY_SLACK_MB:
+                regressions.append(f"{case_id}: メモリ {previous['peak_mb']:.1f} MB -> {current['peak_mb']:.1f} MB")
+    return regressions
+
+
+def _parse_list(value, cast):
+    return tuple(cast(item) for item in value.split(",") if item.strip())
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cropple bench", description="処理のホットパスを合成画像で計測します。")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES_MP)), help=f"画素数 [MP] のカンマ区切り (最大 {','.join(map(str, SIZES_MP))})")
+    parser.add_argument("--full", action="store_true", help="全サイズ (" + ",".join(map(str, SIZES_MP)) + " MP) を計測")
+    parser.add_argument("--modes", default=",".join(MODES), help="画像モードのカンマ区切り")
+    parser.add_argument("--blur-radii", default=",".join(map(str, BLUR_RADII)), help="ぼかし半径のカンマ区切り")
+    parser.add_argument("--filter", help="case_id にこの文字列を含むケースだけを実行")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの繰り返し回数 (最小値を記録)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="比較するベースライン JSON (既定: リポジトリの bench/baseline.json)")
+    parser.add_argument("--no-baseline", action="store_true", help="ベースラインと比較しない")
+    parser.add_argument("--save-baseline", help="結果をベースライン JSON として保存")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="時間の悪化を許容する割合")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="ピークメモリの悪化を許容する割合")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sizes = SIZES_MP if args.full else _parse_list(args.sizes, int)
+    cases = build_cases(sizes, _parse_list(args.modes, str.upper), _parse_list(args.blur_radii, int)) + build_startup_cases()
+    if args.filter: cases = [case for case in cases if args.filter in case[0]]
+    if not cases: print("実行するケースがありません。", file=sys.stderr); return 2
+    baseline = None
+    if args.baseline and not args.no_baseline:
+        try:
+            with open(args.baseline, 'r') as f: baseline = json.load(f)
+        except (OSError, json.JSONDecodeError) as e: print(f"ベースラインを読み込めません: {e}", file=sys.stderr); return 2
+        if (baseline.get('python'), baseline.get('machine')) != (platform.python_version(), platform.machine()):
+            print(f"注意: ベースラインは別の環境 (Python {baseline.get('python')}, {baseline.get('machine')}) で計測されたものです", file=sys.stderr)
+    results = run_cases(cases, max(1, args.repeat))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f, indent=4)
+        print(f"ベースラインを保存しました: {args.save_baseline}")
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance, args.memory_tolerance)
+        if regressions:
+            print(f"\n*** 性能の劣化を検出しました ({len(regressions)}件) ***", file=sys.stderr)
+            for message in regressions: print(f"  {message}", file=sys.stderr)
+            return 1
+        compared = sum(case_id in baseline.get('results', {}) for case_id in results)
+        print(f"ベースラインと比較して劣化はありません ({compared}/{len(results)} ケースを比較)。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+from PIL import ImageFilter
+
+# 拡張モードの余白用の大半径ぼかしエンジン。
+# 縮小 -> 小半径の GaussianBlur -> 目的サイズへ拡大 のピラミッド方式で、
+# 処理量がぼかし半径にほぼ依存しない。縮小時の平均化による広がりは
+# 半径に比べて十分小さいので、見た目は全解像度の GaussianBlur とほぼ一致する。
+
+# 縮小後にこの程度の半径でぼかす (これより小さい半径では縮小しない)
+PYRAMID_TARGET_RADIUS = 8
+
+
+def pyramid_factors(size, radius, target_radius=PYRAMID_TARGET_RADIUS):
+    # 縦横それぞれの縮小率。縮小後も 1px 以上残るように制限する
+    factor = max(1, int(radius // target_radius))
+    w, h = size
+    return max(1, min(factor, w)), max(1, min(factor, h))
+
+
+def fast_gaussian_blur(image, radius, target_radius=PYRAMID_TARGET_RADIUS):
+    # 縮小した画像をぼかして返す。戻り値のサイズは元画像より小さくなり得るので、
+    # 呼び出し側で最終サイズへリサイズすること (blur_and_resize を参照)
+    if radius <= 0 or image.width <= 0 or image.height <= 0: return image
+    factors = pyramid_factors(image.size, radius, target_radius)
+    if factors != (1, 1): image = image.reduce(factors)
+    return blur_reduced(image, radius, factors)
+
+
+def blur_reduced(image, radius, factors):
+    # factors で縮小済みの画像を、縮小前の解像度で radius 相当になるようぼかす
+    factor_x, factor_y = factors
+    # 細い帯で片方の縮小率だけ頭打ちになった場合は縦横別の半径でぼかす
+    if factor_x > 1 or factor_y > 1: radius = radius / factor_x if factor_x == factor_y else (radius / factor_x, radius / factor_y)
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+def blur_for_resize(image, radius, resample, smooth_resample=None):
+    # blur_and_resize の前半: (ぼかした縮小画像, 拡大に使うフィルタ)。
+    # 縮小した場合は中身が十分滑らかなので、smooth_resample (BILINEAR など軽いフィルタ) があればそちらを使う。
+    # 拡大結果を一部ずつ作る場合 (帯ごとの出力) はこの戻り値を保持して resize(box=...) する
+    blurred = fast_gaussian_blur(image, radius)
+    if blurred.width <= 0 or blurred.height <= 0: return None, resample
+    reduced = blurred.size != image.size
+    return blurred, smooth_resample if reduced and smooth_resample is not None else resample
+
+
+def blur_and_resize(image, radius, size, resample, smooth_resample=None):
+    # ぼかした後に size へリサイズする。縮小解像度から直接 size へ拡大するので、
+    # 全解像度のぼかし画像は作らない
+    blurred, resample = blur_for_resize(image, radius, resample, smooth_resample)
+    if blurred is None: return None
+    return blurred.resize(size, resample)
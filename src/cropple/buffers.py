@@ -0,0 +1,132 @@
+from collections import OrderedDict
+import mmap
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+from . import timing
+
+# 全解像度の画像バッファの管理。元画像と編集スタックの途中結果を登録し、メモリ上にある分の合計バイト数を budget までに抑える。
+# 上限を超えたら最も長く使われていないものから画素を一時ファイルへ書き出して手放し (退避)、次に使われたときに読み戻す。
+# 使う側が持ち続ける画像 (GUI が表示中の画像など) は hold で知らせる。退避しても画素が解放されないので退避せず、メモリ上の分として数える。
+# 読み戻しは、L・RGBA・RGBX・CMYK なら一時ファイルを mmap して Image.frombuffer で包むだけで画素をコピーしない
+# (ファイルに裏付けられたページなので、OS はスワップに書かずに捨てて読み直せる。画像は読み取り専用で、書き換えると Pillow がその時点でコピーする)。
+# それ以外 (RGB・LA など) は Pillow の内部形式と並びが違うため、読み戻すとメモリ上の通常の画像にコピーされる。
+# 登録した画像はどの役割からも同じオブジェクトを共有し、書き換えない前提 (描画はいつも新しい画像を作る)。
+# 一時ファイルは退避後も残すので、読み戻した画像をもう一度退避するときは書き出さずに手放すだけで済む。
+
+BUDGET_ENV = "CROPPLE_BUFFER_BUDGET_MB" # メモリ上に置く全解像度バッファの上限 (MB) を指定する環境変数
+DEFAULT_BUDGET_MB = 1024
+SPILL_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "I", "F") # 画素の生データだけで元に戻せるモード
+MAPPED_MODES = ("L", "RGBA", "RGBX", "CMYK") # 一時ファイルの画素をそのまま共有して読み戻せるモード (Pillow の frombuffer がコピーしない)
+SPILL_CHUNK_BYTES = 8 * 1024 * 1024 # 退避時に一度に書き出す帯の大きさ (tobytes で画像全体を複製しない)
+
+
+def budget_bytes_from_env(default_mb=DEFAULT_BUDGET_MB):
+    try: return int(float(os.environ.get(BUDGET_ENV, default_mb)) * 1024 * 1024)
+    except ValueError: return int(default_mb * 1024 * 1024)
+
+
+def _is_decoded(image):
+    # Image.open した画像は、画素をデコードするまで元ファイルを開いたまま持つ (メモリは使っていない)
+    return getattr(image, 'fp', None) is None
+
+
+class Buffer:
+    # 登録した画像1枚の扱い。get() で画像を返し、退避済みなら読み戻す
+    __slots__ = ("_pool", "_image", "_file", "_map", "mode", "size", "info", "nbytes")
+
+    def __init__(self, pool, image):
+        self._pool = pool; self._image = image; self._file = None; self._map = None
+        self.mode = image.mode; self.size = image.size; self.info = dict(image.info)
+        self.nbytes = image.width * image.height * len(image.getbands())
+
+    def peek(self):
+        # メモリ上にあれば画像、退避済みなら None (読み戻さない)
+        return self._image
+
+    def get(self):
+        return self._pool._get(self)
+
+    @property
+    def is_spilled(self): return self._image is None
+
+    def release(self):
+        # 登録を外し、一時ファイルを消す
+        self._pool._forget(self)
+
+
+class BufferPool:
+    def __init__(self, budget_bytes=None, spill_dir=None):
+        self.budget_bytes = budget_bytes_from_env() if budget_bytes is None else budget_bytes
+        self.spill_dir = spill_dir
+        self._resident = OrderedDict() # メモリ上の Buffer -> None (使われていない順)
+        self._held = set() # 使う側が画像を持ち続けている Buffer (退避しない)
+        self._lock = threading.RLock()
+        self.spill_count = 0; self.fault_count = 0; self._spilled_bytes = 0 # 一時ファイルに書き出してある合計
+
+    def register(self, image):
+        buffer = Buffer(self, image)
+        with self._lock: self._resident[buffer] = None; self._enforce()
+        return buffer
+
+    def resident_bytes(self):
+        # メモリ上の画素の合計 (hold されていて退避できないものも含む)
+        with self._lock: return sum(buffer.nbytes for buffer in self._resident if _is_decoded(buffer._image))
+
+    def hold(self, *images):
+        # 使う側が持ち続ける画像を知らせる (前回の指定は置き換え)。その画像のバッファは退避せず、外れたものは上限を超えていれば退避する
+        with self._lock:
+            self._held = {buffer for buffer in self._resident if any(buffer._image is image for image in images if image is not None)}
+            self._enforce()
+
+    def spilled_bytes(self):
+        return self._spilled_bytes
+
+    def _get(self, buffer):
+        with self._lock:
+            if buffer._image is None: self._fault_in(buffer)
+            else: self._resident.move_to_end(buffer)
+            image = buffer._image
+            self._enforce()
+        return image
+
+    def _enforce(self):
+        # 上限を超えている間、古いものから退避する (直近に使った1枚と、hold されている画像は残す)
+        total = sum(buffer.nbytes for buffer in self._resident if _is_decoded(buffer._image))
+        for buffer in list(self._resident)[:-1]:
+            if total <= self.budget_bytes: break
+            if not buffer.nbytes or buffer.mode not in SPILL_MODES or not _is_decoded(buffer._image) or buffer in self._held: continue
+            self._spill(buffer); total -= buffer.nbytes
+
+    def _spill(self, buffer):
+        image = buffer._image
+        if buffer._file is None:
+            with timing.stage("spill", bytes=buffer.nbytes):
+                f = tempfile.TemporaryFile(prefix="cropple-", dir=self.spill_dir)
+                rows = max(1, SPILL_CHUNK_BYTES // max(1, buffer.nbytes // max(1, image.height)))
+                for top in range(0, image.height, rows): f.write(image.crop((0, top, image.width, min(image.height, top + rows))).tobytes())
+                f.flush()
+            buffer._file = f; self._spilled_bytes += buffer.nbytes
+        buffer._image = None; self._resident.pop(buffer, None); self.spill_count += 1
+
+    def _fault_in(self, buffer):
+        with timing.stage("fault", bytes=buffer.nbytes):
+            if buffer.mode in MAPPED_MODES:
+                # 画像が mmap を参照し続ける (ページは一時ファイルと共有)
+                if buffer._map is None: buffer._map = mmap.mmap(buffer._file.fileno(), 0, access=mmap.ACCESS_READ)
+                image = Image.frombuffer(buffer.mode, buffer.size, buffer._map, "raw", buffer.mode, 0, 1)
+            else:
+                # 内部形式へ変換しながらコピーするので、mmap は読み終えたら閉じる
+                with mmap.mmap(buffer._file.fileno(), 0, access=mmap.ACCESS_READ) as mapped: image = Image.frombytes(buffer.mode, buffer.size, mapped)
+        image.info.update(buffer.info)
+        buffer._image = image; self._resident[buffer] = None; self.fault_count += 1
+
+    def _forget(self, buffer):
+        with self._lock:
+            self._resident.pop(buffer, None); self._held.discard(buffer); buffer._image = None
+            # mmap は読み戻した画像が参照している間は閉じず、参照が切れたときに解放される (ファイルは作成時に削除済み)
+            buffer._map = None
+            if buffer._file is not None: buffer._file.close(); buffer._file = None; self._spilled_bytes -= buffer.nbytes
@@ -0,0 +1,433 @@
+from PIL import Image
+import math
+
+from . import timing
+from .blur import blur_for_resize, blur_reduced, pyramid_factors
+
+try:
+    RESAMPLE_LANCZOS = Image.Resampling.LANCZOS
+    RESAMPLE_NEAREST = Image.Resampling.NEAREST
+    RESAMPLE_BICUBIC = Image.Resampling.BICUBIC
+    RESAMPLE_BILINEAR = Image.Resampling.BILINEAR
+    RESAMPLE_BOX = Image.Resampling.BOX
+    FLIP_LEFT_RIGHT = Image.Transpose.FLIP_LEFT_RIGHT
+    FLIP_TOP_BOTTOM = Image.Transpose.FLIP_TOP_BOTTOM
+    ROTATE_90 = Image.Transpose.ROTATE_90
+    ROTATE_180 = Image.Transpose.ROTATE_180
+    ROTATE_270 = Image.Transpose.ROTATE_270
+except AttributeError:
+    RESAMPLE_LANCZOS = Image.LANCZOS
+    RESAMPLE_NEAREST = Image.NEAREST
+    RESAMPLE_BICUBIC = Image.BICUBIC
+    RESAMPLE_BILINEAR = Image.BILINEAR
+    RESAMPLE_BOX = Image.BOX
+    FLIP_LEFT_RIGHT = Image.FLIP_LEFT_RIGHT
+    FLIP_TOP_BOTTOM = Image.FLIP_TOP_BOTTOM
+    ROTATE_90 = Image.ROTATE_90
+    ROTATE_180 = Image.ROTATE_180
+    ROTATE_270 = Image.ROTATE_270
+
+# Tk に依存しない画像処理コア。GUI (main.py) とバッチ処理 (batch.py) の両方から使う。
+
+DEFAULT_ASPECT_W = "16"
+DEFAULT_ASPECT_H = "9"
+DEFAULT_BLUR_RADIUS = 70
+DEFAULT_FILL_COLOR = "#CCCCCC"
+FALLBACK_FILL_RGB = (200, 200, 200)
+EXTEND_POSITIONS = ("center", "top", "bottom", "left", "right")
+# 拡張時の余白の埋め方。blur 以外は縮小もぼかしもしない軽い方法 (大量処理向け)
+#   blur: 端をぼかして引き伸ばす / mirror: 端を鏡映しに折り返す / stretch: 端の1画素を引き伸ばす / mean: 端の帯の列 (行) ごとの平均色
+EXTEND_FILL_MODES = ("blur", "mirror", "stretch", "mean")
+STRIP_TOLERANCE = 2 # extend_strips と extend_image の画素値の差の上限 (補間して拡大する余白で、縦横の拡大それぞれの丸めで ±1)
+# 帯ごとの書き出し (stream.py)・再実行時の記録 (manifest.py) の既定値。コマンドの引数の説明にも使うので、それらのモジュールを読み込まずに参照できるここに置く
+DEFAULT_MEMORY_BUDGET_MB = 256
+MANIFEST_NAME = ".cropple_manifest.json"
+DEFAULT_MANIFEST_ENTRIES = 10000
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+ASPECT_PRESETS = {
+    "オリジナル": "original", "1:1": (1, 1), "カスタム": "custom", "自由選択": "free",
+    "16:9": (16, 9), "9:16": (9, 16), "4:3": (4, 3), "3:4": (3, 4),
+    "3:2": (3, 2), "2:3": (2, 3), "5:4": (5, 4), "4:5": (4, 5),
+    "1:1.91": (100, 191)
+}
+
+# save_settings が書き出すキーと同じ構成の既定値
+DEFAULT_SETTINGS = {
+    'aspect_w': DEFAULT_ASPECT_W, 'aspect_h': DEFAULT_ASPECT_H,
+    'aspect_choice': "16:9",
+    'blur_radius': DEFAULT_BLUR_RADIUS,
+    'rotation_fill_color': DEFAULT_FILL_COLOR,
+    'rotation_fill_mode': "color",
+    'extend_position': "center",
+    'extend_fill': "blur",
+}
+
+# 時計回り90°単位の回転回数 -> transpose 定数
+TRANSPOSE_BY_QUARTER_TURNS = {1: ROTATE_270, 2: ROTATE_180, 3: ROTATE_90}
+
+
+def normalize_image_mode(image):
+    # load_image と同じモード正規化 (P は透過情報があれば RGBA)
+    if image.mode == 'P': return image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode not in ['RGB', 'L', 'RGBA', 'LA']: return image.convert('RGB')
+    return image
+
+
+def parse_aspect_ratio(w_str, h_str):
+    try:
+        if not w_str or not h_str: return None
+        w = int(w_str); h = int(h_str)
+        if w <= 0 or h <= 0: return None
+        return w, h
+    except (TypeError, ValueError): return None
+
+
+def resolve_aspect_ratio(settings, image_size=None):
+    # 設定辞書からアスペクト比タプルを求める。「オリジナル」は画像サイズから、「自由選択」は None
+    choice = settings.get('aspect_choice', DEFAULT_SETTINGS['aspect_choice'])
+    preset = ASPECT_PRESETS.get(choice, "custom")
+    if isinstance(preset, tuple): return preset
+    if preset == "free": return None
+    if preset == "original" and image_size:
+        w, h = image_size
+        if w > 0 and h > 0:
+            common = math.gcd(w, h); return w // common, h // common
+    return parse_aspect_ratio(settings.get('aspect_w'), settings.get('aspect_h'))
+
+
+def parse_hex_color(fill_color_hex):
+    # "#RRGGBB" -> (r,g,b)。不正な値は ValueError
+    hex_digits = fill_color_hex.lstrip('#')
+    if len(hex_digits) != 6: raise ValueError(f"invalid hex color: {fill_color_hex!r}")
+    return tuple(int(hex_digits[i:i+2], 16) for i in (0, 2, 4))
+
+
+def fill_color_for_mode(mode, rgb, alpha=255):
+    # mode の画像の塗りつぶしに使える色。グレースケール (L, LA) は輝度にする
+    if mode in ('L', 'LA'):
+        luma = (rgb[0] * 299 + rgb[1] * 587 + rgb[2] * 114 + 500) // 1000
+        return luma if mode == 'L' else (luma, alpha)
+    return tuple(rgb) + (alpha,) if 'A' in mode else tuple(rgb)
+
+
+def rotation_fill_for(image, fill_mode, fill_color_hex):
+    # 回転時の余白色を返す。透過時は必要なら RGBA に変換した画像も返す
+    if fill_mode == "transparent":
+        if image.mode != 'RGBA': image = image.convert('RGBA')
+        return image, (0, 0, 0, 0)
+    return image, fill_color_for_mode(image.mode, parse_hex_color(fill_color_hex))
+
+
+@timing.timed("rotate")
+def rotate_free(image, angle, fill_mode="color", fill_color_hex=DEFAULT_FILL_COLOR, resample=RESAMPLE_BICUBIC):
+    # 時計回りに angle 度回転 (expand=True)。色指定が不正なら ValueError
+    image, fill_color_tuple = rotation_fill_for(image, fill_mode, fill_color_hex)
+    return image.rotate(-angle, resample=resample, expand=True, fillcolor=fill_color_tuple)
+
+
+def rotation_affine(size, angle):
+    # rotate_free と同じ出力サイズと 出力座標 -> 入力座標 のアフィン係数 (Pillow の rotate(expand=True) と同じ計算)
+    w, h = size
+    rad = math.radians(angle)
+    matrix = [round(math.cos(rad), 15), round(math.sin(rad), 15), 0.0, round(-math.sin(rad), 15), round(math.cos(rad), 15), 0.0]
+    center_x = w / 2; center_y = h / 2
+    matrix[2] = matrix[0] * -center_x + matrix[1] * -center_y + center_x
+    matrix[5] = matrix[3] * -center_x + matrix[4] * -center_y + center_y
+    xx = []; yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        xx.append(matrix[0] * x + matrix[1] * y + matrix[2]); yy.append(matrix[3] * x + matrix[4] * y + matrix[5])
+    new_w = math.ceil(max(xx)) - math.floor(min(xx)); new_h = math.ceil(max(yy)) - math.floor(min(yy))
+    shift_x = -(new_w - w) / 2.0; shift_y = -(new_h - h) / 2.0
+    matrix[2], matrix[5] = (matrix[0] * shift_x + matrix[1] * shift_y + matrix[2], matrix[3] * shift_x + matrix[4] * shift_y + matrix[5])
+    return (new_w, new_h), tuple(matrix)
+
+
+def transpose_affine(size, quarter_turns):
+    # 時計回り quarter_turns 回の90°回転の出力サイズとアフィン係数 (整数位置を参照するので補間しても画素は変わらない)
+    w, h = size
+    quarter_turns %= 4
+    if quarter_turns == 1: return (h, w), (0, 1, 0, -1, 0, h)
+    if quarter_turns == 2: return (w, h), (-1, 0, w, 0, -1, h)
+    if quarter_turns == 3: return (h, w), (0, -1, w, 1, 0, 0)
+    return (w, h), (1, 0, 0, 0, 1, 0)
+
+
+def compose_affine(outer, inner):
+    # inner (出力 -> 中間) の後に outer (中間 -> 入力) を適用する係数
+    a, b, c, d, e, f = outer
+    p, q, r, s, t, u = inner
+    return (a * p + b * s, a * q + b * t, a * r + b * u + c,
+            d * p + e * s, d * q + e * t, d * r + e * u + f)
+
+
+def transpose_quarter_turns(image, quarter_turns):
+    transpose_mode = TRANSPOSE_BY_QUARTER_TURNS.get(quarter_turns % 4)
+    return image.transpose(transpose_mode) if transpose_mode is not None else image
+
+
+def fit_scale(size, max_size):
+    # size を max_size に収める縮小率 (拡大はしない)
+    w, h = size; max_w, max_h = max_size
+    if w <= 0 or h <= 0: return 1.0
+    return min(max_w / w, max_h / h, 1.0)
+
+
+@timing.timed("proxy")
+def make_proxy(image, scale, resample=RESAMPLE_LANCZOS, base=None):
+    # プレビュー用の縮小画像。reducing_gap で大きな縮小を高速化する。
+    # base (同じ画像の縮小デコード結果など) が十分大きければ、画素はそちらから作る
+    if scale >= 1.0: return image
+    proxy_size = (max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale))))
+    if base is not None and base.width >= proxy_size[0] and base.height >= proxy_size[1]: image = base
+    return image.resize(proxy_size, resample, reducing_gap=3.0)
+
+
+def rotated_bounds(size, angle):
+    # angle 度回転 (expand=True) した後の外接矩形サイズ (小数)
+    w, h = size
+    rad = math.radians(angle); cos_a = abs(math.cos(rad)); sin_a = abs(math.sin(rad))
+    return w * cos_a + h * sin_a, w * sin_a + h * cos_a
+
+
+def render_rotation_preview(proxy, angle, fill_mode, fill_color_hex, max_size, resample=RESAMPLE_NEAREST):
+    # 自由回転のライブプレビュー。回転と max_size への縮小を1回のアフィン変換で行い、出力画素だけを補間する
+    try: proxy, fill_color_tuple = rotation_fill_for(proxy, fill_mode, fill_color_hex)
+    except ValueError: proxy, fill_color_tuple = rotation_fill_for(proxy, fill_mode, "#%02x%02x%02x" % FALLBACK_FILL_RGB)
+    bounds_w, bounds_h = rotated_bounds(proxy.size, angle)
+    scale = fit_scale((bounds_w, bounds_h), max_size)
+    out_w = max(1, int(round(bounds_w * scale))); out_h = max(1, int(round(bounds_h * scale)))
+    # 出力座標 -> 入力座標 (中心同士を対応させ、逆回転して 1/scale 倍)
+    rad = math.radians(angle); cos_a = math.cos(rad) / scale; sin_a = math.sin(rad) / scale
+    out_cx = out_w / 2; out_cy = out_h / 2; in_cx = proxy.width / 2; in_cy = proxy.height / 2
+    coeffs = (cos_a, sin_a, in_cx - cos_a * out_cx - sin_a * out_cy,
+              -sin_a, cos_a, in_cy + sin_a * out_cx - cos_a * out_cy)
+    return proxy.transform((out_w, out_h), Image.AFFINE, coeffs, resample=resample, fillcolor=fill_color_tuple)
+
+
+def compute_center_crop_box(size, aspect_tuple):
+    # 指定比率で最大となる中央の切り抜き範囲
+    orig_w, orig_h = size
+    target_ar = aspect_tuple[0] / aspect_tuple[1]
+    if orig_w / orig_h > target_ar: crop_w = max(1, int(round(orig_h * target_ar))); crop_h = orig_h
+    else: crop_w = orig_w; crop_h = max(1, int(round(orig_w / target_ar)))
+    left = (orig_w - crop_w) // 2; top = (orig_h - crop_h) // 2
+    return left, top, left + crop_w, top + crop_h
+
+
+def compute_extend_layout(size, aspect_tuple, position="center"):
+    # 拡張後のサイズと元画像の貼り付け位置。比率が同じなら None
+    orig_w, orig_h = size
+    target_ar = aspect_tuple[0] / aspect_tuple[1]
+    current_ar = orig_w / orig_h if orig_h > 0 else float('inf')
+    if abs(target_ar - current_ar) < 1e-6: return None
+    if target_ar > current_ar: final_h = orig_h; final_w = int(round(orig_h * target_ar))
+    else: final_w = orig_w; final_h = int(round(orig_w / target_ar))
+    # Y座標 (上下方向) の計算
+    if final_h > orig_h: # 縦に拡張される場合
+        if position == "top": paste_y = 0
+        elif position == "bottom": paste_y = final_h - orig_h
+        else: paste_y = (final_h - orig_h) // 2 # "center", "left", "right"
+    else: paste_y = 0 # 横拡張 (final_h == orig_h)
+    # X座標 (左右方向) の計算
+    if final_w > orig_w: # 横に拡張される場合
+        if position == "left": paste_x = 0
+        elif position == "right": paste_x = final_w - orig_w
+        else: paste_x = (final_w - orig_w) // 2 # "center", "top", "bottom"
+    else: paste_x = 0 # 縦拡張 (final_w == orig_w)
+    return final_w, final_h, paste_x, paste_y
+
+
+def _edge_box(size, side, start, end):
+    # 辺 side から内側へ距離 [start, end) の帯の矩形
+    w, h = size
+    if side == "top": return (0, start, w, end)
+    if side == "bottom": return (0, h - end, w, h - start)
+    if side == "left": return (start, 0, end, h)
+    return (w - end, 0, w - start, h)
+
+
+def _reduce_edge(source_image, side, thickness, factors, cache=None):
+    # 端から thickness の帯を factors で縮小する。縮小の区切りは元画像の端に揃え、端数は内側の1ブロックにまとめる
+    # (どの厚みでも端側のブロックが同じになるので、EdgeMaterialCache で比率違いの素材と共有できる)
+    vertical = side in ("top", "bottom")
+    across = factors[1] if vertical else factors[0]
+    full = thickness // across * across
+    outer = None
+    if full: outer = cache.reduced_outer(side, full, factors) if cache is not None else source_image.reduce(factors, box=_edge_box(source_image.size, side, 0, full))
+    inner = source_image.reduce(factors, box=_edge_box(source_image.size, side, full, thickness)) if thickness > full else None
+    if outer is None or inner is None: return outer if inner is None else inner
+    first, second = (outer, inner) if side in ("top", "left") else (inner, outer)
+    reduced = Image.new(first.mode, (first.width, first.height + second.height) if vertical else (first.width + second.width, first.height))
+    reduced.paste(first, (0, 0)); reduced.paste(second, (0, first.height) if vertical else (first.width, 0))
+    return reduced
+
+
+@timing.timed("fill")
+def _simple_edge_material(source_image, side, padding, fill_mode):
+    # ぼかしを使わない余白の素材と、余白サイズへの拡大に使うフィルタ
+    orig_w, orig_h = source_image.size
+    vertical = side in ("top", "bottom")
+    if fill_mode == "stretch": return source_image.crop(_edge_box(source_image.size, side, 0, 1)), RESAMPLE_NEAREST
+    if fill_mode == "mean":
+        # 端の帯 (ぼかしと同じく余白の半分の厚み) を1行 (1列) に平均し、余白の厚み方向へ引き伸ばす
+        thickness = min(orig_h if vertical else orig_w, max(1, padding // 2))
+        return source_image.resize((orig_w, 1) if vertical else (1, orig_h), RESAMPLE_BOX, box=_edge_box(source_image.size, side, 0, thickness)), RESAMPLE_NEAREST
+    # mirror: 余白の厚みだけ端から折り返す。元画像の方が薄ければ折り返した全体を引き伸ばす
+    thickness = min(orig_h if vertical else orig_w, padding)
+    material = source_image.crop(_edge_box(source_image.size, side, 0, thickness)).transpose(FLIP_TOP_BOTTOM if vertical else FLIP_LEFT_RIGHT)
+    return material, (RESAMPLE_NEAREST if thickness == padding else RESAMPLE_BILINEAR)
+
+
+def _edge_material(source_image, side, padding, blur_radius_val, cache=None, fill_mode="blur"):
+    # 余白用の素材 (余白より小さい画像) と、余白サイズへの拡大に使うフィルタ
+    if fill_mode == "blur": return _blur_edge_material(source_image, side, padding, blur_radius_val, cache)
+    if source_image.width <= 0 or source_image.height <= 0: return None, None
+    return _simple_edge_material(source_image, side, padding, fill_mode)
+
+
+@timing.timed("blur")
+def _blur_edge_material(source_image, side, padding, blur_radius_val, cache=None):
+    # 元画像の端 (padding の半分の厚み) をぼかした縮小画像
+    orig_w, orig_h = source_image.size
+    vertical = side in ("top", "bottom")
+    desired_source_thickness = max(1, padding // 2)
+    actual_source_thickness = min(orig_h if vertical else orig_w, desired_source_thickness)
+    if orig_w <= 0 or orig_h <= 0: return None, None
+    if actual_source_thickness < desired_source_thickness:
+        # 元画像より厚い素材が必要な場合は引き伸ばしてからぼかす
+        source_material = source_image.crop(_edge_box(source_image.size, side, 0, actual_source_thickness))
+        source_material = source_material.resize((orig_w, desired_source_thickness) if vertical else (desired_source_thickness, orig_h), RESAMPLE_LANCZOS)
+        return blur_for_resize(source_material, blur_radius_val, RESAMPLE_LANCZOS, RESAMPLE_BILINEAR)
+    factors = pyramid_factors((orig_w, actual_source_thickness) if vertical else (actual_source_thickness, orig_h), blur_radius_val) if blur_radius_val > 0 else (1, 1)
+    if factors == (1, 1):
+        return blur_for_resize(source_image.crop(_edge_box(source_image.size, side, 0, actual_source_thickness)), blur_radius_val, RESAMPLE_LANCZOS, RESAMPLE_BILINEAR)
+    return blur_reduced(_reduce_edge(source_image, side, actual_source_thickness, factors, cache), blur_radius_val, factors), RESAMPLE_BILINEAR
+
+
+class EdgeMaterialCache:
+    # 同じ元画像・ぼかし半径から複数の比率へ拡張するときに余白用の素材を共有する。
+    # reserve で各辺に必要な最大の余白を先に登録しておくと、全解像度の端の縮小は辺ごとに1回で済み、
+    # 比率ごとの素材はその縮小済みの帯から切り出して作る (単独で extend_image した場合と同じ画素になる)
+    def __init__(self, source_image, blur_radius_val, fill_mode="blur"):
+        self.source_image = source_image; self.blur_radius_val = blur_radius_val; self.fill_mode = fill_mode
+        self._thickness = {} # 辺 -> 必要な最大の厚み
+        self._reduced = {}   # (辺, 縮小率) -> (縮小した厚み, 縮小済みの帯)
+        self._materials = {} # (辺, 余白) -> (素材, フィルタ)
+        self._pending = set() # prepare で作る (辺, 余白)
+
+    def reserve(self, side, padding):
+        self._thickness[side] = max(self._thickness.get(side, 0), max(1, padding // 2))
+        self._pending.add((side, padding))
+
+    def reserve_extend(self, aspect_tuple, position="center"):
+        # extend_image(source_image, aspect_tuple, blur_radius_val, position) が使う余白をすべて登録する
+        layout = compute_extend_layout(self.source_image.size, aspect_tuple, position)
+        if layout is None: return
+        for side, (padding, _) in _extend_paddings(self.source_image.size, layout).items():
+            if padding > 0: self.reserve(side, padding)
+
+    def prepare(self):
+        # 登録済みの素材をまとめて作る。以降は読むだけなので、複数のスレッドから extend_image に渡してよい
+        for side, padding in sorted(self._pending): self.material(side, padding)
+        self._pending.clear()
+
+    def reduced_outer(self, side, full, factors):
+        # 端から full (縮小率の倍数) の帯の縮小結果。共有の帯が足りなければ作り直す
+        vertical = side in ("top", "bottom")
+        across = factors[1] if vertical else factors[0]
+        entry = self._reduced.get((side, factors))
+        if entry is None or entry[0] < full:
+            limit = self.source_image.height if vertical else self.source_image.width
+            shared = min(max(full, self._thickness.get(side, 0)), limit) // across * across
+            entry = (shared, self.source_image.reduce(factors, box=_edge_box(self.source_image.size, side, 0, shared)))
+            self._reduced[(side, factors)] = entry
+        shared, reduced = entry
+        if shared == full: return reduced
+        blocks = full // across; w, h = reduced.size
+        if side == "top": return reduced.crop((0, 0, w, blocks))
+        if side == "bottom": return reduced.crop((0, h - blocks, w, h))
+        if side == "left": return reduced.crop((0, 0, blocks, h))
+        return reduced.crop((w - blocks, 0, w, h))
+
+    def material(self, side, padding):
+        key = (side, padding)
+        if key not in self._materials: self._materials[key] = _edge_material(self.source_image, side, padding, self.blur_radius_val, self, self.fill_mode)
+        return self._materials[key]
+
+
+def _edge_fill(source_image, side, padding, final_w, final_h, blur_radius_val, material_cache=None, fill_mode="blur"):
+    # 元画像の端をぼかし (fill_mode の方法で加工し)、余白サイズに引き伸ばす
+    material, resample = material_cache.material(side, padding) if material_cache is not None else _edge_material(source_image, side, padding, blur_radius_val, None, fill_mode)
+    if material is None: return None
+    return material.resize((final_w, padding) if side in ("top", "bottom") else (padding, final_h), resample)
+
+
+def _extend_paddings(size, layout):
+    # 辺ごとの (余白の厚み, 貼り付け位置)
+    orig_w, orig_h = size
+    final_w, final_h, paste_x, paste_y = layout
+    return {
+        "top": (paste_y, (0, 0)),
+        "bottom": (final_h - (paste_y + orig_h), (0, paste_y + orig_h)),
+        "left": (paste_x, (0, 0)),
+        "right": (final_w - (paste_x + orig_w), (paste_x + orig_w, 0)),
+    }
+
+
+@timing.timed("extend")
+def extend_image(source_image, aspect_tuple, blur_radius_val=DEFAULT_BLUR_RADIUS, position="center", material_cache=None, fill_mode="blur"):
+    # 指定比率になるよう余白を追加し、余白を端のぼかし (または fill_mode の方法) で埋める。
+    # material_cache (source_image・blur_radius_val・fill_mode が同じ EdgeMaterialCache) があれば素材を共有する
+    if not source_image or not aspect_tuple: return None
+    layout = compute_extend_layout(source_image.size, aspect_tuple, position)
+    if layout is None: return source_image.copy()
+    final_w, final_h, paste_x, paste_y = layout
+    if final_w <= 0 or final_h <= 0: return None
+    output_mode = source_image.mode
+    has_alpha = 'A' in output_mode
+    initial_fill_for_extended = fill_color_for_mode(output_mode, (0, 0, 0), 0) if has_alpha else fill_color_for_mode(output_mode, FALLBACK_FILL_RGB)
+    extended_image = Image.new(output_mode, (final_w, final_h), initial_fill_for_extended)
+    extended_image.paste(source_image, (paste_x, paste_y), mask=source_image if has_alpha else None)
+
+    for side, (padding, offset) in _extend_paddings(source_image.size, layout).items():
+        if padding <= 0: continue
+        fill_content = _edge_fill(source_image, side, padding, final_w, final_h, blur_radius_val, material_cache, fill_mode)
+        if fill_content is not None: extended_image.paste(fill_content, offset, mask=fill_content if has_alpha else None)
+    extended_image.paste(source_image, (paste_x, paste_y), mask=source_image if has_alpha else None)
+    return extended_image
+
+
+def extend_strips(source_image, aspect_tuple, blur_radius_val=DEFAULT_BLUR_RADIUS, position="center", strip_rows=256, fill_mode="blur"):
+    # extend_image と同じ結果を上から strip_rows 行ずつ (y, 帯画像) として返すジェネレータ。
+    # 保持するのは元画像と余白用の縮小ぼかし素材だけで、出力全体の画像は作らない。
+    # 余白は素材から帯の範囲だけを resize(box=...) で拡大する。stretch・mean と、折り返しを引き伸ばさない mirror は extend_image と一致する。
+    # 補間して拡大する余白 (blur と、元画像より厚い余白の mirror) は、帯の境界で補間係数の丸めが変わるので STRIP_TOLERANCE まで違うことがある
+    if not source_image or not aspect_tuple: return
+    layout = compute_extend_layout(source_image.size, aspect_tuple, position)
+    orig_w, orig_h = source_image.size
+    final_w, final_h, paste_x, paste_y = layout or (orig_w, orig_h, 0, 0)
+    if final_w <= 0 or final_h <= 0: return
+    has_alpha = 'A' in source_image.mode
+    initial_fill_for_extended = fill_color_for_mode(source_image.mode, (0, 0, 0), 0) if has_alpha else fill_color_for_mode(source_image.mode, FALLBACK_FILL_RGB)
+    paddings = _extend_paddings(source_image.size, layout) if layout else {}
+    materials = {side: _edge_material(source_image, side, padding, blur_radius_val, None, fill_mode) for side, (padding, _) in paddings.items() if padding > 0}
+    strip_rows = max(1, int(strip_rows))
+    for y0 in range(0, final_h, strip_rows):
+        y1 = min(final_h, y0 + strip_rows)
+        source_y0 = max(y0, paste_y); source_y1 = min(y1, paste_y + orig_h)
+        source_part = source_image.crop((0, source_y0 - paste_y, orig_w, source_y1 - paste_y)) if source_y0 < source_y1 else None
+        if layout is None: yield y0, source_part; continue
+        strip = Image.new(source_image.mode, (final_w, y1 - y0), initial_fill_for_extended)
+        if source_part is not None: strip.paste(source_part, (paste_x, source_y0 - y0), mask=source_part if has_alpha else None)
+        for side, (material, resample) in materials.items():
+            if material is None: continue
+            padding, (offset_x, offset_y) = paddings[side]
+            if side in ("top", "bottom"): fill_w = final_w; fill_y0 = max(y0, offset_y); fill_y1 = min(y1, offset_y + padding); fill_h = padding
+            else: fill_w = padding; fill_y0 = y0; fill_y1 = y1; fill_h = final_h
+            if fill_y0 >= fill_y1: continue
+            scale = material.height / fill_h
+            fill_content = material.resize((fill_w, fill_y1 - fill_y0), resample, box=(0, (fill_y0 - offset_y) * scale, material.width, (fill_y1 - offset_y) * scale))
+            strip.paste(fill_content, (offset_x, fill_y0 - y0), mask=fill_content if has_alpha else None)
+        if source_part is not None: strip.paste(source_part, (paste_x, source_y0 - y0), mask=source_part if has_alpha else None)
+        yield y0, strip
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import threading
+import weakref
+
+from . import core, timing
+
+# キャンバス表示用の縮小画像キャッシュ。
+# 画像ごとに 1/2, 1/4, ... のミップマップを必要な段まで作り、目的サイズ以上で最小の段から縮小する。
+# 縮小結果は (画像, 表示サイズ) ごとに保持するので、同じ画像を同じサイズで二度リサンプリングしない。
+# キーは画像オブジェクトの同一性 (id + weakref)。画像が破棄されると対応するエントリも消える。
+# 拡大表示では TileCache が同じミップマップを使い、見えている部分だけをタイルとして作る。
+# quick は、まだ作っていない縮小を作ってある段から NEAREST で即座に作った仮のエントリを返す (GUI が先に表示し、
+# 本来の縮小は refine でワーカースレッドから作る)。そのため辞書の操作はロックで守るが、縮小そのものはロックの外で行う。
+
+MAX_PYRAMIDS = 4
+MAX_ENTRIES = 16
+MIN_LEVEL_SIDE = 64
+TILE_SIZE = 256 # 拡大表示のタイルの一辺 (表示上の画素)
+MAX_TILES = 128 # 保持するタイル数 (約 25MB + PhotoImage)
+
+
+class DisplayEntry:
+    # image: 表示サイズの PIL 画像。photo: GUI 側が作る ImageTk.PhotoImage を一緒に保持する。
+    # refine: 仮のエントリなら本来の画質のエントリを作って返す関数 (キャッシュにも入る)。本来のエントリは None
+    def __init__(self, image, refine=None):
+        self.image = image
+        self.photo = None
+        self.refine = refine
+
+
+class DisplayCache:
+    def __init__(self, max_pyramids=MAX_PYRAMIDS, max_entries=MAX_ENTRIES):
+        self.max_pyramids = max_pyramids
+        self.max_entries = max_entries
+        self._pyramids = OrderedDict() # id(image) -> (weakref, [level0, level1, ...])
+        self._entries = OrderedDict()  # (id(image), size) -> (weakref, DisplayEntry)
+        self._lock = threading.RLock() # weakref のコールバックはロック中の同じスレッドからも呼ばれうる
+
+    def _forget(self, image_id):
+        with self._lock:
+            self._pyramids.pop(image_id, None)
+            for key in [key for key in self._entries if key[0] == image_id]: del self._entries[key]
+
+    def _alive(self, table, key, image):
+        # id の再利用で別画像のエントリを返さないよう、weakref の参照先まで確認する
+        item = table.get(key)
+        if item is None: return None
+        if item[0]() is not image: del table[key]; return None
+        table.move_to_end(key)
+        return item[1]
+
+    def _levels(self, image):
+        # image 自身を除く縮小段のリスト (image を強参照しないので weakref のコールバックで破棄される)
+        image_id = id(image)
+        levels = self._alive(self._pyramids, image_id, image)
+        if levels is None:
+            levels = []
+            self._pyramids[image_id] = (weakref.ref(image, lambda _, image_id=image_id: self._forget(image_id)), levels)
+            while len(self._pyramids) > self.max_pyramids: self._pyramids.popitem(last=False)
+        return levels
+
+    def existing_level(self, image, size):
+        # 作ってある段のうち size 以上で最も小さいもの (段を作り足さない)
+        with self._lock:
+            for level in reversed(self._levels(image)):
+                if level.width >= size[0] and level.height >= size[1]: return level
+        return image
+
+    def largest_level(self, image):
+        # 作ってある段のうち最も大きいもの (なければ image 自身)
+        with self._lock: levels = self._levels(image)
+        return levels[0] if levels else image
+
+    def level_for(self, image, size):
+        # size 以上で最も小さいミップマップ段。足りない段はここで 1/2 ずつ作り足す
+        target_w, target_h = size
+        while True:
+            with self._lock: levels = self._levels(image); count = len(levels); last = levels[-1] if levels else image
+            if last.width // 2 < max(target_w, MIN_LEVEL_SIDE) or last.height // 2 < max(target_h, MIN_LEVEL_SIDE): break
+            reduced = last.reduce(2)
+            with self._lock:
+                if len(levels) == count: levels.append(reduced) # 別のスレッドが先に作っていれば捨てる
+        return self.existing_level(image, size)
+
+    def peek(self, image, size):
+        with self._lock: return self._alive(self._entries, (id(image), tuple(size)), image)
+
+    def get(self, image, size):
+        key = (id(image), tuple(size))
+        entry = self.peek(image, size)
+        if entry is None:
+            with timing.stage("resize", size=list(size)):
+                level = self.level_for(image, size)
+                resized = level if level.size == tuple(size) else level.resize(size, core.RESAMPLE_LANCZOS)
+            entry = DisplayEntry(resized)
+            with self._lock:
+                self._entries[key] = (weakref.ref(image), entry)
+                while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return entry
+
+    def quick(self, image, size):
+        # 作ってあればそのエントリ、なければ作ってある段から NEAREST で縮小した仮のエントリ (キャッシュしない)
+        entry = self.peek(image, size)
+        if entry is not None: return entry
+        level = self.existing_level(image, size)
+        if level.size == tuple(size): return self.get(image, size)
+        with timing.stage("resize", size=list(size), quick=True): resized = level.resize(size, core.RESAMPLE_NEAREST)
+        return DisplayEntry(resized, refine=lambda: self.get(image, size))
+
+    def clear(self):
+        with self._lock: self._pyramids.clear(); self._entries.clear()
+
+
+class TileCache:
+    # 拡大表示用のタイル。表示倍率 scale (表示上の画素 / 元画像の画素) で見えている TILE_SIZE 四方のタイルだけを作る。
+    # 縮小表示 (scale < 1) は DisplayCache のミップマップから、拡大表示は元画像から、タイルの範囲だけを resize(box=...) する。
+    # quick の仮のタイルは、縮小表示なら作ってある段から、拡大表示なら縮小デコード版 (base) か作ってある一番大きい段から作る
+    # (元画像がまだデコードされていなくても GUI のスレッドでデコードを起こさない)。
+    # 作るのも保持するのも画面に見えている程度の画素だけなので、元画像の大きさによらずメモリと描画時間がほぼ一定になる
+    def __init__(self, display_cache, max_tiles=MAX_TILES, tile_size=TILE_SIZE):
+        self.display_cache = display_cache; self.max_tiles = max_tiles; self.tile_size = tile_size
+        self._entries = OrderedDict() # (id(image), scale, tx, ty) -> (weakref, DisplayEntry)
+        self._lock = threading.Lock()
+
+    def view_size(self, image, scale):
+        return max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale)))
+
+    def visible_tiles(self, image, scale, view_box):
+        # 表示上の矩形 view_box (left, top, right, bottom) に掛かるタイル番号 (tx, ty)
+        view_w, view_h = self.view_size(image, scale); size = self.tile_size
+        left = max(0, int(view_box[0]) // size); top = max(0, int(view_box[1]) // size)
+        right = min((view_w - 1) // size, int(view_box[2]) // size); bottom = min((view_h - 1) // size, int(view_box[3]) // size)
+        return [(tx, ty) for ty in range(top, bottom + 1) for tx in range(left, right + 1)]
+
+    def _quick_source(self, image, scale, base=None):
+        level = self.display_cache.existing_level(image, self.view_size(image, scale)) if scale < 1.0 else self.display_cache.largest_level(image)
+        return base if level is image and base is not None else level
+
+    def _render(self, image, scale, tx, ty, quick=False, base=None):
+        view_w, view_h = self.view_size(image, scale); size = self.tile_size
+        x0 = tx * size; y0 = ty * size; x1 = min(view_w, x0 + size); y1 = min(view_h, y0 + size)
+        if quick: level = self._quick_source(image, scale, base)
+        elif scale < 1.0: level = self.display_cache.level_for(image, (view_w, view_h))
+        else: level = image
+        level_x = level.width / view_w; level_y = level.height / view_h
+        resample = core.RESAMPLE_LANCZOS if scale < 1.0 and not quick else core.RESAMPLE_NEAREST # 拡大時は画素の境界が見えるように
+        return level.resize((x1 - x0, y1 - y0), resample, box=(x0 * level_x, y0 * level_y, x1 * level_x, y1 * level_y))
+
+    def _peek(self, image, scale, tx, ty):
+        key = (id(image), scale, tx, ty)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0]() is image: self._entries.move_to_end(key); return item[1]
+        return None
+
+    def get(self, image, scale, tx, ty):
+        entry = self._peek(image, scale, tx, ty)
+        if entry is not None: return entry
+        with timing.stage("resize", tile=[tx, ty]): entry = DisplayEntry(self._render(image, scale, tx, ty))
+        with self._lock:
+            self._entries[(id(image), scale, tx, ty)] = (weakref.ref(image), entry)
+            while len(self._entries) > self.max_tiles: self._entries.popitem(last=False)
+        return entry
+
+    def quick(self, image, scale, tx, ty, base=None):
+        # 作ってあれば本来のタイル、そうでなければ仮のタイル。base は image の縮小デコード版 (拡大表示の仮のタイルに使う)。
+        # 拡大表示で image より小さい画像がなければ (デコード済みのはずなので) NEAREST で本来のタイルをそのまま作る
+        entry = self._peek(image, scale, tx, ty)
+        if entry is not None: return entry
+        if scale >= 1.0 and self._quick_source(image, scale, base) is image: return self.get(image, scale, tx, ty)
+        with timing.stage("resize", tile=[tx, ty], quick=True): tile = self._render(image, scale, tx, ty, quick=True, base=base)
+        return DisplayEntry(tile, refine=lambda: self.get(image, scale, tx, ty))
+
+    def clear(self):
+        with self._lock: self._entries.clear()
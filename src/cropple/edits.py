@@ -0,0 +1,222 @@
+from collections import OrderedDict
+
+from . import core, timing
+
+# 非破壊編集スタック。操作はタプルのデータとして保持し、常に元画像から描画し直す。
+#   ("transpose", quarter_turns)                         時計回り90°単位の回転
+#   ("rotate", angle, fill_mode, fill_color_hex)         自由回転 (expand=True)
+#   ("crop", (left, top, right, bottom))                 直前の段階の座標での切り抜き
+#   ("extend", (aspect_w, aspect_h), blur_radius, position[, fill_mode])  fill_mode は core.EXTEND_FILL_MODES (省略時 blur)
+# 連続する同種の操作は push 時にまとめるので、回転を繰り返しても再補間は1回で済む。
+# 途中結果は LRU キャッシュに残し、変更のあった後ろの部分だけを描き直す。
+# pool (buffers.BufferPool) を渡すと元画像と途中結果をそこに登録し、メモリ上に置くのは pool の上限までにする
+# (上限を超えた古いものは一時ファイルへ退避され、キャッシュからは消えずに次に使うとき読み戻される)。
+
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def merge_op(previous, op):
+    # previous の直後に op を積むとき、1つにまとめられればまとめた操作を返す (打ち消し合えば ())。
+    # まとめられなければ None
+    if previous is None or previous[0] != op[0]: return None
+    if op[0] == "transpose":
+        quarter_turns = (previous[1] + op[1]) % 4
+        return ("transpose", quarter_turns) if quarter_turns else ()
+    if op[0] == "rotate" and previous[2:] == op[2:]:
+        angle = previous[1] + op[1]
+        return ("rotate", angle) + op[2:] if abs(angle) >= 0.1 else ()
+    if op[0] == "crop":
+        outer_left, outer_top = previous[1][:2]
+        left, top, right, bottom = op[1]
+        return ("crop", (outer_left + left, outer_top + top, outer_left + right, outer_top + bottom))
+    if op[0] == "extend": return op # 拡張の設定変更は置き換え
+    return None
+
+
+def apply_op(image, op):
+    kind = op[0]
+    if kind == "transpose": return core.transpose_quarter_turns(image, op[1])
+    if kind == "rotate": return core.rotate_free(image, op[1], op[2], op[3])
+    if kind == "crop": return image.crop(op[1])
+    if kind == "extend":
+        extended = core.extend_image(image, op[1], op[2], op[3], fill_mode=op[4] if len(op) > 4 else "blur")
+        if extended is None: raise ValueError("拡張画像の生成に失敗しました。設定を確認してください。")
+        return extended
+    raise ValueError(f"unknown edit operation: {kind!r}")
+
+
+class RenderCache:
+    # 操作列のプレフィックス (タプル) -> 描画結果 の LRU キャッシュ。合計バイト数 (pool があれば退避済みの分も含む) で上限を決める
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, pool=None):
+        self.max_bytes = max_bytes; self.pool = pool
+        self._entries = OrderedDict() # キー -> 画像 (pool があれば buffers.Buffer)
+        self._total_bytes = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        self._entries.move_to_end(key)
+        return entry if self.pool is None else entry.get()
+
+    def _drop(self, entry):
+        if self.pool is None: self._total_bytes -= image_nbytes(entry)
+        else: self._total_bytes -= entry.nbytes; entry.release()
+
+    def put(self, key, image):
+        if key in self._entries: self._drop(self._entries.pop(key))
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes: return
+        self._entries[key] = image if self.pool is None else self.pool.register(image); self._total_bytes += nbytes
+        while self._total_bytes > self.max_bytes: self._drop(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        for entry in list(self._entries.values()): self._drop(entry)
+        self._entries.clear(); self._total_bytes = 0
+
+
+GEOMETRY_OPS = ("transpose", "rotate", "crop")
+
+
+def geometry_run_end(ops, start):
+    # start から続く、1回のアフィン変換にまとめられる幾何操作の終わり (自由回転の余白設定が揃っている範囲)。
+    # 切り抜きの後の自由回転はまとめない (回転で見える角に、切り抜きで捨てた画素ではなく余白の色が入るようにする)
+    fill = None; cropped = False; end = start
+    while end < len(ops) and ops[end][0] in GEOMETRY_OPS:
+        if ops[end][0] == "rotate":
+            if cropped or (fill is not None and ops[end][2:] != fill): break
+            fill = ops[end][2:]
+        elif ops[end][0] == "crop": cropped = True
+        end += 1
+    return end
+
+
+@timing.timed("geometry")
+def render_geometry(image, ops):
+    # 90°回転・自由回転・切り抜きを合成したアフィン変換1回で描画する。
+    # 出力画素だけを補間するので、回転後の拡張キャンバスを作ってから切り抜くより速く省メモリ
+    rotations = [op for op in ops if op[0] == "rotate"]
+    if not rotations:
+        for op in ops: image = apply_op(image, op) # 画素の並べ替えだけなので補間しない
+        return image
+    size = image.size; matrix = (1, 0, 0, 0, 1, 0)
+    for op in ops:
+        if op[0] == "transpose": size, op_matrix = core.transpose_affine(size, op[1])
+        elif op[0] == "rotate": size, op_matrix = core.rotation_affine(size, op[1])
+        else:
+            left, top, right, bottom = op[1]
+            size, op_matrix = (right - left, bottom - top), (1, 0, left, 0, 1, top)
+        matrix = core.compose_affine(matrix, op_matrix)
+    image, fill_color_tuple = core.rotation_fill_for(image, rotations[0][2], rotations[0][3])
+    return image.transform(size, core.Image.AFFINE, matrix, resample=core.RESAMPLE_BICUBIC, fillcolor=fill_color_tuple)
+
+
+def render_ops(original, ops, cache=None):
+    # 元画像に ops を適用する。cache があれば最長の描画済みプレフィックスから再開し、
+    # 連続する幾何操作はまとめて1回のリサンプリングで描画する
+    ops = tuple(ops)
+    start = 0; image = original
+    if cache is not None:
+        for i in range(len(ops), 0, -1):
+            cached = cache.get(ops[:i])
+            if cached is not None: start = i; image = cached; break
+    while start < len(ops):
+        end = geometry_run_end(ops, start)
+        if end > start: image = render_geometry(image, ops[start:end])
+        else: image = apply_op(image, ops[start]); end = start + 1
+        if cache is not None: cache.put(ops[:end], image)
+        start = end
+    return image
+
+
+class EditStack:
+    # 履歴は操作列のスナップショットとして持つので、まとめた操作も1手ずつ元に戻せる
+    def __init__(self, original, max_cache_bytes=DEFAULT_CACHE_BYTES, pool=None):
+        self.pool = pool
+        self._original = original if pool is None else pool.register(original)
+        self._history = [()]
+        self._position = 0
+        self.cache = RenderCache(max_cache_bytes, pool)
+
+    @property
+    def original(self):
+        # 退避されていれば読み戻す。同じ画像かどうかを見るだけなら is_original を使う
+        return self._original if self.pool is None else self._original.get()
+
+    def is_original(self, image):
+        return image is not None and image is (self._original if self.pool is None else self._original.peek())
+
+    def close(self):
+        # pool に登録したバッファを手放す (別の画像を開いたとき)
+        self.cache.clear()
+        if self.pool is not None: self._original.release()
+
+    @property
+    def ops(self): return self._history[self._position]
+
+    def _commit(self, ops):
+        del self._history[self._position + 1:]
+        self._history.append(tuple(ops)); self._position += 1
+
+    def push(self, op):
+        # 直前の操作とまとめられる場合は置き換え、打ち消し合う場合は取り除く
+        ops = list(self.ops)
+        merged = merge_op(ops[-1] if ops else None, op)
+        if merged is None: ops.append(op)
+        elif merged: ops[-1] = merged
+        else: ops.pop()
+        self._commit(ops)
+
+    def clear(self):
+        if self.ops: self._commit(())
+
+    def replace(self, ops):
+        # 操作列を丸ごと置き換える (1手として元に戻せる)
+        if tuple(ops) != self.ops: self._commit(ops)
+
+    def undo(self):
+        if not self.can_undo(): return False
+        self._position -= 1; return True
+
+    def redo(self):
+        if not self.can_redo(): return False
+        self._position += 1; return True
+
+    def can_undo(self): return self._position > 0
+
+    def can_redo(self): return self._position < len(self._history) - 1
+
+    def render(self, extra_ops=()):
+        # extra_ops (保存時の拡張など) は履歴に積まずに末尾へ付けて描画する
+        return render_ops(self.original, self.ops + tuple(extra_ops), self.cache)
+
+
+def geometry_output_size(size, ops):
+    # 描画せずに幾何操作後の画像サイズを求める
+    for op in ops:
+        if op[0] == "transpose": size = core.transpose_affine(size, op[1])[0]
+        elif op[0] == "rotate": size = core.rotation_affine(size, op[1])[0]
+        elif op[0] == "crop": size = (op[1][2] - op[1][0], op[1][3] - op[1][1])
+    return size
+
+
+def build_ops(size, settings, mode="extend", quarter_turns=0, rotation_angle=0.0):
+    # バッチ処理用: 回転 -> 切り抜き/拡張 を GUI と同じ順序・設定で操作列にする
+    ops = []
+    if quarter_turns % 4: ops.append(("transpose", quarter_turns % 4))
+    if abs(rotation_angle) >= 0.1:
+        ops.append(("rotate", rotation_angle, settings.get('rotation_fill_mode', "color"), settings.get('rotation_fill_color', core.DEFAULT_FILL_COLOR)))
+    size = geometry_output_size(size, ops)
+    aspect_tuple = core.resolve_aspect_ratio(settings, size)
+    if not aspect_tuple: return ops
+    if mode == "crop": ops.append(("crop", core.compute_center_crop_box(size, aspect_tuple)))
+    else: ops.append(("extend", aspect_tuple, int(settings.get('blur_radius', core.DEFAULT_BLUR_RADIUS)), settings.get('extend_position', "center"), settings.get('extend_fill', "blur")))
+    return ops
+
+
+def process_image(image, settings, mode="extend", quarter_turns=0, rotation_angle=0.0):
+    image = core.normalize_image_mode(image)
+    return render_ops(image, build_ops(image.size, settings, mode, quarter_turns, rotation_angle))
@@ -0,0 +1,103 @@
+from PIL import Image
+import contextlib
+import io
+import os
+
+from . import timing
+
+# 画像の書き出し。形式ごとのエンコーダ設定を扱い、GUI のバックグラウンド保存と
+# バッチ処理の両方から使う。一時ファイルに書いてから置き換えるので、
+# 途中でキャンセル・失敗しても保存先に壊れたファイルは残らない。
+
+ENCODER_DEFAULTS = {
+    'png_compress_level': 6,   # 0 (無圧縮・最速) - 9 (最小・最遅)
+    'jpeg_quality': 95,
+    'jpeg_optimize': False,
+    'jpeg_progressive': False,
+    'jpeg_lossless': False,    # JPEG の90°回転・切り抜きを再エンコードせずに行う (lossless.py)
+    'webp_quality': 90,
+    'webp_method': 4,          # 0 (最速) - 6 (最小)
+}
+
+SAVE_FILETYPES = [("PNG files", "*.png"), ("JPEG files", "*.jpg"), ("WebP files", "*.webp"), ("GIF files", "*.gif"), ("TIFF files", "*.tif"), ("All files", "*.*")]
+
+
+class SaveCancelled(Exception):
+    pass
+
+
+def encoder_settings_from(settings):
+    # 設定辞書からエンコーダ設定だけを取り出し、欠けているものは既定値で補う
+    return {key: settings.get(key, default) for key, default in ENCODER_DEFAULTS.items()}
+
+
+def save_options_for(path, encoder_settings=None):
+    # 保存先の拡張子に応じた Image.save のキーワード引数
+    encoder_settings = encoder_settings_from(encoder_settings or {})
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.png': return {'compress_level': int(encoder_settings['png_compress_level'])}
+    if ext in ('.jpg', '.jpeg'):
+        return {'quality': int(encoder_settings['jpeg_quality']), 'optimize': bool(encoder_settings['jpeg_optimize']),
+                'progressive': bool(encoder_settings['jpeg_progressive'])}
+    if ext == '.webp': return {'quality': int(encoder_settings['webp_quality']), 'method': int(encoder_settings['webp_method'])}
+    return {}
+
+
+def image_format_for(path, default=None):
+    # 拡張子 -> Pillow の形式名。PNG・JPEG・GIF・BMP は preinit で登録される分だけで引き、
+    # 全プラグインの読み込み (Image.init, 起動1回あたり数十 ms) はそれ以外の拡張子のときだけにする
+    ext = os.path.splitext(path)[1].lower()
+    Image.preinit()
+    return Image.EXTENSION.get(ext) or Image.registered_extensions().get(ext, default)
+
+
+def prepare_for_save(image, save_path):
+    # JPEG は透過を持てないので RGB に落とす
+    if save_path.lower().endswith(('.jpg', '.jpeg')) and image.mode not in ('RGB', 'RGBX', 'L'): return image.convert('RGB')
+    return image
+
+
+class ProgressFile:
+    # 書き込みバイト数を通知し、キャンセル要求があれば次の書き込みで中断するファイルラッパー
+    def __init__(self, f, progress=None, cancel_event=None):
+        self._f = f; self._progress = progress; self._cancel_event = cancel_event
+        self.bytes_written = 0
+
+    def write(self, data):
+        if self._cancel_event is not None and self._cancel_event.is_set(): raise SaveCancelled()
+        n = self._f.write(data)
+        self.bytes_written += len(data)
+        if self._progress: self._progress(self.bytes_written)
+        return n
+
+    def fileno(self):
+        # Pillow がファイル記述子へ直接書き込むとバイト数を数えられないので、write 経由にさせる
+        raise io.UnsupportedOperation("fileno")
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+@contextlib.contextmanager
+def atomic_output(save_path):
+    # 一時ファイルのパスを渡し、正常に抜けたら save_path へ置き換える。例外時は一時ファイルを消す
+    tmp_path = f"{save_path}.{os.getpid()}.part"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+
+@timing.timed("encode")
+def save_image(image, save_path, encoder_settings=None, progress=None, cancel_event=None):
+    # progress(書き込み済みバイト数) を呼びながら保存する。cancel_event がセットされると SaveCancelled
+    image = prepare_for_save(image, save_path)
+    image_format = image_format_for(save_path, 'PNG')
+    with atomic_output(save_path) as tmp_path:
+        with open(tmp_path, 'wb') as raw:
+            image.save(ProgressFile(raw, progress, cancel_event), format=image_format, **save_options_for(save_path, encoder_settings))
+        if cancel_event is not None and cancel_event.is_set(): raise SaveCancelled()
+    return save_path
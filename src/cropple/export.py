@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from . import core, encode
+
+# 同じ画像を複数のアスペクト比でまとめて書き出すエクスポートセット。
+# 読み込み・回転などの描画は1回だけで、余白用のぼかし素材は core.EdgeMaterialCache で比率間で共有する。
+# 比率ごとの拡張とエンコードはスレッドで並行して行う (Pillow の縮小・貼り付け・エンコードは GIL を解放する)。
+
+DEFAULT_EXPORT_PRESETS = ("1:1", "4:5", "16:9", "9:16", "1:1.91")
+
+
+def preset_suffix(preset_name):
+    # "16:9" -> "_16x9" (ファイル名に使えない ":" を置き換える)
+    return "_" + preset_name.replace(":", "x")
+
+
+def export_paths(base_path, preset_names):
+    # "out/photo.png" -> {"1:1": "out/photo_1x1.png", ...}
+    stem, ext = os.path.splitext(base_path)
+    return {name: f"{stem}{preset_suffix(name)}{ext}" for name in preset_names}
+
+
+def export_set(image, targets, blur_radius_val=core.DEFAULT_BLUR_RADIUS, position="center", encoder_settings=None,
+               workers=None, progress=None, cancel_event=None, fill_mode="blur"):
+    # targets: [(アスペクト比タプル, 保存先), ...]。progress には全ファイルの合計書き込みバイト数を渡す。
+    # 戻り値: 保存先のリスト (targets の順)
+    if not targets: return []
+    material_cache = core.EdgeMaterialCache(image, blur_radius_val, fill_mode)
+    for aspect_tuple, _ in targets: material_cache.reserve_extend(aspect_tuple, position)
+    material_cache.prepare()
+    lock = threading.Lock(); bytes_written = {}
+    def on_progress(save_path, n):
+        with lock: bytes_written[save_path] = n; total = sum(bytes_written.values())
+        if progress: progress(total)
+    def render_and_save(aspect_tuple, save_path):
+        if cancel_event is not None and cancel_event.is_set(): raise encode.SaveCancelled()
+        extended = core.extend_image(image, aspect_tuple, blur_radius_val, position, material_cache)
+        if extended is None: raise ValueError(f"拡張画像の生成に失敗しました: {save_path}")
+        return encode.save_image(extended, save_path, encoder_settings, lambda n: on_progress(save_path, n), cancel_event)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(targets)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_and_save, aspect_tuple, save_path) for aspect_tuple, save_path in targets]
+        return [future.result() for future in futures]
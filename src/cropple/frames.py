@@ -0,0 +1,90 @@
+from PIL import Image
+from collections import deque
+import os
+
+from . import core, edits, encode, timing
+
+# アニメーション GIF・複数ページ TIFF などの複数フレーム画像に、同じ操作列を全フレームへ適用して書き出す。
+# フレームは元ファイルから1枚ずつ読み (GIF は Pillow が前のフレームと合成・破棄処理した全体の絵になる)、
+# スレッドプールで並行して描画し、順番どおりにエンコーダへ渡す。先読みは workers * FRAME_WINDOW_PER_WORKER 枚まで。
+# GIF と TIFF はエンコーダがフレームを逐次受け取れるので、全フレームの描画結果を同時に持たない
+# (ただし GIF のエンコーダは差分を取るため、減色後の1画素1バイトのフレームを最後まで保持する)。
+# 各フレームは合成済みの全体の絵なので、GIF は破棄方法 2 (背景に戻す) で書き、表示時間とループ回数は元のものを引き継ぐ。
+
+ANIMATED_FORMATS = ("GIF", "TIFF", "WEBP", "PNG")
+STREAMED_FORMATS = ("GIF", "TIFF") # append_images をジェネレータのまま逐次エンコードできる形式
+FRAME_WINDOW_PER_WORKER = 2
+
+
+def is_animated(image):
+    return bool(getattr(image, 'is_animated', False)) or getattr(image, 'n_frames', 1) > 1
+
+
+def format_for(save_path):
+    return encode.image_format_for(save_path)
+
+
+def supports_frames(save_path):
+    return format_for(save_path) in ANIMATED_FORMATS
+
+
+def frame_mode(image):
+    # 全フレームで揃えるモード。GIF は途中のフレームから透過することがあるので、透過色があれば RGBA
+    image.seek(0)
+    mode = core.normalize_image_mode(image).mode
+    if 'A' not in mode and 'transparency' in image.info: mode = "LA" if mode == "L" else "RGBA"
+    return mode
+
+
+def iter_frames(image, mode, cancel_event=None):
+    # (フレーム, 表示時間[ms]) を先頭から順に返す。フレームは元ファイルから切り離したコピー
+    for index in range(getattr(image, 'n_frames', 1)):
+        if cancel_event is not None and cancel_event.is_set(): raise encode.SaveCancelled()
+        image.seek(index)
+        with timing.stage("decode", frame=index): frame = image.convert(mode)
+        yield frame, image.info.get('duration')
+
+
+def _map_ordered(func, items, workers, window):
+    # func(item) を並行して実行し、入力の順番どおりに結果を返す。実行中・完了待ちは window 件まで
+    from concurrent.futures import ThreadPoolExecutor # 複数フレームの画像を書き出すときだけ読み込む
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+
+
+def render_frames(image, ops, workers=None, cancel_event=None):
+    # ops (edits の操作列) を全フレームに適用した画像を順に返すジェネレータ。表示時間は info['duration'] に入れる
+    workers = max(1, workers or os.cpu_count() or 1)
+    def render(item):
+        frame, duration = item
+        rendered = edits.render_ops(frame, ops)
+        if duration is not None: rendered.info['duration'] = duration
+        return rendered
+    return _map_ordered(render, iter_frames(image, frame_mode(image), cancel_event), workers, workers * FRAME_WINDOW_PER_WORKER)
+
+
+@timing.timed("frames")
+def save_frames(image, ops, save_path, encoder_settings=None, progress=None, cancel_event=None, workers=None):
+    # 開いた複数フレーム画像 image の全フレームに ops を適用して save_path に保存する
+    image_format = format_for(save_path)
+    if image_format not in ANIMATED_FORMATS: raise ValueError(f"複数フレームを保存できない形式です: {save_path}")
+    rendered = render_frames(image, ops, workers, cancel_event)
+    first = next(rendered)
+    rest = rendered if image_format in STREAMED_FORMATS else list(rendered)
+    options = dict(encode.save_options_for(save_path, encoder_settings), save_all=True, append_images=rest, loop=image.info.get('loop', 0))
+    if image_format == "GIF": options['disposal'] = 2
+    # WebP・APNG はフレームごとの info を見ないので表示時間を一覧で渡す (この2形式は rest がリスト)
+    elif image_format in ("WEBP", "PNG"): options['duration'] = [frame.info.get('duration', 0) for frame in [first] + rest]
+    with encode.atomic_output(save_path) as tmp_path:
+        with open(tmp_path, 'w+b') as raw: # 複数ページの TIFF は書いた部分を読み戻して追記する
+            first.save(encode.ProgressFile(raw, progress, cancel_event), format=image_format, **options)
+        if cancel_event is not None and cancel_event.is_set(): raise encode.SaveCancelled()
+    return save_path
+
+
+def save_frames_from_path(src_path, ops, save_path, encoder_settings=None, progress=None, cancel_event=None, workers=None):
+    with Image.open(src_path) as image: return save_frames(image, ops, save_path, encoder_settings, progress, cancel_event, workers)
@@ -0,0 +1,25 @@
+from PIL import Image
+
+from . import core, timing
+
+# 画像の読み込み。Image.open はヘッダだけを読み、画素のデコードは最初に画素へ
+# アクセスしたときまで遅延される。表示用には JPEG の DCT スケーリング (Image.draft) で
+# 縮小デコードした画像を別に用意し、全解像度のデコードは切り抜き確定・回転・保存まで行わない。
+
+
+def open_image(path):
+    # 全解像度の画像を遅延デコードのまま返す。モード変換が必要な場合 (CMYK・GIF のパレットなど) はここでデコードされる。
+    # 変換した画像にも、元のファイルが複数フレームかどうか (is_animated) を引き継ぐ (frames.is_animated でファイルを開き直さずに判定できるように)
+    image = Image.open(path)
+    normalized = core.normalize_image_mode(image)
+    if normalized is not image: normalized.is_animated = bool(getattr(image, 'is_animated', False)) or getattr(image, 'n_frames', 1) > 1
+    return normalized
+
+
+def open_draft(path, max_size):
+    # max_size 以上で最小の縮小率 (1/2, 1/4, 1/8) でデコードした表示用画像。縮小デコードできない形式は None
+    image = Image.open(path)
+    if image.format != "JPEG": image.close(); return None
+    if not image.draft(None, max_size): image.close(); return None
+    with timing.stage("draft", size=list(image.size)): image.load()
+    return core.normalize_image_mode(image)
@@ -0,0 +1,96 @@
+from PIL import Image
+import os
+import shutil
+import subprocess
+
+from . import encode, timing
+
+# JPEG の 90° 単位の回転と切り抜きを、画素に戻さず DCT 係数のまま行う高速・無劣化の保存経路。
+# 変換は libjpeg / libjpeg-turbo に付属する jpegtran に任せる (見つからなければこの経路は使わない)。
+# 操作列が回転 (transpose) と切り抜き (crop) だけで、MCU (最小符号化単位) の境界に揃っている場合に限り、
+# それ以外は None を返して呼び出し側が通常の画素処理 (デコード -> 描画 -> 再エンコード) で保存する。
+
+JPEGTRAN_ENV = "CROPPLE_JPEGTRAN" # jpegtran のパスを明示する環境変数
+JPEGTRAN_TIMEOUT_SECONDS = 120
+LOSSLESS_OPS = ("transpose", "crop")
+ROTATE_ARGS = {1: "90", 2: "180", 3: "270"} # 時計回り90°の回数 -> jpegtran -rotate
+
+
+def find_jpegtran():
+    return os.environ.get(JPEGTRAN_ENV) or shutil.which("jpegtran")
+
+
+def mcu_size(image):
+    # JPEG の MCU の画素サイズ (4:2:0 なら 16x16)。JPEG 以外・可逆変換の対象外のモードは None
+    layers = getattr(image, 'layer', None)
+    if image.format != "JPEG" or image.mode not in ("L", "RGB") or not layers: return None
+    return 8 * max(layer[1] for layer in layers), 8 * max(layer[2] for layer in layers)
+
+
+def _rotate_box(box, frame_size, quarter_turns):
+    # frame_size の画像内の box を、画像ごと時計回りに quarter_turns 回回転した後の座標へ移す
+    for _ in range(quarter_turns % 4):
+        x0, y0, x1, y1 = box; frame_w, frame_h = frame_size
+        box = (frame_h - y1, x0, frame_h - y0, x1); frame_size = (frame_h, frame_w)
+    return box, frame_size
+
+
+def plan_transform(size, mcu, ops, snap=False):
+    # ops を「時計回りに quarter_turns 回回転 -> 回転後の座標で crop_box を切り抜き」の1回にまとめる。
+    # 戻り値: (quarter_turns, crop_box または None)。可逆にできない場合は None。
+    # snap=True なら切り抜きの左上を MCU の境界までずらす (切り抜きサイズは保つ)
+    if any(op[0] not in LOSSLESS_OPS for op in ops): return None
+    quarter_turns = 0; frame_size = tuple(size); box = (0, 0) + tuple(size)
+    for op in ops:
+        if op[0] == "transpose":
+            box, frame_size = _rotate_box(box, frame_size, op[1]); quarter_turns = (quarter_turns + op[1]) % 4
+        else:
+            x0, y0, x1, y1 = op[1]
+            box = (box[0] + x0, box[1] + y0, box[0] + x1, box[1] + y1)
+    # 右端・下端の半端な MCU は左端・上端へ回す変換ができない (回転後に左上へ来る辺は MCU の倍数が必要)
+    width, height = size; mcu_w, mcu_h = mcu
+    if quarter_turns in (1, 2) and height % mcu_h: return None
+    if quarter_turns in (2, 3) and width % mcu_w: return None
+    if box == (0, 0) + frame_size: return quarter_turns, None
+    grid_w, grid_h = (mcu_h, mcu_w) if quarter_turns % 2 else (mcu_w, mcu_h)
+    shift_x = box[0] % grid_w; shift_y = box[1] % grid_h
+    if (shift_x or shift_y) and not snap: return None
+    box = (box[0] - shift_x, box[1] - shift_y, box[2] - shift_x, box[3] - shift_y)
+    if box[0] < 0 or box[1] < 0 or box[2] > frame_size[0] or box[3] > frame_size[1] or box[0] >= box[2] or box[1] >= box[3]: return None
+    return quarter_turns, box
+
+
+def jpegtran_args(jpegtran, plan, encoder_settings=None):
+    # メタデータは画素経路 (encode.save_image) と同じく引き継がない。EXIF の向きが残ると二重に回転して表示されるため
+    quarter_turns, box = plan
+    encoder_settings = encode.encoder_settings_from(encoder_settings or {})
+    args = [jpegtran, "-copy", "none", "-perfect"]
+    if encoder_settings['jpeg_optimize']: args.append("-optimize")
+    if encoder_settings['jpeg_progressive']: args.append("-progressive")
+    if quarter_turns: args += ["-rotate", ROTATE_ARGS[quarter_turns]]
+    if box: args += ["-crop", f"{box[2] - box[0]}x{box[3] - box[1]}+{box[0]}+{box[1]}"]
+    return args
+
+
+def is_candidate(src_path, ops, save_path):
+    # ファイルを開かずに判定できる条件だけを見る (形式・保存先・操作の種類)
+    jpeg_exts = ('.jpg', '.jpeg')
+    return bool(src_path) and src_path.lower().endswith(jpeg_exts) and save_path.lower().endswith(jpeg_exts) and all(op[0] in LOSSLESS_OPS for op in ops)
+
+
+@timing.timed("lossless")
+def save_lossless(src_path, ops, save_path, encoder_settings=None, snap=False, jpegtran=None):
+    # 可逆に保存できたら save_path、できなければ None (保存先には何も残さない)
+    jpegtran = jpegtran or find_jpegtran()
+    if not jpegtran or not is_candidate(src_path, ops, save_path): return None
+    try:
+        with Image.open(src_path) as image: mcu = mcu_size(image); size = image.size
+    except OSError: return None
+    plan = plan_transform(size, mcu, ops, snap) if mcu else None
+    if plan is None: return None
+    try:
+        with encode.atomic_output(save_path) as tmp_path:
+            subprocess.run(jpegtran_args(jpegtran, plan, encoder_settings) + ["-outfile", tmp_path, src_path],
+                           check=True, capture_output=True, timeout=JPEGTRAN_TIMEOUT_SECONDS)
+    except (OSError, subprocess.SubprocessError): return None
+    return save_path
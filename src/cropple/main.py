@@ -1,41 +1,43 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, colorchooser
-from PIL import Image, ImageTk, ImageFilter
+from tkinter import filedialog, messagebox, ttk
+from PIL import Image, ImageTk
 import math
 import json
 import os
 import tkinterdnd2
 import re
+import threading
+import weakref
 
-try:
-    RESAMPLE_LANCZOS = Image.Resampling.LANCZOS
-    RESAMPLE_NEAREST = Image.Resampling.NEAREST
-    RESAMPLE_BICUBIC = Image.Resampling.BICUBIC
-    ROTATE_90 = Image.Transpose.ROTATE_90
-    ROTATE_270 = Image.Transpose.ROTATE_270
-except AttributeError: 
-    RESAMPLE_LANCZOS = Image.LANCZOS
-    RESAMPLE_NEAREST = Image.NEAREST
-    RESAMPLE_BICUBIC = Image.BICUBIC
-    ROTATE_90 = Image.ROTATE_90
-    ROTATE_270 = Image.ROTATE_270
+from . import buffers, core, encode, loader, timing
+from .display import DisplayCache, TileCache
+from .edits import EditStack
+from .core import RESAMPLE_NEAREST, ROTATE_90, ROTATE_270
+
+# 起動を速くするため、使う操作が限られるモジュール (色選択ダイアログ・一括書き出し・可逆変換・おすすめ範囲・複数フレームの保存・帯ごとの保存) は
+# その操作が初めて実行されたときに読み込み、保存中だけの進捗表示も初回の保存で、フィルムストリップも最初のセッションで作る。
 
 class CropApp:
     SETTINGS_FILE_NAME = ".cropple_settings.json"
-    DEFAULT_ASPECT_W = "16"
-    DEFAULT_ASPECT_H = "9"
-    DEFAULT_BLUR_RADIUS = 70
+    DEFAULT_ASPECT_W = core.DEFAULT_ASPECT_W
+    DEFAULT_ASPECT_H = core.DEFAULT_ASPECT_H
+    DEFAULT_BLUR_RADIUS = core.DEFAULT_BLUR_RADIUS
     WINDOW_SIZE_RATIO = 0.75
     MIN_WINDOW_WIDTH = 780 
     MIN_WINDOW_HEIGHT_CONTROLS = 320 
     MIN_CANVAS_HEIGHT = 200          
+    ROTATION_PREVIEW_POLL_MS = 15
+    REFINE_POLL_MS = 15
+    QUICK_PREVIEW_FACTOR = 4 # 仮の拡張プレビューは 1/4 の大きさで作って拡大する
+    SAVE_POLL_MS = 100
+    THUMBNAIL_POLL_MS = 50
+    FILMSTRIP_PAD = 4 # フィルムストリップのサムネイルの間隔
+    STATUS_POLL_MS = 250
+    ZOOM_STEP = 1.25 # マウスホイール1目盛りの拡大率
+    MAX_VIEW_SCALE = 8.0 # 最大の表示倍率 (表示上の画素 / 画像の画素)
+    EXTEND_MEMORY_BUDGET_MB = core.DEFAULT_MEMORY_BUDGET_MB # 拡張後の画像がこれを超える場合は帯ごとに書き出す
 
-    ASPECT_PRESETS = {
-        "オリジナル": "original", "1:1": (1, 1), "カスタム": "custom", "自由選択": "free",
-        "16:9": (16, 9), "9:16": (9, 16), "4:3": (4, 3), "3:4": (3, 4), 
-        "3:2": (3, 2), "2:3": (2, 3), "5:4": (5, 4),"4:5": (4, 5), 
-         "1:1.91": (100, 191)
-    }
+    ASPECT_PRESETS = core.ASPECT_PRESETS
     PRESET_ORDER_ROW1 = ["オリジナル", "1:1", "16:9", "9:16", "4:3", "3:4"]
     PRESET_ORDER_ROW2 = ["3:2", "2:3", "5:4", "4:5", "1:1.91", "カスタム", "自由選択"]
 
@@ -48,20 +50,58 @@ class CropApp:
 
         self.settings_file_path = os.path.join(os.path.expanduser("~"), self.SETTINGS_FILE_NAME)
         self.image_path = None
-        self.original_pil_image = None
+        self._source_animated = False # 元ファイルが複数フレーム (アニメーション GIF・複数ページ TIFF) か
+        self.buffer_pool = buffers.BufferPool() # 元画像と編集の途中結果。上限を超えた古いものは一時ファイルへ退避する
+        self._draft_image = None # 表示用の縮小デコード (JPEG のみ)。元画像の全解像度デコードは必要になるまで遅延
         self.processed_pil_image = None
+        self.edit_stack = None # 元画像に対する非破壊の操作履歴。processed_pil_image はその描画結果
         self.active_pil_for_canvas = None
         self.display_pil_image = None
         self.tk_image = None
+        self.display_cache = DisplayCache() # (画像, 表示サイズ) -> 縮小画像と PhotoImage
+        self._displayed_entry = None # キャンバスに表示中の display_cache のエントリ
+        # 拡大表示: view_scale が None なら全体表示 (image_on_canvas)、それ以外はその倍率のタイルを見えている分だけ置く
+        self.tile_cache = TileCache(self.display_cache)
+        self.view_scale = None
+        self._view_size = (0, 0) # キャンバス座標での表示中の画像の大きさ (選択枠の座標はこの座標系)
+        self._tile_items = {} # (tx, ty) -> (キャンバスの id, タイルのエントリ)
         self.image_on_canvas = None 
         self.rect = None 
+        self._suggested_crop = None # (選択枠の id, 原寸での切り抜き範囲)。おすすめ範囲の枠が残っている間は原寸の座標をそのまま使う
         self.start_x = None
         self.start_y = None
         self._processing_aspect_change = False
+        self._preview_proxy_cache = None # (weakref(元画像), 縮小率, 縮小画像)
+        # 自由回転ライブプレビュー (ワーカースレッドとは lock 越しに最新の要求/結果を1件ずつ受け渡す)
+        self._rotation_preview_lock = threading.Lock()
+        self._rotation_preview_request = None
+        self._rotation_preview_result = None
+        self._rotation_preview_busy = False
+        self._rotation_preview_generation = 0
+        # 段階的な描画: 表示・タイル・拡張プレビューはまず安い方法 (NEAREST, 縮小して拡張) で描き、本来の画質のものを
+        # ワーカースレッドで作って差し替える。要求は種類 (表示の高画質化 / 拡張プレビュー) ごとに最新の1件だけを持ち、
+        # 新しい表示や同じ種類の新しい要求で世代が進んだ結果は捨てる
+        self._refine_lock = threading.Lock()
+        self._refine_requests = {} # 種類 -> (世代, render, apply) (未着手のもの)
+        self._refine_results = []
+        self._refine_busy = False
+        self._refine_generations = {} # 種類 -> 世代
+        self._save_thread = None # バックグラウンド保存 (ワーカーとは _save_state 辞書で受け渡す)
+        self._save_state = None
+        self._save_cancel_event = None
+        self._export_preset_names = None # 一括書き出しで前回選んだ比率 (None なら export.DEFAULT_EXPORT_PRESETS)
+        # 複数画像のセッション (session.Session)。フィルムストリップは最初のセッションで _build_filmstrip が作る
+        self.session = None
+        self.filmstrip_frame = None
+        self._thumbnail_photos = {} # セッション内の番号 -> サムネイルの PhotoImage
+        self._pending_thumbnails = {} # セッション内の番号 -> 作成中のサムネイルの Future
+        self._filmstrip_generation = 0
+        self._status_operation_count = 0 # ステータスバーに表示中の timing.last_operation の通し番号
         self.rotation_angle_var = tk.DoubleVar(value=0)
         self.rotation_fill_color_var = tk.StringVar(value="#CCCCCC")
         self.rotation_fill_mode_var = tk.StringVar(value="color") 
         self.extend_position_var = tk.StringVar(value="center")
+        self.extend_fill_var = tk.StringVar(value="blur")
 
 
         self.top_controls_area = ttk.Frame(master)
@@ -118,6 +158,15 @@ class CropApp:
         self.blur_radius_label.pack(side=tk.LEFT, padx=(0,5), pady=5)
         self.blur_radius_var.trace_add("write", lambda *args: self.blur_radius_label.config(text=str(self.blur_radius_var.get())))
 
+        # 余白の埋め方 (ぼかし以外は軽い処理で、ぼかし半径は使わない)
+        fill_controls_subframe = ttk.Frame(self.blur_frame)
+        fill_controls_subframe.pack(anchor='w')
+        ttk.Label(fill_controls_subframe, text="余白:").pack(side=tk.LEFT, padx=(5, 5), pady=(0,5))
+        self.extend_fill_radios = []
+        for fill_mode, label in (("blur", "ぼかし"), ("mirror", "折り返し"), ("stretch", "端を延長"), ("mean", "平均色")):
+            radio = ttk.Radiobutton(fill_controls_subframe, text=label, variable=self.extend_fill_var, value=fill_mode, command=self._on_extend_fill_change)
+            radio.pack(side=tk.LEFT, pady=(0,5)); self.extend_fill_radios.append(radio)
+
         # 画像配置コントロール用のサブフレーム
         position_controls_subframe = ttk.Frame(self.blur_frame)
         position_controls_subframe.pack(anchor='w')
@@ -176,6 +225,29 @@ class CropApp:
         self.rotation_fill_color_entry = ttk.Entry(self.fill_color_subframe, textvariable=self.rotation_fill_color_var, width=9)
         self.rotation_fill_color_entry.pack(side=tk.LEFT, padx=2)
         self.rotation_fill_color_var.trace_add("write", self._update_rotation_fill_preview)
+
+        self.encode_frame = ttk.LabelFrame(group2_frame, text="保存設定")
+        self.encode_frame.pack(side=tk.LEFT, padx=5, pady=5, fill=tk.Y, anchor='nw')
+        self.png_compress_level_var = tk.IntVar(value=encode.ENCODER_DEFAULTS['png_compress_level'])
+        self.jpeg_quality_var = tk.IntVar(value=encode.ENCODER_DEFAULTS['jpeg_quality'])
+        self.jpeg_optimize_var = tk.BooleanVar(value=encode.ENCODER_DEFAULTS['jpeg_optimize'])
+        self.jpeg_progressive_var = tk.BooleanVar(value=encode.ENCODER_DEFAULTS['jpeg_progressive'])
+        self.jpeg_lossless_var = tk.BooleanVar(value=encode.ENCODER_DEFAULTS['jpeg_lossless'])
+        self.webp_method_var = tk.IntVar(value=encode.ENCODER_DEFAULTS['webp_method'])
+        png_webp_subframe = ttk.Frame(self.encode_frame)
+        png_webp_subframe.pack(anchor='w')
+        ttk.Label(png_webp_subframe, text="PNG圧縮:").pack(side=tk.LEFT, padx=(5,2), pady=2)
+        ttk.Spinbox(png_webp_subframe, from_=0, to=9, textvariable=self.png_compress_level_var, width=3).pack(side=tk.LEFT, padx=(0,10), pady=2)
+        ttk.Label(png_webp_subframe, text="WebP方式:").pack(side=tk.LEFT, padx=(0,2), pady=2)
+        ttk.Spinbox(png_webp_subframe, from_=0, to=6, textvariable=self.webp_method_var, width=3).pack(side=tk.LEFT, padx=(0,5), pady=2)
+        jpeg_subframe = ttk.Frame(self.encode_frame)
+        jpeg_subframe.pack(anchor='w')
+        ttk.Label(jpeg_subframe, text="JPEG品質:").pack(side=tk.LEFT, padx=(5,2), pady=2)
+        ttk.Spinbox(jpeg_subframe, from_=1, to=100, textvariable=self.jpeg_quality_var, width=4).pack(side=tk.LEFT, padx=(0,5), pady=2)
+        ttk.Checkbutton(jpeg_subframe, text="最適化", variable=self.jpeg_optimize_var).pack(side=tk.LEFT, padx=2, pady=2)
+        ttk.Checkbutton(jpeg_subframe, text="プログレッシブ", variable=self.jpeg_progressive_var).pack(side=tk.LEFT, padx=(2,5), pady=2)
+        # JPEG を JPEG で保存し、操作が90°回転と切り抜きだけなら jpegtran で再エンコードせずに保存する
+        ttk.Checkbutton(self.encode_frame, text="JPEGの回転・切り抜きは再エンコードしない", variable=self.jpeg_lossless_var).pack(anchor='w', padx=5, pady=(0,2))
         
         self.settings_preview_buttons_frame = ttk.Frame(self.top_controls_area)
         self.settings_preview_buttons_frame.pack(pady=(5,0), fill="x")
@@ -185,6 +257,8 @@ class CropApp:
         self.default_settings_button.pack(side=tk.LEFT, padx=5, pady=2)
         self.update_preview_button = ttk.Button(self.settings_preview_buttons_frame, text="拡張プレビュー更新", command=self.update_preview_action, state=tk.DISABLED)
         self.update_preview_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.smart_crop_button = ttk.Button(self.settings_preview_buttons_frame, text="おすすめ範囲を選択", command=self.smart_crop_action, state=tk.DISABLED)
+        self.smart_crop_button.pack(side=tk.LEFT, padx=5, pady=2)
         
         self.separator_after_settings = ttk.Separator(self.top_controls_area, orient=tk.HORIZONTAL)
         self.separator_after_settings.pack(fill='x', pady=5)
@@ -197,6 +271,24 @@ class CropApp:
         self.reset_image_button.pack(side=tk.LEFT, padx=5, pady=2)
         self.execute_button = ttk.Button(self.file_reset_buttons_frame, text="実行して画像を保存", command=self.execute_action)
         self.execute_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.export_set_button = ttk.Button(self.file_reset_buttons_frame, text="複数比率で書き出し", command=self.export_set_action)
+        self.export_set_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.undo_button = ttk.Button(self.file_reset_buttons_frame, text="元に戻す", command=self.undo_edit, state=tk.DISABLED)
+        self.undo_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.redo_button = ttk.Button(self.file_reset_buttons_frame, text="やり直し", command=self.redo_edit, state=tk.DISABLED)
+        self.redo_button.pack(side=tk.LEFT, padx=5, pady=2)
+        # 保存中だけ表示する進捗表示 (初回の保存で _build_save_progress_frame が作る)
+        self.save_progress_frame = None
+        master.bind("<Control-z>", lambda e: self.undo_edit())
+        master.bind("<Control-y>", lambda e: self.redo_edit())
+
+        # 直近の操作の段階別の所要時間 (ワーカースレッドの操作も含め _poll_status が拾う)
+        self.status_frame = ttk.Frame(master)
+        self.status_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0,5))
+        self.status_label = ttk.Label(self.status_frame, text="", anchor='w')
+        self.status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.export_trace_button = ttk.Button(self.status_frame, text="トレース保存", command=self.export_trace)
+        self.export_trace_button.pack(side=tk.RIGHT)
 
         self.canvas_frame = ttk.Frame(master)
         self.canvas_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=(0,10))
@@ -206,21 +298,141 @@ class CropApp:
         self.canvas.dnd_bind('<<Drop>>', self.handle_drop)
         self.canvas.bind("<ButtonPress-1>", self.on_button_press)
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
+        # ホイールで拡大・縮小、右 (中) ボタンのドラッグで移動、Ctrl+0 で全体表示
+        self.canvas.bind("<MouseWheel>", lambda e: self.zoom_view(self.ZOOM_STEP if e.delta > 0 else 1 / self.ZOOM_STEP, (e.x, e.y)))
+        self.canvas.bind("<Button-4>", lambda e: self.zoom_view(self.ZOOM_STEP, (e.x, e.y)))
+        self.canvas.bind("<Button-5>", lambda e: self.zoom_view(1 / self.ZOOM_STEP, (e.x, e.y)))
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", lambda e: self.canvas.scan_mark(e.x, e.y))
+            self.canvas.bind(f"<B{button}-Motion>", self.on_pan_drag)
+        self.canvas.bind("<Configure>", lambda e: self._update_tiles())
+        master.bind("<Control-0>", lambda e: self.zoom_view(0))
 
         self.load_settings()
-        self._display_image_on_canvas() 
+        # 画像がないうちは最初の描画の前にレイアウトを確定させない (ウィンドウの大きさは main で決める)
+        self.canvas.config(width=max(100, self.MIN_WINDOW_WIDTH - 40), height=self.MIN_CANVAS_HEIGHT)
         self.on_mode_change()
         self.on_aspect_choice_change()
         self._update_rotation_fill_preview()
         self._on_rotation_fill_mode_change()
+        self.master.after(self.STATUS_POLL_MS, self._poll_status)
+
+    def _poll_status(self):
+        operation = timing.last_operation()
+        if operation and operation[0] != self._status_operation_count:
+            self._status_operation_count = operation[0]; self.status_label.config(text=timing.format_operation(operation))
+        self.master.after(self.STATUS_POLL_MS, self._poll_status)
+
+    def export_trace(self):
+        path = filedialog.asksaveasfilename(title="トレースを保存", defaultextension=".json", filetypes=[("Chrome trace (JSON)", "*.json"), ("All files", "*.*")])
+        if not path: return
+        try: count = timing.export_chrome_trace(path)
+        except OSError as e: messagebox.showerror("エラー", f"トレースを保存できませんでした: {e}"); return
+        messagebox.showinfo("トレース保存", f"{count} 区間を保存しました (chrome://tracing や Perfetto で開けます): {path}")
 
     def _update_rotation_label(self, *args):
         self.rotation_label.config(text=f"{self.rotation_angle_var.get():.1f}°")
 
     def on_rotation_slider_change_preview(self, value_str):
-        pass
+        if not self.processed_pil_image or not self.display_pil_image or not self.image_on_canvas: return
+        try: angle = float(value_str)
+        except ValueError: return
+        if self.rect: self.canvas.delete(self.rect); self.rect = None
+        if self.view_scale is not None: self._show_fit_view() # 回転プレビューは全体表示の画像に描く
+        self._cancel_refinements() # 回転プレビューの上に高画質化した表示を重ねない
+        source = self.processed_pil_image
+        max_size = self.display_pil_image.size
+        request = (self._rotation_preview_generation, source, core.fit_scale(source.size, max_size), angle,
+                   self.rotation_fill_mode_var.get(), self.rotation_fill_color_var.get(), max_size)
+        with self._rotation_preview_lock:
+            # 未処理の要求は最新の角度で上書きする (途中の角度は描画しない)
+            self._rotation_preview_request = request
+            if self._rotation_preview_busy: return
+            self._rotation_preview_busy = True
+        threading.Thread(target=self._rotation_preview_worker, daemon=True).start()
+        self.master.after(self.ROTATION_PREVIEW_POLL_MS, self._poll_rotation_preview)
+
+    def _rotation_preview_worker(self):
+        # Tk には触れない。結果は _poll_rotation_preview がメインスレッドで受け取る
+        while True:
+            with self._rotation_preview_lock:
+                request = self._rotation_preview_request; self._rotation_preview_request = None
+                if request is None: self._rotation_preview_busy = False; return
+            generation, source, scale, angle, fill_mode, fill_color_hex, max_size = request
+            # ドラッグ中は NEAREST で即座に描き、次の要求が無ければ同じ角度を BILINEAR で描き直す
+            for resample in (RESAMPLE_NEAREST, core.RESAMPLE_BILINEAR):
+                try: frame = core.render_rotation_preview(self._get_preview_proxy(source, scale), angle, fill_mode, fill_color_hex, max_size, resample)
+                except Exception: frame = None
+                with self._rotation_preview_lock:
+                    self._rotation_preview_result = (generation, frame)
+                    if self._rotation_preview_request is not None: break
+
+    def _poll_rotation_preview(self):
+        with self._rotation_preview_lock:
+            result = self._rotation_preview_result; self._rotation_preview_result = None
+            busy = self._rotation_preview_busy
+        if result:
+            generation, frame = result
+            if frame is not None and generation == self._rotation_preview_generation: self._show_rotation_preview(frame)
+        if busy: self.master.after(self.ROTATION_PREVIEW_POLL_MS, self._poll_rotation_preview)
+
+    def _start_refinement(self, name, render, apply):
+        # render() をワーカースレッドで実行し、結果を apply(result) でメインスレッドに渡す (どちらも Tk 以外の状態だけを読む)。
+        # 同じ種類の未着手の要求は置き換え、実行中の要求の結果は世代が変わっていれば捨てる
+        generation = self._refine_generations[name] = self._refine_generations.get(name, 0) + 1
+        with self._refine_lock:
+            self._refine_requests[name] = (generation, render, apply)
+            if self._refine_busy: return
+            self._refine_busy = True
+        threading.Thread(target=self._refine_worker, daemon=True).start()
+        self.master.after(self.REFINE_POLL_MS, self._poll_refinement)
+
+    def _cancel_refinements(self):
+        for name in self._refine_generations: self._refine_generations[name] += 1
+
+    def _refine_worker(self):
+        while True:
+            with self._refine_lock:
+                if not self._refine_requests: self._refine_busy = False; return
+                name = next(iter(self._refine_requests)); generation, render, apply = self._refine_requests.pop(name)
+            if generation != self._refine_generations.get(name): continue
+            try:
+                with timing.stage(name): result = render()
+            except Exception: continue
+            with self._refine_lock: self._refine_results.append((name, generation, apply, result))
+
+    def _poll_refinement(self):
+        with self._refine_lock:
+            results = self._refine_results; self._refine_results = []
+            busy = self._refine_busy
+        for name, generation, apply, result in results:
+            if generation == self._refine_generations.get(name): apply(result)
+        if busy: self.master.after(self.REFINE_POLL_MS, self._poll_refinement)
+
+    def _refine_quick_entries(self):
+        # 仮のエントリ (全体表示の画像と見えているタイル) を本来の画質で作り直して差し替える
+        quick = [entry for entry in [self._displayed_entry] + [entry for _, entry in self._tile_items.values()] if entry is not None and entry.refine]
+        if quick: self._start_refinement("refine", lambda: [(entry, entry.refine()) for entry in quick], self._replace_refined_entries)
+
+    def _replace_refined_entries(self, pairs):
+        for quick, refined in pairs:
+            if refined.photo is None: refined.photo = ImageTk.PhotoImage(refined.image)
+            if quick is self._displayed_entry:
+                self._displayed_entry = refined; self.display_pil_image = refined.image; self.tk_image = refined.photo
+                if self.image_on_canvas: self.canvas.itemconfig(self.image_on_canvas, image=self.tk_image)
+            for key, (item, entry) in list(self._tile_items.items()):
+                if entry is quick: self.canvas.itemconfig(item, image=refined.photo); self._tile_items[key] = (item, refined)
+
+    def _show_rotation_preview(self, frame):
+        # キャンバスの大きさは変えず、表示中の画像の位置に中央揃えで差し替える
+        if not self.image_on_canvas or not self.display_pil_image: return
+        self.tk_image = ImageTk.PhotoImage(frame)
+        offset_x = (self.display_pil_image.width - frame.width) // 2; offset_y = (self.display_pil_image.height - frame.height) // 2
+        self.canvas.itemconfig(self.image_on_canvas, image=self.tk_image)
+        self.canvas.coords(self.image_on_canvas, offset_x, offset_y)
 
     def choose_rotation_fill_color(self):
+        from tkinter import colorchooser
         color_code = colorchooser.askcolor(title="回転時の背景色を選択", initialcolor=self.rotation_fill_color_var.get())
         if color_code and color_code[1]:
             self.rotation_fill_color_var.set(color_code[1])
@@ -245,62 +457,70 @@ class CropApp:
                  self.transparent_note_label.pack_forget() # それ以外は非表示
         self._update_rotation_fill_preview() 
 
-    def apply_rotation_transpose(self, transpose_mode):
-        if not self.processed_pil_image: return
-        self.processed_pil_image = self.processed_pil_image.transpose(transpose_mode)
-        self.rotation_angle_var.set(0) 
+    @timing.timed("render")
+    def _render_edit_stack(self):
+        # 操作履歴を元画像から描き直して表示する (途中結果は edit_stack のキャッシュから再利用)
+        try: self.processed_pil_image = self.edit_stack.render()
+        except Exception as e: messagebox.showerror("処理エラー", f"画像の再描画中にエラー: {e}"); return False
+        self.rotation_angle_var.set(0)
         self.active_pil_for_canvas = self.processed_pil_image
+        self.buffer_pool.hold(self.processed_pil_image) # 前に表示していた画像は手放したので、上限を超えていれば退避できる
+        if self.rect: self.canvas.delete(self.rect); self.rect = None
         self._display_image_on_canvas()
+        self._update_undo_redo_buttons()
         if self.aspect_choice_var.get() == "オリジナル": self.on_aspect_choice_change()
+        return True
+
+    def _apply_edit(self, op):
+        if not self.edit_stack: return False
+        self.edit_stack.push(op)
+        if self._render_edit_stack(): return True
+        self.edit_stack.undo(); self._update_undo_redo_buttons()
+        return False
+
+    def _update_undo_redo_buttons(self):
+        self.undo_button.config(state=tk.NORMAL if self.edit_stack and self.edit_stack.can_undo() else tk.DISABLED)
+        self.redo_button.config(state=tk.NORMAL if self.edit_stack and self.edit_stack.can_redo() else tk.DISABLED)
+
+    def undo_edit(self):
+        if self.edit_stack and self.edit_stack.undo(): self._render_edit_stack()
+
+    def redo_edit(self):
+        if self.edit_stack and self.edit_stack.redo(): self._render_edit_stack()
+
+    def apply_rotation_transpose(self, transpose_mode):
+        if not self.processed_pil_image: return
+        quarter_turns = 1 if transpose_mode == ROTATE_270 else 3 # ROTATE_270 は時計回り90°
+        self._apply_edit(("transpose", quarter_turns))
 
     def apply_free_rotation(self):
         if not self.processed_pil_image: return
         angle_to_apply = self.rotation_angle_var.get()
         if abs(angle_to_apply) < 0.1: return
         
-        image_to_rotate = self.processed_pil_image 
-        fill_color_tuple = None
-
-        if self.rotation_fill_mode_var.get() == "transparent":
-            if image_to_rotate.mode != 'RGBA':
-                image_to_rotate = image_to_rotate.convert('RGBA')
-            fill_color_tuple = (0,0,0,0) 
-        else: # "color"
-            fill_color_hex = self.rotation_fill_color_var.get()
-            try:
-                r,g,b = tuple(int(fill_color_hex.lstrip('#')[i:i+2],16) for i in (0,2,4))
-                fill_color_tuple = (r,g,b,255) if image_to_rotate.mode == 'RGBA' or image_to_rotate.mode == 'LA' else (r,g,b) # LAモードも考慮
+        fill_mode = self.rotation_fill_mode_var.get()
+        fill_color_hex = self.rotation_fill_color_var.get()
+        if fill_mode == "color":
+            try: core.parse_hex_color(fill_color_hex)
             except ValueError:
                 messagebox.showerror("色指定エラー", "背景色のHEXコードが無効です。デフォルトのグレーを使用します。")
-                fill_color_tuple = (200,200,200,255) if image_to_rotate.mode == 'RGBA' or image_to_rotate.mode == 'LA' else (200,200,200)
-        
-        try:
-            # rotate前に image_to_rotate を self.processed_pil_image に代入しないように注意
-            rotated_image = image_to_rotate.rotate(
-                -angle_to_apply, resample=RESAMPLE_BICUBIC, expand=True, fillcolor=fill_color_tuple
-            )
-            # 回転後の画像を processed_pil_image に設定
-            self.processed_pil_image = rotated_image
-
-        except Exception as e: messagebox.showerror("回転エラー", f"自由回転処理中にエラー: {e}"); return
-        
-        self.rotation_angle_var.set(0)
-        self.active_pil_for_canvas = self.processed_pil_image
-        self._display_image_on_canvas()
-        if self.aspect_choice_var.get() == "オリジナル": self.on_aspect_choice_change()
+                fill_color_hex = "#%02x%02x%02x" % core.FALLBACK_FILL_RGB
+
+        # 直前の自由回転とは1回の回転にまとめられ、元画像から補間し直す
+        self._apply_edit(("rotate", angle_to_apply, fill_mode, fill_color_hex))
 
     def reset_all_rotation(self): 
-        if not self.original_pil_image: return
-        self.processed_pil_image = self.original_pil_image.copy()
-        self.rotation_angle_var.set(0)
-        self.active_pil_for_canvas = self.processed_pil_image
-        self._display_image_on_canvas()
-        if self.aspect_choice_var.get() == "オリジナル": self.on_aspect_choice_change()
+        if not self.edit_stack: return
+        self.edit_stack.clear() # 「元に戻す」で取り消せる
+        self._render_edit_stack()
 
     def reset_image_processing(self):
-        if not self.original_pil_image: messagebox.showwarning("リセット不可", "画像が読み込まれていません。"); return
-        self.processed_pil_image = self.original_pil_image.copy()
+        if not self.edit_stack: messagebox.showwarning("リセット不可", "画像が読み込まれていません。"); return
+        self.edit_stack.clear()
+        self.processed_pil_image = self.edit_stack.render()
         self.active_pil_for_canvas = self.processed_pil_image
+        self.buffer_pool.hold(self.processed_pil_image)
+        self._update_undo_redo_buttons()
         self.rotation_angle_var.set(0)
         if self.rect: self.canvas.delete(self.rect); self.rect = None
         self._display_image_on_canvas()
@@ -320,48 +540,153 @@ class CropApp:
         cleaned_paths = []
         for p in raw_paths:
             p_cleaned = p.strip('"').strip("'")
-            if os.path.exists(p_cleaned) and os.path.isfile(p_cleaned): cleaned_paths.append(p_cleaned)
+            if os.path.exists(p_cleaned): cleaned_paths.append(p_cleaned)
         if cleaned_paths:
-            for path_to_load in cleaned_paths:
-                if path_to_load.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    self.load_image(path_to_load); return 
+            if self.open_images(cleaned_paths): return
             messagebox.showwarning("ドロップエラー", "ドロップされた有効な画像ファイルが見つかりませんでした。")
         else: messagebox.showwarning("ドロップエラー", f"ドロップされたファイルパスを解析できませんでした。\nData: '{filepaths_str}'")
 
     def load_image_dialog(self):
-        path = filedialog.askopenfilename(filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp *.gif"), ("All files", "*.*")])
-        if path: self.load_image(path)
+        paths = filedialog.askopenfilenames(filetypes=[("Image files", " ".join("*" + ext for ext in core.IMAGE_EXTENSIONS)), ("All files", "*.*")])
+        if paths and not self.open_images(self.master.tk.splitlist(paths)): messagebox.showwarning("読み込みエラー", "選択されたファイルに対応する画像がありません。")
+
+    def open_images(self, paths):
+        # 画像1枚ならそのまま開き、複数の画像やフォルダならセッションにしてフィルムストリップを出す。開ける画像がなければ False
+        from . import session
+        image_paths = session.expand_paths(paths)
+        if not image_paths: return False
+        self._close_session()
+        if len(image_paths) == 1 and not os.path.isdir(paths[0]): self.load_image(image_paths[0]); return True
+        self.session = session.Session(image_paths, self._get_canvas_max_size())
+        if self.filmstrip_frame is None: self._build_filmstrip()
+        self._populate_filmstrip()
+        self.filmstrip_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0,5), before=self.canvas_frame)
+        self.show_session_image(0)
+        return True
 
-    def load_image(self, path):
+    def _close_session(self):
+        if self.session is None: return
+        self.session.close(); self.session = None
+        self._filmstrip_generation += 1; self._pending_thumbnails = {}; self._thumbnail_photos = {}
+        self.filmstrip_canvas.delete("all"); self.filmstrip_frame.pack_forget()
+        self.master.unbind("<Prior>"); self.master.unbind("<Next>")
+
+    def _build_filmstrip(self):
+        self.filmstrip_frame = ttk.Frame(self.master)
+        nav_frame = ttk.Frame(self.filmstrip_frame)
+        nav_frame.pack(fill=tk.X)
+        self.prev_image_button = ttk.Button(nav_frame, text="◀ 前の画像", command=lambda: self.step_session(-1))
+        self.prev_image_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.next_image_button = ttk.Button(nav_frame, text="次の画像 ▶", command=lambda: self.step_session(1))
+        self.next_image_button.pack(side=tk.LEFT, padx=5, pady=2)
+        self.session_label = ttk.Label(nav_frame, text="", anchor='w')
+        self.session_label.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.filmstrip_canvas = tk.Canvas(self.filmstrip_frame, height=self.session.thumbnail_size + 2 * self.FILMSTRIP_PAD, bg="grey30", highlightthickness=0)
+        self.filmstrip_canvas.pack(fill=tk.X)
+        filmstrip_scrollbar = ttk.Scrollbar(self.filmstrip_frame, orient=tk.HORIZONTAL, command=self.filmstrip_canvas.xview)
+        filmstrip_scrollbar.pack(fill=tk.X)
+        self.filmstrip_canvas.config(xscrollcommand=filmstrip_scrollbar.set)
+        self.filmstrip_canvas.bind("<ButtonPress-1>", self._on_filmstrip_click)
+
+    def _filmstrip_cell_width(self):
+        return self.session.thumbnail_size + self.FILMSTRIP_PAD
+
+    def _populate_filmstrip(self):
+        # 枠だけ先に並べ、サムネイルはできたものから _poll_thumbnails が置く
+        canvas = self.filmstrip_canvas; cell = self._filmstrip_cell_width(); size = self.session.thumbnail_size; pad = self.FILMSTRIP_PAD
+        canvas.delete("all")
+        for index in range(len(self.session)): canvas.create_rectangle(index * cell + pad, pad, index * cell + pad + size, pad + size, outline="grey45")
+        canvas.create_rectangle(0, 0, 0, 0, outline="orange", width=2, tags="selection")
+        canvas.config(scrollregion=(0, 0, len(self.session) * cell + pad, size + 2 * pad))
+        self._filmstrip_generation += 1; self._thumbnail_photos = {}
+        self._pending_thumbnails = dict(enumerate(self.session.thumbnails))
+        self.master.bind("<Prior>", lambda e: self.step_session(-1)); self.master.bind("<Next>", lambda e: self.step_session(1))
+        self.master.after(self.THUMBNAIL_POLL_MS, self._poll_thumbnails, self._filmstrip_generation)
+
+    def _poll_thumbnails(self, generation):
+        # できたサムネイルを PhotoImage にして置く (セッションが替わったら止める)
+        if generation != self._filmstrip_generation: return
+        cell = self._filmstrip_cell_width(); size = self.session.thumbnail_size; pad = self.FILMSTRIP_PAD
+        for index, future in list(self._pending_thumbnails.items()):
+            if not future.done(): continue
+            del self._pending_thumbnails[index]
+            try: thumbnail = future.result()
+            except Exception: continue # 開けない画像は枠だけ残す
+            photo = self._thumbnail_photos[index] = ImageTk.PhotoImage(thumbnail)
+            self.filmstrip_canvas.create_image(index * cell + pad + size // 2, pad + size // 2, image=photo)
+        self.filmstrip_canvas.tag_raise("selection")
+        if self._pending_thumbnails: self.master.after(self.THUMBNAIL_POLL_MS, self._poll_thumbnails, generation)
+
+    def _update_filmstrip(self):
+        index = self.session.index; count = len(self.session); cell = self._filmstrip_cell_width(); pad = self.FILMSTRIP_PAD; size = self.session.thumbnail_size
+        self.filmstrip_canvas.coords("selection", index * cell + pad - 2, pad - 2, index * cell + pad + size + 2, pad + size + 2)
+        self.session_label.config(text=f"{index + 1} / {count}  {os.path.basename(self.session.current_path)}")
+        self.prev_image_button.config(state=tk.NORMAL if index > 0 else tk.DISABLED)
+        self.next_image_button.config(state=tk.NORMAL if index < count - 1 else tk.DISABLED)
+        # 選択中のサムネイルが見えるようにスクロールする
+        left, right = self.filmstrip_canvas.xview(); total = count * cell + pad
+        if index * cell / total < left or (index + 1) * cell / total > right: self.filmstrip_canvas.xview_moveto(max(0.0, (index + 0.5) * cell / total - (right - left) / 2))
+
+    def _on_filmstrip_click(self, event):
+        index = int(self.filmstrip_canvas.canvasx(event.x) // self._filmstrip_cell_width())
+        if self.session is not None and index != self.session.index: self.show_session_image(index)
+
+    def step_session(self, step):
+        if self.session is not None: self.show_session_image(self.session.index + step)
+
+    def show_session_image(self, index):
+        # セッションの index 番目の画像に移る。今の画像の操作列は覚えておき、移った先で覚えていた操作列を描き直す (設定はそのまま)
+        session = self.session
+        if session is None or not 0 <= index < len(session): return
+        if self.edit_stack and self.image_path == session.current_path: session.remember_ops(self.image_path, self.edit_stack.ops)
+        prefetched = session.select(index)
+        self.load_image(session.current_path, prefetched)
+        ops = session.ops_for(session.current_path)
+        if ops and self.edit_stack and self.image_path == session.current_path:
+            self.edit_stack.replace(ops); self._update_undo_redo_buttons(); self._render_edit_stack()
+        self._update_filmstrip()
+
+    @timing.timed("load")
+    def load_image(self, path, prefetched=None):
+        # prefetched (session.Prefetched) があれば、先読みしたデコード済みの画像と表示用の縮小を使う
         if not path: return
         try:
-            self.original_pil_image = Image.open(path)
-            if self.original_pil_image.mode not in ['RGB', 'L', 'RGBA', 'LA']: self.original_pil_image = self.original_pil_image.convert('RGB')
-            elif self.original_pil_image.mode == 'P': self.original_pil_image = self.original_pil_image.convert('RGBA' if 'transparency' in self.original_pil_image.info else 'RGB')
-            self.processed_pil_image = self.original_pil_image.copy()
+            if self.edit_stack: self.edit_stack.close(); self.edit_stack = None
+            original = prefetched.image if prefetched is not None and prefetched.image is not None else loader.open_image(path)
+            self._draft_image = prefetched.draft if prefetched is not None else loader.open_draft(path, self._get_canvas_max_size())
+            if self._draft_image is None:
+                with timing.stage("decode"): original.load()
+            self.edit_stack = EditStack(original, pool=self.buffer_pool)
+            self.processed_pil_image = self.edit_stack.render()
             self.active_pil_for_canvas = self.processed_pil_image
+            self.buffer_pool.hold(self.processed_pil_image)
             self.rotation_angle_var.set(0) 
         except Exception as e:
             messagebox.showerror("エラー", f"画像を開けませんでした: {path}\n{e}")
-            self.original_pil_image=None; self.processed_pil_image=None; self.active_pil_for_canvas=None
+            if self.edit_stack: self.edit_stack.close()
+            self._draft_image=None; self.processed_pil_image=None; self.active_pil_for_canvas=None; self.edit_stack=None
             self._display_image_on_canvas(); self.on_mode_change()
             return
         self.image_path = path
+        from . import frames
+        self._source_animated = frames.is_animated(original)
         self._display_image_on_canvas()
         self.on_mode_change()
 
     def _display_image_on_canvas(self):
+        self._rotation_preview_generation += 1 # 描画中の回転プレビューは破棄
+        self._cancel_refinements() # 前の表示の高画質化・作りかけの拡張プレビューも破棄
         self.master.update_idletasks()
-        controls_height = self.top_controls_area.winfo_reqheight()
+        controls_height = self._controls_height()
         canvas_frame_padx_sum = 20; canvas_frame_pady_sum = 15
         min_controls_width = self.MIN_WINDOW_WIDTH - canvas_frame_padx_sum - 20
-        canvas_max_allowable_width = self.max_window_width - canvas_frame_padx_sum
-        canvas_max_allowable_height = self.max_window_height - controls_height - canvas_frame_pady_sum - 20
+        canvas_max_allowable_width, canvas_max_allowable_height = self._get_canvas_max_size()
         if not self.active_pil_for_canvas:
             placeholder_w=max(100,min_controls_width); placeholder_h=max(100, self.MIN_WINDOW_HEIGHT_CONTROLS - controls_height + self.MIN_CANVAS_HEIGHT - canvas_frame_pady_sum - 20 if self.MIN_WINDOW_HEIGHT_CONTROLS > controls_height else self.MIN_CANVAS_HEIGHT)
             self.canvas.config(width=placeholder_w,height=placeholder_h)
             if self.image_on_canvas: self.canvas.delete(self.image_on_canvas); self.image_on_canvas=None
             if self.tk_image: self.tk_image=None
+            self.display_pil_image=None; self._displayed_entry=None; self._show_fit_view()
             win_w=max(self.MIN_WINDOW_WIDTH,self.top_controls_area.winfo_reqwidth()+canvas_frame_padx_sum+20); win_h=max(self.MIN_WINDOW_HEIGHT_CONTROLS + self.MIN_CANVAS_HEIGHT, controls_height + placeholder_h + canvas_frame_pady_sum + 20)
             self.master.geometry(f"{min(win_w,self.max_window_width)}x{min(win_h,self.max_window_height)}")
             return
@@ -370,17 +695,89 @@ class CropApp:
         if img_width>0 and img_height>0: ratio=min(canvas_max_allowable_width/img_width,canvas_max_allowable_height/img_height,1.0)
         new_width=int(img_width*ratio); new_height=int(img_height*ratio)
         new_width=max(50,new_width); new_height=max(50,new_height)
-        self.display_pil_image=self.active_pil_for_canvas.resize((new_width,new_height),RESAMPLE_LANCZOS)
-        self.tk_image=ImageTk.PhotoImage(self.display_pil_image)
+        # まだ縮小していなければ NEAREST の仮の画像を先に表示し、LANCZOS の縮小は _refine_quick_entries で裏で作る
+        entry=self.display_cache.quick(self._display_source(self.active_pil_for_canvas, new_width, new_height), (new_width,new_height))
+        if entry.photo is None: entry.photo=ImageTk.PhotoImage(entry.image)
+        if self.rect: self.canvas.delete(self.rect); self.rect=None; self.start_x=None; self.start_y=None
+        self.display_pil_image=entry.image; self.tk_image=entry.photo
+        self._show_fit_view()
+        if entry is self._displayed_entry and self.image_on_canvas:
+            # 同じ画像・同じサイズなら再リサンプリングもキャンバスの作り直しもしない (回転プレビューで差し替えた分だけ戻す)
+            self.canvas.itemconfig(self.image_on_canvas, image=self.tk_image); self.canvas.coords(self.image_on_canvas, 0, 0)
+            self._refine_quick_entries(); return
+        self._displayed_entry=entry
         self.canvas.config(width=new_width,height=new_height)
         if self.image_on_canvas: self.canvas.delete(self.image_on_canvas)
-        if self.rect: self.canvas.delete(self.rect); self.rect=None; self.start_x=None; self.start_y=None
         self.image_on_canvas=self.canvas.create_image(0,0,anchor=tk.NW,image=self.tk_image)
         final_win_width=max(self.MIN_WINDOW_WIDTH, new_width+canvas_frame_padx_sum+20)
         final_win_height=max(self.MIN_WINDOW_HEIGHT_CONTROLS + self.MIN_CANVAS_HEIGHT, new_height+controls_height+canvas_frame_pady_sum+20)
         self.master.geometry(f"{min(final_win_width,self.max_window_width)}x{min(final_win_height,self.max_window_height)}")
+        self._refine_quick_entries()
 
-    def on_custom_aspect_entry_write(self, *args):\n        if self._processing_aspect_change: return
+    def _show_fit_view(self):
+        # 全体表示に戻す (タイルを外し、スクロールを原点へ)
+        self.view_scale = None
+        for item, _ in self._tile_items.values(): self.canvas.delete(item)
+        self._tile_items = {}
+        self._view_size = self.display_pil_image.size if self.display_pil_image else (0, 0)
+        self.canvas.config(scrollregion=(0, 0) + self._view_size); self.canvas.xview_moveto(0); self.canvas.yview_moveto(0)
+        if self.image_on_canvas: self.canvas.itemconfig(self.image_on_canvas, state=tk.NORMAL)
+
+    def zoom_view(self, factor, anchor=None):
+        # 表示倍率を factor 倍にする (全体表示から MAX_VIEW_SCALE まで)。anchor (ウィジェット上の座標) の下の画素は動かさない
+        if not self.active_pil_for_canvas or not self.display_pil_image or not self.image_on_canvas: return
+        fit_scale = self.display_pil_image.width / self.active_pil_for_canvas.width
+        current = self.view_scale or fit_scale
+        new_scale = max(fit_scale, min(self.MAX_VIEW_SCALE, current * factor))
+        if abs(new_scale - current) < 1e-9: return
+        anchor_x, anchor_y = anchor or (self.canvas.winfo_width() / 2, self.canvas.winfo_height() / 2)
+        image_x = self.canvas.canvasx(anchor_x) / current; image_y = self.canvas.canvasy(anchor_y) / current
+        if self.rect: self.canvas.scale(self.rect, 0, 0, new_scale / current, new_scale / current)
+        if new_scale <= fit_scale: self._show_fit_view(); return
+        for item, _ in self._tile_items.values(): self.canvas.delete(item)
+        self._tile_items = {}; self.view_scale = new_scale
+        self._view_size = self.tile_cache.view_size(self.active_pil_for_canvas, new_scale)
+        self.canvas.itemconfig(self.image_on_canvas, state=tk.HIDDEN)
+        self.canvas.config(scrollregion=(0, 0) + self._view_size)
+        self.canvas.xview_moveto((image_x * new_scale - anchor_x) / self._view_size[0]); self.canvas.yview_moveto((image_y * new_scale - anchor_y) / self._view_size[1])
+        self._update_tiles()
+
+    def on_pan_drag(self, event):
+        self.canvas.scan_dragto(event.x, event.y, gain=1); self._update_tiles()
+
+    def _update_tiles(self):
+        # 見えているタイルだけをキャンバスに置き、見えなくなったものは外す (画素と PhotoImage は tile_cache が LRU で保持)
+        if self.view_scale is None or not self.active_pil_for_canvas: return
+        image = self.active_pil_for_canvas; tile_size = self.tile_cache.tile_size
+        view_box = (self.canvas.canvasx(0), self.canvas.canvasy(0), self.canvas.canvasx(self.canvas.winfo_width()), self.canvas.canvasy(self.canvas.winfo_height()))
+        visible = set(self.tile_cache.visible_tiles(image, self.view_scale, view_box))
+        source = self._display_source(image, 1, 1); base = source if source is not image else None # 元画像のままなら縮小デコード版から仮のタイルを作る
+        for key in [key for key in self._tile_items if key not in visible]: self.canvas.delete(self._tile_items.pop(key)[0])
+        for tx, ty in sorted(visible - set(self._tile_items)):
+            entry = self.tile_cache.quick(image, self.view_scale, tx, ty, base)
+            if entry.photo is None: entry.photo = ImageTk.PhotoImage(entry.image)
+            self._tile_items[(tx, ty)] = (self.canvas.create_image(tx * tile_size, ty * tile_size, anchor=tk.NW, image=entry.photo), entry)
+        if self.rect: self.canvas.tag_raise(self.rect)
+        self._refine_quick_entries()
+
+    def _display_source(self, image, width, height):
+        # 元画像のままなら縮小デコード版から縮小する (全解像度のデコードを起こさない)
+        draft = self._draft_image
+        if draft is not None and self.edit_stack and self.edit_stack.is_original(image) and draft.width >= width and draft.height >= height: return draft
+        return image
+
+    def _controls_height(self):
+        height = self.top_controls_area.winfo_reqheight() + self.status_frame.winfo_reqheight()
+        if self.session is not None and self.filmstrip_frame is not None: height += self.filmstrip_frame.winfo_reqheight()
+        return height
+
+    def _get_canvas_max_size(self):
+        controls_height = self._controls_height()
+        canvas_frame_padx_sum = 20; canvas_frame_pady_sum = 15
+        return self.max_window_width - canvas_frame_padx_sum, self.max_window_height - controls_height - canvas_frame_pady_sum - 20
+
+    def on_custom_aspect_entry_write(self, *args):
+        if self._processing_aspect_change: return
         self.aspect_choice_var.set("カスタム")
 
     def on_aspect_choice_change(self, event=None):
@@ -407,7 +804,7 @@ class CropApp:
             messagebox.showwarning("モードエラー", "拡張モードでは「自由選択」は使用できません。アスペクト比を16:9に戻しました。")
         self._processing_aspect_change = False
 
-    def load_settings():
+    def load_settings(self):
         try:
             with open(self.settings_file_path,'r') as f: settings=json.load(f)
             loaded_w=settings.get('aspect_w',self.DEFAULT_ASPECT_W); loaded_h=settings.get('aspect_h',self.DEFAULT_ASPECT_H)
@@ -415,6 +812,8 @@ class CropApp:
             self.rotation_fill_color_var.set(settings.get('rotation_fill_color', "#CCCCCC"))
             self.rotation_fill_mode_var.set(settings.get('rotation_fill_mode', "color"))
             self.extend_position_var.set(settings.get('extend_position', "center"))
+            self.extend_fill_var.set(settings.get('extend_fill') if settings.get('extend_fill') in core.EXTEND_FILL_MODES else "blur")
+            self._set_encoder_settings(encode.encoder_settings_from(settings))
             saved_aspect_choice = settings.get('aspect_choice', '16:9')
             if saved_aspect_choice in self.ASPECT_PRESETS: self.aspect_choice_var.set(saved_aspect_choice)
             else: self.aspect_choice_var.set("カスタム")
@@ -433,12 +832,32 @@ class CropApp:
                   'blur_radius':self.blur_radius_var.get(), 
                   'rotation_fill_color': self.rotation_fill_color_var.get(),
                   'rotation_fill_mode': self.rotation_fill_mode_var.get(),
-                  'extend_position': self.extend_position_var.get()}
+                  'extend_position': self.extend_position_var.get(),
+                  'extend_fill': self.extend_fill_var.get(),
+                  **self._get_encoder_settings()}
         try:
             with open(self.settings_file_path,'w') as f: json.dump(settings,f,indent=4)
             messagebox.showinfo("設定保存",f"設定を保存しました。\nパス: {self.settings_file_path}")
         except IOError as e: messagebox.showerror("設定保存エラー",f"設定の保存に失敗しました: {e}")
 
+    def _get_encoder_settings(self):
+        settings = dict(encode.ENCODER_DEFAULTS)
+        for key, var in (('png_compress_level', self.png_compress_level_var), ('jpeg_quality', self.jpeg_quality_var),
+                         ('jpeg_optimize', self.jpeg_optimize_var), ('jpeg_progressive', self.jpeg_progressive_var),
+                         ('jpeg_lossless', self.jpeg_lossless_var), ('webp_method', self.webp_method_var)):
+            try: settings[key] = var.get()
+            except tk.TclError: pass # 入力途中の不正な値は既定値
+        settings['png_compress_level'] = max(0, min(9, settings['png_compress_level']))
+        settings['jpeg_quality'] = max(1, min(100, settings['jpeg_quality']))
+        settings['webp_method'] = max(0, min(6, settings['webp_method']))
+        return settings
+
+    def _set_encoder_settings(self, settings):
+        self.png_compress_level_var.set(settings['png_compress_level']); self.jpeg_quality_var.set(settings['jpeg_quality'])
+        self.jpeg_optimize_var.set(settings['jpeg_optimize']); self.jpeg_progressive_var.set(settings['jpeg_progressive'])
+        self.jpeg_lossless_var.set(settings['jpeg_lossless'])
+        self.webp_method_var.set(settings['webp_method'])
+
     def apply_default_settings_to_ui(self):
         self._processing_aspect_change=True
         self.aspect_w_var.set(self.DEFAULT_ASPECT_W); self.aspect_h_var.set(self.DEFAULT_ASPECT_H)
@@ -447,23 +866,26 @@ class CropApp:
         self.on_aspect_choice_change()
         self.rotation_angle_var.set(0); self.rotation_fill_color_var.set("#CCCCCC"); 
         self.rotation_fill_mode_var.set("color")
-        self.extend_position_var.set("center")
+        self.extend_position_var.set("center"); self.extend_fill_var.set("blur")
+        self._set_encoder_settings(encode.ENCODER_DEFAULTS)
         self._update_rotation_fill_preview()
         self._on_rotation_fill_mode_change()
-        if self.original_pil_image: self.reset_image_processing()
-        elif self.processed_pil_image: self.processed_pil_image=None; self.active_pil_for_canvas=None; self._display_image_on_canvas()
+        if self.edit_stack: self.reset_image_processing()
+        elif self.processed_pil_image: self.processed_pil_image=None; self.active_pil_for_canvas=None; self.edit_stack=None; self._display_image_on_canvas()
 
     def on_mode_change(self):
         mode=self.mode.get(); is_crop_mode=(mode=="crop"); is_extend_mode=(mode=="extend")
         has_image=bool(self.processed_pil_image)
-        self.blur_radius_scale.config(state=tk.NORMAL if is_extend_mode else tk.DISABLED)
+        self._on_extend_fill_change()
         pos_state = tk.NORMAL if is_extend_mode else tk.DISABLED
+        for radio in self.extend_fill_radios: radio.config(state=pos_state)
         self.pos_center_radio.config(state=pos_state)
         self.pos_top_radio.config(state=pos_state)
         self.pos_bottom_radio.config(state=pos_state)
         self.pos_left_radio.config(state=pos_state)
         self.pos_right_radio.config(state=pos_state)
         self.update_preview_button.config(state=tk.NORMAL if is_extend_mode and has_image else tk.DISABLED)
+        self.smart_crop_button.config(state=tk.NORMAL if is_crop_mode and has_image else tk.DISABLED)
         rot_state = tk.NORMAL if has_image else tk.DISABLED
         self.rotate_left_button.config(state=rot_state); self.rotate_right_button.config(state=rot_state)
         self.reset_rotation_button.config(state=rot_state); self.rotation_slider.config(state=rot_state)
@@ -472,34 +894,34 @@ class CropApp:
         self.fill_mode_transparent_radio.config(state=rot_state) 
         self._on_rotation_fill_mode_change() 
         self.reset_image_button.config(state=tk.NORMAL if has_image else tk.DISABLED)
+        self._update_undo_redo_buttons()
         self.canvas.config(cursor="cross" if is_crop_mode else "arrow")
         if self.rect: self.canvas.delete(self.rect); self.rect=None
         self.on_aspect_choice_change()
         if self.processed_pil_image: self.active_pil_for_canvas = self.processed_pil_image; self._display_image_on_canvas()
-        else: self._display_image_on_canvas()
+        # 画像がなければ、表示中のものを消すときだけ描き直す (起動直後は update_idletasks でレイアウトを確定させない)
+        elif self.image_on_canvas: self._display_image_on_canvas()
+
+    def _on_extend_fill_change(self):
+        # ぼかし半径はぼかしの余白でだけ使う
+        self.blur_radius_scale.config(state=tk.NORMAL if self.mode.get()=="extend" and self.extend_fill_var.get()=="blur" else tk.DISABLED)
 
     def on_free_aspect_change(self): pass 
 
     def get_aspect_ratio_tuple(self):
-        try:
-            w_str=self.aspect_w_var.get(); h_str=self.aspect_h_var.get()
-            if not w_str or not h_str: return None
-            w=int(w_str); h=int(h_str)
-            if w<=0 or h<=0: return None
-            return w,h
-        except ValueError: return None
+        return core.parse_aspect_ratio(self.aspect_w_var.get(), self.aspect_h_var.get())
 
     def on_button_press(self, event):
         if self.mode.get()!="crop" or not self.display_pil_image: return
         self.start_x=self.canvas.canvasx(event.x); self.start_y=self.canvas.canvasy(event.y)
-        self.start_x=max(0,min(self.start_x,self.display_pil_image.width)); self.start_y=max(0,min(self.start_y,self.display_pil_image.height))
+        self.start_x=max(0,min(self.start_x,self._view_size[0])); self.start_y=max(0,min(self.start_y,self._view_size[1]))
         if self.rect: self.canvas.delete(self.rect)
         self.rect=self.canvas.create_rectangle(self.start_x,self.start_y,self.start_x+1,self.start_y+1,outline='red',width=2)
 
     def on_mouse_drag(self, event):
         if self.mode.get()!="crop" or not self.rect or self.start_x is None: return
         cur_x=self.canvas.canvasx(event.x); cur_y=self.canvas.canvasy(event.y)
-        canvas_w=self.display_pil_image.width; canvas_h=self.display_pil_image.height
+        canvas_w,canvas_h=self._view_size
         cur_x=max(0,min(cur_x,canvas_w)); cur_y=max(0,min(cur_y,canvas_h))
         end_x,end_y = cur_x,cur_y
         if self.aspect_choice_var.get() != "自由選択":
@@ -523,108 +945,117 @@ class CropApp:
     def crop_image_action(self):
         if not self.processed_pil_image: messagebox.showwarning("切り抜き不可", "処理対象の画像が読み込まれていません。"); return
         image_to_save = None; operation_description = "現在の画像全体"
-        if self.rect:
+        if self.rect and self._suggested_crop and self._suggested_crop[0] == self.rect:
+            if not self._apply_edit(("crop", self._suggested_crop[1])): return
+            image_to_save = self.processed_pil_image; operation_description = "切り抜き後の画像"
+        elif self.rect:
             coords = self.canvas.coords(self.rect)
             if coords and len(coords) == 4:
                 source_for_crop = self.processed_pil_image 
                 c_x1,c_y1,c_x2,c_y2=map(float,coords)
                 norm_c_left=min(c_x1,c_x2); norm_c_top=min(c_y1,c_y2); norm_c_right=max(c_x1,c_x2); norm_c_bottom=max(c_y1,c_y2)
                 if not self.display_pil_image: messagebox.showerror("エラー", "表示中の画像がありません。"); return
-                disp_w=self.display_pil_image.width; disp_h=self.display_pil_image.height
+                disp_w,disp_h=self._view_size # 拡大表示中は拡大後の座標系
                 src_w,src_h=source_for_crop.size
                 scale_x=src_w/disp_w if disp_w>0 else 1; scale_y=src_h/disp_h if disp_h>0 else 1
                 crop_left=int(norm_c_left*scale_x); crop_top=int(norm_c_top*scale_y); crop_right=int(norm_c_right*scale_x); crop_bottom=int(norm_c_bottom*scale_y)
                 crop_left=max(0,crop_left); crop_top=max(0,crop_top); crop_right=min(src_w,crop_right); crop_bottom=min(src_h,crop_bottom)
                 if crop_left < crop_right and crop_top < crop_bottom:
-                    cropped_pil = source_for_crop.crop((crop_left,crop_top,crop_right,crop_bottom))
-                    self.processed_pil_image = cropped_pil; self.active_pil_for_canvas = self.processed_pil_image
-                    self._display_image_on_canvas() 
-                    if self.rect: self.canvas.delete(self.rect); self.rect = None
+                    if not self._apply_edit(("crop", (crop_left,crop_top,crop_right,crop_bottom))): return
                     image_to_save = self.processed_pil_image; operation_description = "切り抜き後の画像"
                 else: messagebox.showwarning("切り抜き範囲無効", "選択された切り抜き範囲が無効です。現在の画像全体を保存します。"); image_to_save = self.processed_pil_image
             else: image_to_save = self.processed_pil_image; messagebox.showinfo("情報", "切り抜き範囲の取得に失敗しました。現在の画像全体を保存します。")
         else: image_to_save = self.processed_pil_image; messagebox.showinfo("情報", "切り抜き範囲が選択されていません。現在の画像全体を保存します。")
         if not image_to_save: messagebox.showerror("エラー", "保存する画像がありません。"); return
-        save_path=filedialog.asksaveasfilename(title=f"{operation_description}を保存", defaultextension=".png", filetypes=[("PNG files","*.png"),("JPEG files","*.jpg"),("All files","*.*")])
-        if save_path:
-            try: image_to_save.save(save_path); messagebox.showinfo("成功", f"{operation_description}を保存しました: {save_path}")
-            except Exception as e: messagebox.showerror("エラー", f"画像の保存に失敗しました: {e}")
-
-    def _generate_extended_image(self, source_image_for_processing):
-        if not source_image_for_processing: return None
-        aspect_tuple=self.get_aspect_ratio_tuple();
-        if not aspect_tuple: return None
-        target_aspect_w,target_aspect_h=aspect_tuple; target_ar=target_aspect_w/target_aspect_h
-        orig_w,orig_h=source_image_for_canvas.size 
-        current_ar = orig_w / orig_h if orig_h > 0 else float('inf')
-        if abs(target_ar-current_ar)<1e-6 : return source_image_for_processing.copy()
-        final_w,final_h = 0,0
-        if target_ar > current_ar: final_h=orig_h; final_w=int(round(orig_h*target_ar))
-        else: final_w=orig_w; final_h=int(round(orig_w/target_ar))
-        if final_w<=0 or final_h<=0: return None
-        output_mode = source_image_for_processing.mode
-        initial_fill_for_extended = (0,0,0,0) if 'A' in output_mode else (200,200,200)
-        extended_image = Image.new(output_mode, (final_w, final_h), initial_fill_for_extended)
-
-        position = self.extend_position_var.get()
-        # Y座標 (上下方向) の計算
-        if final_h > orig_h: # 縦に拡張される場合
-            if position == "top": paste_y_in_extended = 0
-            elif position == "bottom": paste_y_in_extended = final_h - orig_h
-            else: paste_y_in_extended = (final_h - orig_h) // 2 # "center", "left", "right"
-        else: paste_y_in_extended = 0 # 横拡張 (final_h == orig_h)
-        # X座標 (左右方向) の計算
-        if final_w > orig_w: # 横に拡張される場合
-            if position == "left": paste_x_in_extended = 0
-            elif position == "right": paste_x_in_extended = final_w - orig_w
-            else: paste_x_in_extended = (final_w - orig_w) // 2 # "center", "top", "bottom"
-        else: paste_x_in_extended = 0 # 縦拡張 (final_w == orig_w)
-
-        extended_image.paste(source_image_for_processing, (paste_x_in_extended, paste_y_in_extended), mask=source_image_for_processing if 'A' in output_mode else None)
-
-        top_padding_fill=paste_y_in_extended; bottom_padding_fill=final_h-(paste_y_in_extended+orig_h)
-        left_padding_fill=paste_x_in_extended; right_padding_fill=final_w-(paste_x_in_extended+orig_w)
-        blur_radius_val = self.blur_radius_var.get()
-        if top_padding_fill > 0:
-            desired_source_thickness=max(1,top_padding_fill//2); actual_source_thickness=min(orig_h,desired_source_thickness)
-            source_material=source_image_for_processing.crop((0,0,orig_w,actual_source_thickness))
-            if actual_source_thickness<desired_source_thickness and desired_source_thickness>0: source_material=source_material.resize((orig_w,desired_source_thickness),RESAMPLE_LANCZOS)
-            if blur_radius_val>0 and source_material.width>0 and source_material.height>0: blurred_material=source_material.filter(ImageFilter.GaussianBlur(blur_radius_val))
-            else: blurred_material=source_material
-            if blurred_material.width>0 and blurred_material.height>0: fill_content=blurred_material.resize((final_w,top_padding_fill),RESAMPLE_LANCZOS); extended_image.paste(fill_content,(0,0), mask=fill_content if 'A' in output_mode else None)
-        if bottom_padding_fill > 0:
-            desired_source_thickness=max(1,bottom_padding_fill//2); actual_source_thickness=min(orig_h,desired_source_thickness)
-            source_material=source_image_for_processing.crop((0,orig_h-actual_source_thickness,orig_w,orig_h))
-            if actual_source_thickness<desired_source_thickness and desired_source_thickness>0: source_material=source_material.resize((orig_w,desired_source_thickness),RESAMPLE_LANCZOS)
-            if blur_radius_val>0 and source_material.width>0 and source_material.height>0: blurred_material=source_material.filter(ImageFilter.GaussianBlur(blur_radius_val))
-            else: blurred_material=source_material
-            if blurred_material.width>0 and blurred_material.height>0: fill_content=blurred_material.resize((final_w,bottom_padding_fill),RESAMPLE_LANCZOS); extended_image.paste(fill_content,(0, paste_y_in_extended + orig_h), mask=fill_content if 'A' in output_mode else None)
-        if left_padding_fill > 0:
-            desired_source_thickness=max(1,left_padding_fill//2); actual_source_thickness=min(orig_w,desired_source_thickness)
-            source_material=source_image_for_processing.crop((0,0,actual_source_thickness,orig_h))
-            if actual_source_thickness<desired_source_thickness and desired_source_thickness>0: source_material=source_material.resize((desired_source_thickness,orig_h),RESAMPLE_LANCZOS)
-            if blur_radius_val>0 and source_material.width>0 and source_material.height>0: blurred_material=source_material.filter(ImageFilter.GaussianBlur(blur_radius_val))
-            else: blurred_material=source_material
-            if blurred_material.width>0 and blurred_material.height>0: fill_content=blurred_material.resize((left_padding_fill, final_h),RESAMPLE_LANCZOS); extended_image.paste(fill_content,(0,0), mask=fill_content if 'A' in output_mode else None)
-        if right_padding_fill > 0:
-            desired_source_thickness=max(1,right_padding_fill//2); actual_source_thickness=min(orig_w,desired_source_thickness)
-            source_material=source_image_for_processing.crop((orig_w-actual_source_thickness,0,orig_w,orig_h))
-            if actual_source_thickness<desired_source_thickness and desired_source_thickness>0: source_material=source_material.resize((desired_source_thickness,orig_h),RESAMPLE_LANCZOS)
-            if blur_radius_val>0 and source_material.width>0 and source_material.height>0: blurred_material=source_material.filter(ImageFilter.GaussianBlur(blur_radius_val))
-            else: blurred_material=source_material
-            if blurred_material.width>0 and blurred_material.height>0: fill_content=blurred_material.resize((right_padding_fill,final_h),RESAMPLE_LANCZOS); extended_image.paste(fill_content,(paste_x_in_extended + orig_w, 0), mask=fill_content if 'A' in output_mode else None)
-        extended_image.paste(source_image_for_processing,(paste_x_in_extended,paste_y_in_extended), mask=source_image_for_processing if 'A' in output_mode else None)
-        return extended_image
+        save_path=filedialog.asksaveasfilename(title=f"{operation_description}を保存", defaultextension=".png", filetypes=encode.SAVE_FILETYPES)
+        if save_path: self._start_background_save(image_to_save, save_path, f"{operation_description}を保存しました: {save_path}", self._source_save_func(self.edit_stack.ops))
+
+    def smart_crop_action(self):
+        # 表示中の縮小画像から目立つ部分を含む範囲を求め、選択枠として描く (ドラッグで描き直せる)
+        if self.mode.get()!="crop" or not self.processed_pil_image or not self.display_pil_image: return
+        aspect_tuple=self.get_aspect_ratio_tuple()
+        if not aspect_tuple: messagebox.showinfo("おすすめ範囲", "「自由選択」以外のアスペクト比を選んでください。"); return
+        from . import smartcrop
+        box=smartcrop.suggest_crop_box(self.processed_pil_image, aspect_tuple, proxy=self.display_pil_image)
+        scale_x=self._view_size[0]/self.processed_pil_image.width; scale_y=self._view_size[1]/self.processed_pil_image.height
+        if self.rect: self.canvas.delete(self.rect)
+        self.rect=self.canvas.create_rectangle(box[0]*scale_x,box[1]*scale_y,box[2]*scale_x,box[3]*scale_y,outline='red',width=2)
+        self.start_x=None; self.start_y=None; self._suggested_crop=(self.rect, box)
+
+    def _source_save_func(self, ops, fallback=None):
+        # 元ファイルから直接書き出す経路 (保存スレッドで実行)。複数フレームの画像を複数フレーム対応の形式へ保存するなら全フレームに ops を適用し、
+        # JPEG -> JPEG で回転・切り抜きだけなら DCT 係数のまま保存する。どちらでもなければ fallback (既定は通常の再エンコード)
+        src_path = self.image_path; animated = self._source_animated
+        def save(image, save_path, encoder_settings, progress, cancel_event):
+            if animated:
+                from . import frames
+                if frames.supports_frames(save_path): return frames.save_frames_from_path(src_path, ops, save_path, encoder_settings, progress, cancel_event)
+            if encoder_settings['jpeg_lossless']:
+                from . import lossless
+                if lossless.save_lossless(src_path, ops, save_path, encoder_settings): return save_path
+            return (fallback or encode.save_image)(image, save_path, encoder_settings, progress, cancel_event)
+        return save
+
+    def _get_preview_proxy(self, source, scale):
+        # source の縮小版をキャッシュ (画像が差し替わるか縮小率が変わったら作り直す)。回転プレビューのワーカーからも呼ばれる
+        cache = self._preview_proxy_cache
+        if cache and cache[0]() is source and cache[1] == scale: return cache[2]
+        proxy = core.make_proxy(source, scale, base=self._draft_image if self.edit_stack and self.edit_stack.is_original(source) else None)
+        self._preview_proxy_cache = (weakref.ref(source), scale, proxy)
+        return proxy
 
+    def _extended_preview_params(self):
+        # 拡張プレビューの描画に使う値 (Tk の変数はメインスレッドでしか読めないので先に取り出す)
+        aspect_tuple=self.get_aspect_ratio_tuple()
+        if not self.processed_pil_image or not aspect_tuple: return None
+        position=self.extend_position_var.get()
+        layout=core.compute_extend_layout(self.processed_pil_image.size, aspect_tuple, position)
+        final_size=layout[:2] if layout else self.processed_pil_image.size
+        scale=core.fit_scale(final_size, self._get_canvas_max_size())
+        return self.processed_pil_image, aspect_tuple, self.blur_radius_var.get(), position, self.extend_fill_var.get(), scale
+
+    def _generate_extended_preview(self, params, quick=False):
+        # キャンバスに収まる縮小画像から拡張プレビューを作る (ぼかし半径も同じ比率で縮小)。
+        # quick なら 1/QUICK_PREVIEW_FACTOR の大きさに NEAREST で縮小して拡張し、本来の大きさへ BILINEAR で拡大する
+        source, aspect_tuple, blur_radius, position, fill_mode, scale = params
+        if not quick: return core.extend_image(self._get_preview_proxy(source, scale), aspect_tuple, blur_radius*scale, position, fill_mode=fill_mode)
+        proxy_size=(max(1, int(round(source.width*scale))), max(1, int(round(source.height*scale))))
+        layout=core.compute_extend_layout(proxy_size, aspect_tuple, position)
+        small_scale=scale/self.QUICK_PREVIEW_FACTOR; small_size=(max(1, proxy_size[0]//self.QUICK_PREVIEW_FACTOR), max(1, proxy_size[1]//self.QUICK_PREVIEW_FACTOR))
+        small=self._display_source(source, *small_size).resize(small_size, RESAMPLE_NEAREST)
+        extended=core.extend_image(small, aspect_tuple, blur_radius*small_scale, position, fill_mode=fill_mode)
+        return extended.resize(layout[:2] if layout else proxy_size, core.RESAMPLE_BILINEAR) if extended else None
+
+    @timing.timed("preview")
     def update_preview_action(self):
         if self.mode.get()!="extend" or not self.processed_pil_image: messagebox.showwarning("プレビューエラー","拡張モードで画像を開いてからプレビューを更新してください。"); return
-        preview_image=self._generate_extended_image(self.processed_pil_image)
-        if preview_image: self.active_pil_for_canvas=preview_image; self._display_image_on_canvas()
-        else: messagebox.showerror("プレビューエラー","プレビュー画像の生成に失敗しました。設定を確認してください。")
+        params=self._extended_preview_params()
+        preview_image=self._generate_extended_preview(params, quick=True) if params else None
+        if not preview_image: messagebox.showerror("プレビューエラー","プレビュー画像の生成に失敗しました。設定を確認してください。"); return
+        self.active_pil_for_canvas=preview_image; self._display_image_on_canvas()
+        # ぼかし半径が大きくても操作を止めないよう、本来のプレビューは裏で作って差し替える
+        self._start_refinement("preview", lambda: self._generate_extended_preview(params), self._show_refined_preview)
+
+    def _show_refined_preview(self, preview_image):
+        if preview_image and self.mode.get()=="extend": self.active_pil_for_canvas=preview_image; self._display_image_on_canvas()
 
     def extend_image_and_save(self):
         if not self.processed_pil_image: messagebox.showwarning("警告","まず画像を読み込んでください。"); return
-        final_image_to_save=self._generate_extended_image(self.processed_pil_image)
+        aspect_tuple=self.get_aspect_ratio_tuple()
+        final_image_to_save=None; save_func=None
+        if aspect_tuple:
+            blur_radius_val=self.blur_radius_var.get(); position=self.extend_position_var.get(); fill_mode=self.extend_fill_var.get()
+            try:
+                from . import stream
+                if stream.should_stream(self.processed_pil_image.size, aspect_tuple, position, self.EXTEND_MEMORY_BUDGET_MB):
+                    # 巨大な出力は拡張画像を作らず、保存スレッドで帯ごとに拡張しながら書き出す
+                    final_image_to_save=self.processed_pil_image
+                    save_func=lambda image, save_path, encoder_settings, progress, cancel_event: stream.save_extended(
+                        image, save_path, aspect_tuple, blur_radius_val, position, encoder_settings, self.EXTEND_MEMORY_BUDGET_MB, progress, cancel_event, fill_mode)
+                # 拡張は履歴には積まず、描画済みの操作列の末尾に付けて描画する (同じ設定での再保存はキャッシュから)
+                else: final_image_to_save=self.edit_stack.render((("extend", aspect_tuple, blur_radius_val, position, fill_mode),))
+                save_func=self._source_save_func(self.edit_stack.ops + (("extend", aspect_tuple, blur_radius_val, position, fill_mode),), save_func)
+            except ValueError: final_image_to_save=None
         if not final_image_to_save: messagebox.showerror("エラー","拡張画像の生成に失敗しました。設定を確認してください。"); return
         try:
             current_settings_ar_tuple=self.get_aspect_ratio_tuple()
@@ -633,15 +1064,103 @@ class CropApp:
                 if abs(current_settings_ar-(self.processed_pil_image.width/self.processed_pil_image.height))<1e-6:
                      messagebox.showinfo("情報","画像は既に指定されたアスペクト比です。拡張処理はスキップされました。")
         except(TypeError,ZeroDivisionError,AttributeError):pass
-        save_path=filedialog.asksaveasfilename(defaultextension=".png",filetypes=[("PNG files","*.png"),("JPEG files","*.jpg"),("All files","*.*")])
-        if save_path:
-            try: final_image_to_save.save(save_path); messagebox.showinfo("成功",f"画像を拡張して保存しました: {save_path}")
-            except Exception as e: messagebox.showerror("エラー",f"画像の保存に失敗しました: {e}")
+        save_path=filedialog.asksaveasfilename(defaultextension=".png",filetypes=encode.SAVE_FILETYPES)
+        if save_path: self._start_background_save(final_image_to_save, save_path, f"画像を拡張して保存しました: {save_path}", save_func)
 
-if __name__ == "__main__":
+    def _ask_export_presets(self):
+        # 書き出す比率を選ぶモーダルダイアログ。キャンセル時は None
+        from . import export
+        previous = export.DEFAULT_EXPORT_PRESETS if self._export_preset_names is None else self._export_preset_names
+        dialog = tk.Toplevel(self.master); dialog.title("複数比率で書き出し"); dialog.transient(self.master); dialog.resizable(False, False)
+        ttk.Label(dialog, text="書き出すアスペクト比 (拡張モードの設定で余白を埋めます):").pack(anchor='w', padx=10, pady=(10,5))
+        choices_frame = ttk.Frame(dialog); choices_frame.pack(anchor='w', padx=10)
+        names = [name for name in self.PRESET_ORDER_ROW1 + self.PRESET_ORDER_ROW2 if isinstance(self.ASPECT_PRESETS.get(name), tuple)]
+        selected_vars = {name: tk.BooleanVar(value=name in previous) for name in names}
+        for i, name in enumerate(names):
+            ttk.Checkbutton(choices_frame, text=name, variable=selected_vars[name]).grid(row=i // 5, column=i % 5, sticky='w', padx=3, pady=2)
+        result = []
+        def accept():
+            result.extend(name for name in names if selected_vars[name].get()); dialog.destroy()
+        buttons_frame = ttk.Frame(dialog); buttons_frame.pack(pady=10)
+        ttk.Button(buttons_frame, text="書き出す", command=accept).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons_frame, text="キャンセル", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+        dialog.grab_set(); self.master.wait_window(dialog)
+        return result or None
+
+    def export_set_action(self):
+        # 選んだ比率すべてを、描画済みの画像から1回の処理で書き出す (余白の素材は比率間で共有)
+        if not self.processed_pil_image: messagebox.showwarning("警告","まず画像を読み込んでください。"); return
+        from . import export
+        names = self._ask_export_presets()
+        if not names: return
+        self._export_preset_names = names
+        base_path = filedialog.asksaveasfilename(title="書き出し先 (ファイル名の後ろに比率が付きます)", defaultextension=".png", filetypes=encode.SAVE_FILETYPES)
+        if not base_path: return
+        paths = export.export_paths(base_path, names)
+        targets = [(self.ASPECT_PRESETS[name], paths[name]) for name in names]
+        blur_radius_val = self.blur_radius_var.get(); position = self.extend_position_var.get(); fill_mode = self.extend_fill_var.get()
+        save_func = lambda image, save_path, encoder_settings, progress, cancel_event: export.export_set(
+            image, targets, blur_radius_val, position, encoder_settings, progress=progress, cancel_event=cancel_event, fill_mode=fill_mode)
+        self._start_background_save(self.processed_pil_image, base_path, f"{len(targets)} 枚を書き出しました:\n" + "\n".join(paths.values()), save_func)
+
+    def _build_save_progress_frame(self):
+        self.save_progress_frame = ttk.Frame(self.file_reset_buttons_frame)
+        self.save_progress_bar = ttk.Progressbar(self.save_progress_frame, mode="indeterminate", length=120)
+        self.save_progress_bar.pack(side=tk.LEFT, padx=5, pady=2)
+        self.save_progress_label = ttk.Label(self.save_progress_frame, text="", width=16)
+        self.save_progress_label.pack(side=tk.LEFT, padx=2, pady=2)
+        self.save_cancel_button = ttk.Button(self.save_progress_frame, text="キャンセル", command=self.cancel_background_save)
+        self.save_cancel_button.pack(side=tk.LEFT, padx=5, pady=2)
+
+    def _start_background_save(self, image, save_path, success_message, save_func=None):
+        # エンコードはワーカースレッドで行い、メインスレッドは SAVE_POLL_MS ごとに進捗を見る。
+        # save_func は encode.save_image と同じ引数を受け取る保存関数 (帯ごとの書き出しなど)
+        if self._save_thread is not None: messagebox.showwarning("保存中","前の保存処理が終わるまでお待ちください。"); return
+        state = {'bytes_written': 0, 'done': False, 'error': None, 'save_path': save_path, 'success_message': success_message}
+        cancel_event = threading.Event()
+        encoder_settings = self._get_encoder_settings()
+        def worker():
+            try:
+                with timing.stage("save"): (save_func or encode.save_image)(image, save_path, encoder_settings, lambda n: state.__setitem__('bytes_written', n), cancel_event)
+            except BaseException as e: state['error'] = e
+            state['done'] = True
+        self._save_state = state; self._save_cancel_event = cancel_event
+        self._save_thread = threading.Thread(target=worker, daemon=True)
+        if self.save_progress_frame is None: self._build_save_progress_frame()
+        self.execute_button.config(state=tk.DISABLED); self.export_set_button.config(state=tk.DISABLED); self.save_cancel_button.config(state=tk.NORMAL)
+        self.save_progress_label.config(text="保存中...")
+        self.save_progress_frame.pack(side=tk.LEFT, padx=5)
+        self.save_progress_bar.start(15)
+        self._save_thread.start()
+        self.master.after(self.SAVE_POLL_MS, self._poll_background_save)
+
+    def cancel_background_save(self):
+        if self._save_cancel_event is None: return
+        self._save_cancel_event.set()
+        self.save_cancel_button.config(state=tk.DISABLED); self.save_progress_label.config(text="キャンセル中...")
+
+    def _poll_background_save(self):
+        state = self._save_state
+        if not state['done']:
+            if not self._save_cancel_event.is_set(): self.save_progress_label.config(text=f"{state['bytes_written'] / (1024 * 1024):.1f} MB 書き込み済み")
+            self.master.after(self.SAVE_POLL_MS, self._poll_background_save); return
+        self._save_thread = None; self._save_state = None; self._save_cancel_event = None
+        self.save_progress_bar.stop(); self.save_progress_frame.pack_forget()
+        self.execute_button.config(state=tk.NORMAL); self.export_set_button.config(state=tk.NORMAL)
+        error = state['error']
+        if isinstance(error, encode.SaveCancelled): messagebox.showinfo("保存キャンセル", f"保存をキャンセルしました: {state['save_path']}")
+        elif error is not None: messagebox.showerror("エラー", f"画像の保存に失敗しました: {error}")
+        else: messagebox.showinfo("成功", state['success_message'])
+
+def main():
+    timing.configure(enabled=True, record=True) # 記録は MAX_EVENTS 件で頭打ち
     root = tkinterdnd2.Tk()
-    app = CropApp(root)
+    with timing.stage("startup"): app = CropApp(root) # ステータスバーに最初に表示される所要時間
     initial_width = max(app.MIN_WINDOW_WIDTH, int(root.winfo_screenwidth() * 0.5))
     initial_height = max(app.MIN_WINDOW_HEIGHT_CONTROLS + app.MIN_CANVAS_HEIGHT, int(root.winfo_screenheight() * 0.6))
     root.geometry(f"{min(initial_width, app.max_window_width)}x{min(initial_height, app.max_window_height)}")
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    if app.session is not None: app.session.close() # 作りかけのサムネイル・先読みを待たずに終了する
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import os
+import time
+
+from . import core, encode
+
+# バッチの再実行で、入力画像と処理設定が前回と同じ出力を作り直さないための記録 (出力ディレクトリの .cropple_manifest.json)。
+# 出力ごとに「入力ファイルの内容のハッシュ + 正規化した設定」の鍵と、書き出した出力ファイルのサイズ・更新時刻を残す。
+# 鍵が一致し、出力ファイルもそのまま残っていれば処理を省く。入力のハッシュはサイズ・更新時刻が同じ間は記録から再利用する。
+# 1件処理するごとに記録し、数秒おきと終了時に保存するので、中断した実行は続きから再開できる。
+# 記録は出力・入力それぞれ max_entries 件までで、最も長く使われていないものから捨てる (出力ファイル自体は消さない)。
+
+MANIFEST_NAME = core.MANIFEST_NAME
+MANIFEST_VERSION = 1 # 同じ設定でも出力が変わる変更を入れたら上げる (古い記録はすべて無効になる)
+DEFAULT_MAX_ENTRIES = core.DEFAULT_MANIFEST_ENTRIES
+SAVE_INTERVAL_SECONDS = 5.0
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _normalized_aspect(settings):
+    # 32:18 と 16:9 のように同じ比率は同じ値にする。「オリジナル」「自由選択」は画像ごとに決まるので名前のまま
+    preset = core.ASPECT_PRESETS.get(settings.get('aspect_choice', core.DEFAULT_SETTINGS['aspect_choice']), "custom")
+    if preset in ("original", "free"): return preset
+    aspect_tuple = preset if isinstance(preset, tuple) else core.parse_aspect_ratio(settings.get('aspect_w'), settings.get('aspect_h'))
+    if not aspect_tuple: return None
+    common = math.gcd(*aspect_tuple); return [aspect_tuple[0] // common, aspect_tuple[1] // common]
+
+
+def settings_key(settings, mode="extend", quarter_turns=0, rotation_angle=0.0):
+    # 出力に影響する設定だけを並べた文字列。使われない設定 (切り抜きモードのぼかし半径、回転しない場合の余白色など) は含めない
+    angle = round(float(rotation_angle), 3) if abs(rotation_angle) >= 0.1 else 0.0
+    fill_mode = settings.get('rotation_fill_mode', "color")
+    fill = None
+    if angle: fill = [fill_mode, str(settings.get('rotation_fill_color', core.DEFAULT_FILL_COLOR)).upper() if fill_mode == "color" else None]
+    extend = None
+    if mode == "extend":
+        extend_fill = settings.get('extend_fill', "blur")
+        extend = [int(settings.get('blur_radius', core.DEFAULT_BLUR_RADIUS)) if extend_fill == "blur" else None, settings.get('extend_position', "center"), extend_fill]
+    encoder = sorted(encode.encoder_settings_from(settings).items())
+    return json.dumps([mode, _normalized_aspect(settings), quarter_turns % 4, angle, fill, extend, encoder], ensure_ascii=False)
+
+
+class Manifest:
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path; self.max_entries = max(1, max_entries)
+        self._outputs = OrderedDict() # 出力の絶対パス -> {'key', 'size', 'mtime_ns'} (古い順)
+        self._sources = OrderedDict() # 入力の絶対パス -> [size, mtime_ns, ハッシュ] (古い順)
+        self._dirty = False; self._saved_at = time.monotonic()
+        try:
+            with open(path, 'r') as f: data = json.load(f)
+        except (OSError, ValueError): return
+        if not isinstance(data, dict) or data.get('version') != MANIFEST_VERSION: return
+        self._outputs.update(data.get('outputs', {})); self._sources.update(data.get('sources', {}))
+
+    def _touch(self, entries, key):
+        entries.move_to_end(key); self._dirty = True
+        while len(entries) > self.max_entries: entries.popitem(last=False)
+
+    def source_digest(self, src_path):
+        key = os.path.abspath(src_path); st = os.stat(src_path)
+        cached = self._sources.get(key)
+        if not cached or cached[0] != st.st_size or cached[1] != st.st_mtime_ns: self._sources[key] = cached = [st.st_size, st.st_mtime_ns, file_digest(src_path)]
+        self._touch(self._sources, key)
+        return cached[2]
+
+    def job_key(self, src_path, key_of_settings):
+        return hashlib.sha256(f"{self.source_digest(src_path)}\0{key_of_settings}".encode('utf-8')).hexdigest()
+
+    def is_fresh(self, job_key, dst_path):
+        # 前回同じ鍵で書き出した出力が、書き出した時のまま残っているか
+        key = os.path.abspath(dst_path); entry = self._outputs.get(key)
+        if not entry or entry.get('key') != job_key: return False
+        try: st = os.stat(dst_path)
+        except OSError: return False
+        if st.st_size != entry.get('size') or st.st_mtime_ns != entry.get('mtime_ns'): return False
+        self._touch(self._outputs, key)
+        return True
+
+    def record(self, job_key, dst_path):
+        key = os.path.abspath(dst_path); st = os.stat(dst_path)
+        self._outputs[key] = {'key': job_key, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        self._touch(self._outputs, key)
+
+    def save(self):
+        if not self._dirty: return
+        with encode.atomic_output(self.path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'outputs': self._outputs, 'sources': self._sources}, f, ensure_ascii=False)
+        self._dirty = False; self._saved_at = time.monotonic()
+
+    def save_if_due(self):
+        if self._dirty and time.monotonic() - self._saved_at >= SAVE_INTERVAL_SECONDS: self.save()
@@ -0,0 +1,276 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, UnidentifiedImageError
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import asyncio
+import itertools
+import json
+import mimetypes
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from . import batch, core, encode, stream
+
+# 他のツールから HTTP で呼び出すためのローカル処理サーバー (cropple serve)。外部への通信は一切しない。
+#   POST /process?mode=extend&aspect=16:9&format=png  本文に画像そのもの (Content-Length 必須)。処理後の画像を返す
+#   GET /metrics                                     処理件数と所要時間の分位点 (JSON)
+#   GET /health                                      稼働確認
+# パラメータは save_settings が保存するキー (aspect_choice, blur_radius, extend_fill など) と同じ名前で、
+# 指定しなかったものは起動時の設定 (--settings と個別オプション) を使う。
+# 画像処理は batch.process_file を起動時に温めておいたプロセスプールで実行する。アップロードは一時ファイルへ
+# 少しずつ書き、結果も一時ファイルから少しずつ返すので、イベントループ側は画像全体をメモリに持たない。
+# 受け付け済み (処理中 + ワーカー待ち) が queue_limit に達している間は、本文を読む前に 503 を返す。
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_UPLOAD_MB = 200
+HEADER_TIMEOUT_SECONDS = 30.0
+IO_CHUNK_BYTES = 64 * 1024
+METRICS_WINDOW = 1024 # 分位点を求める直近のリクエスト数
+PERCENTILES = (50, 90, 99)
+REQUEST_PARAMS = ("mode", "rotate90", "angle", "format", "aspect", "filename")
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large",
+               415: "Unsupported Media Type", 422: "Unprocessable Entity", 431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message); self.status = status; self.headers = headers or {}
+
+
+def percentile(sorted_values, pct):
+    # 最近順位法。sorted_values は昇順
+    if not sorted_values: return None
+    return sorted_values[max(0, min(len(sorted_values) - 1, -(-pct * len(sorted_values) // 100) - 1))]
+
+
+class Metrics:
+    def __init__(self, window=METRICS_WINDOW):
+        self.started = time.time(); self.statuses = Counter()
+        self._latency = deque(maxlen=window) # リクエスト受信から応答し終えるまで (成功した POST /process のみ)
+        self._queue_wait = deque(maxlen=window) # 受け付けからワーカーが処理を始めるまで
+        self._process = deque(maxlen=window) # ワーカーでの処理時間
+
+    def observe(self, status, latency=None, queue_wait=None, process=None):
+        self.statuses[status] += 1
+        for values, value in ((self._latency, latency), (self._queue_wait, queue_wait), (self._process, process)):
+            if value is not None: values.append(value)
+
+    def snapshot(self, workers, queue_limit, in_flight):
+        def summary(values):
+            ordered = sorted(values)
+            return dict({'count': len(ordered)}, **{f"p{pct}_ms": None if not ordered else round(percentile(ordered, pct) * 1000, 1) for pct in PERCENTILES})
+        return {'uptime_seconds': round(time.time() - self.started, 1), 'workers': workers, 'queue_limit': queue_limit, 'in_flight': in_flight,
+                'requests': sum(self.statuses.values()), 'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+                'latency': summary(self._latency), 'queue_wait': summary(self._queue_wait), 'process': summary(self._process)}
+
+
+def _warm_up():
+    # ワーカーの起動とモジュールの読み込みを最初のリクエストより前に済ませる
+    from . import edits, frames, lossless, smartcrop # noqa: F401
+    core.extend_image(Image.new("RGB", (16, 16)), (2, 1), 4, "center")
+    return os.getpid()
+
+
+def _coerce(key, value):
+    default = core.DEFAULT_SETTINGS.get(key, encode.ENCODER_DEFAULTS.get(key))
+    if isinstance(default, bool):
+        if value.lower() in ("1", "true", "on", "yes"): return True
+        if value.lower() in ("0", "false", "off", "no"): return False
+        raise ValueError(f"{key} は true / false で指定してください: {value}")
+    if isinstance(default, int): return int(value)
+    return value
+
+
+def parse_request_params(base_settings, query, defaults=None):
+    # クエリ文字列 -> (設定, mode, 90°回転回数, 自由回転角度, 出力形式, 元のファイル名)。不正な値は ValueError。
+    # defaults は REQUEST_PARAMS のうち指定されなかったものの値 (起動時の --mode など)
+    settings = dict(base_settings); params = dict(defaults or {})
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key in REQUEST_PARAMS: params[key] = value
+        elif key in core.DEFAULT_SETTINGS or key in encode.ENCODER_DEFAULTS: settings[key] = _coerce(key, value)
+        else: raise ValueError(f"不明なパラメータです: {key}")
+    aspect = params.pop('aspect', None)
+    if aspect:
+        if aspect in core.ASPECT_PRESETS: settings['aspect_choice'] = aspect
+        else:
+            w_str, _, h_str = aspect.partition(":")
+            if not core.parse_aspect_ratio(w_str, h_str): raise ValueError(f"アスペクト比の指定が不正です: {aspect}")
+            settings['aspect_choice'] = "カスタム"; settings['aspect_w'] = w_str; settings['aspect_h'] = h_str
+    mode = params.get('mode', "extend")
+    if mode not in ("extend", "crop", "smart"): raise ValueError(f"mode は extend / crop / smart のいずれかです: {mode}")
+    if settings.get('extend_position') not in core.EXTEND_POSITIONS: raise ValueError(f"extend_position が不正です: {settings.get('extend_position')}")
+    if settings.get('extend_fill') not in core.EXTEND_FILL_MODES: raise ValueError(f"extend_fill が不正です: {settings.get('extend_fill')}")
+    if settings.get('rotation_fill_mode') == "color": core.parse_hex_color(settings['rotation_fill_color'])
+    output_format = params.get('format', "png").lower()
+    if output_format not in batch.OUTPUT_FORMATS: raise ValueError(f"format は {' / '.join(sorted(batch.OUTPUT_FORMATS))} のいずれかです: {output_format}")
+    return settings, mode, int(params.get('rotate90', 0)), float(params.get('angle', 0.0)), output_format, params.get('filename', "")
+
+
+def _source_extension(filename, content_type):
+    # 一時ファイルの拡張子 (可逆変換の判定や format=same に使う)。ファイル名、Content-Type の順に見る
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in core.IMAGE_EXTENSIONS: return ext
+    ext = mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return ".jpg" if ext in (".jpe", ".jpeg") else ext if ext in core.IMAGE_EXTENSIONS else ""
+
+
+class Server:
+    def __init__(self, settings, defaults=None, workers=None, queue_limit=None, max_upload_mb=DEFAULT_MAX_UPLOAD_MB, memory_budget_mb=None, log=print):
+        self.settings = settings; self.defaults = defaults or {}; self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_limit = max(1, queue_limit or self.workers * 2); self.max_upload_bytes = int(max_upload_mb * 1024 * 1024)
+        self.memory_budget_mb = memory_budget_mb; self.log = log
+        self.metrics = Metrics(); self._accepted = 0; self._ids = itertools.count(1)
+        self._executor = None; self._tmp_dir = None
+
+    async def start_pool(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="cropple-serve-")
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers)))
+        self.log(f"ワーカーを起動しました: {len(set(pids))} processes")
+
+    def close(self):
+        if self._executor is not None: self._executor.shutdown(wait=True, cancel_futures=True); self._executor = None
+        if self._tmp_dir: shutil.rmtree(self._tmp_dir, ignore_errors=True); self._tmp_dir = None
+
+    async def handle(self, reader, writer):
+        received = time.perf_counter(); status = None; timings = {}
+        try:
+            try: head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT_SECONDS)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError): return # 何も送らずに切れた・黙ったままの接続
+            except asyncio.LimitOverrunError: head = None
+            try:
+                if head is None: raise HttpError(431, "リクエストヘッダーが大きすぎます")
+                method, target, headers = self._parse_head(head)
+                path = urlsplit(target).path
+                if path == "/process":
+                    if method != "POST": raise HttpError(405, "POST で画像を送ってください", {'Allow': "POST"})
+                    status = await self._process(reader, writer, urlsplit(target).query, headers, timings)
+                elif path in ("/metrics", "/health"):
+                    if method != "GET": raise HttpError(405, "GET で呼び出してください", {'Allow': "GET"})
+                    body = self.metrics.snapshot(self.workers, self.queue_limit, self._accepted) if path == "/metrics" else {'status': "ok"}
+                    status = 200; await self._send_json(writer, status, body)
+                else: raise HttpError(404, f"見つかりません: {path}")
+            except HttpError as e:
+                status = e.status; await self._send_json(writer, status, {'error': str(e)}, e.headers)
+            except Exception as e:
+                status = 500; self.log(f"内部エラー: {e!r}"); await self._send_json(writer, status, {'error': str(e)})
+        except ConnectionError: pass # 応答の途中でクライアントが切断した
+        finally:
+            if status is not None:
+                if timings and status == 200: self.metrics.observe(status, time.perf_counter() - received, timings.get('queue_wait'), timings.get('process'))
+                else: self.metrics.observe(status)
+            writer.close()
+
+    def _parse_head(self, head):
+        lines = head.decode('latin-1').split("\r\n")
+        try: method, target, _ = lines[0].split(" ", 2)
+        except ValueError: raise HttpError(400, "リクエスト行が不正です")
+        headers = {}
+        for line in lines[1:]:
+            if line: name, _, value = line.partition(":"); headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def _process(self, reader, writer, query, headers, timings):
+        timings['received'] = True # /process のリクエストだけ所要時間を集計する
+        try: settings, mode, quarter_turns, angle, output_format, filename = parse_request_params(self.settings, query, self.defaults)
+        except ValueError as e: raise HttpError(400, str(e))
+        if 'content-length' not in headers: raise HttpError(411, "Content-Length を指定してください (chunked 転送には対応していません)")
+        try: length = int(headers['content-length'])
+        except ValueError: raise HttpError(400, "Content-Length が不正です")
+        if length <= 0: raise HttpError(400, "画像が空です")
+        if length > self.max_upload_bytes: raise HttpError(413, f"画像が大きすぎます (上限 {self.max_upload_bytes // (1024 * 1024)} MB)")
+        # 背圧: 受け付け済みが上限なら本文を読まずに断る (クライアントは Retry-After 後に再送する)
+        if self._accepted >= self.queue_limit: raise HttpError(503, "処理待ちが上限に達しています", {'Retry-After': "1"})
+        src_ext = _source_extension(filename, headers.get('content-type', ""))
+        if output_format == "same" and not src_ext: raise HttpError(400, "format=same には filename または画像の Content-Type が必要です")
+        job_id = next(self._ids)
+        src_path = os.path.join(self._tmp_dir, f"{job_id}-in{src_ext}")
+        dst_path = batch.build_output_path(f"{job_id}-out{src_ext}", self._tmp_dir, output_format)
+        self._accepted += 1
+        try:
+            with open(src_path, 'wb') as f:
+                remaining = length
+                while remaining:
+                    chunk = await reader.read(min(IO_CHUNK_BYTES, remaining))
+                    if not chunk: raise HttpError(400, "本文が Content-Length より短いです")
+                    f.write(chunk); remaining -= len(chunk)
+            queued = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                _, _, elapsed = await loop.run_in_executor(self._executor, batch.process_file, src_path, dst_path, settings, mode, quarter_turns, angle, self.memory_budget_mb)
+            except UnidentifiedImageError: raise HttpError(415, "画像として読み込めません")
+            except (ValueError, OSError) as e: raise HttpError(422, str(e))
+            timings['process'] = elapsed; timings['queue_wait'] = max(0.0, time.perf_counter() - queued - elapsed)
+            await self._send_file(writer, dst_path)
+            return 200
+        finally:
+            self._accepted -= 1
+            for path in (src_path, dst_path):
+                try: os.remove(path)
+                except OSError: pass
+
+    async def _send_head(self, writer, status, content_type, length, headers=None):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}", f"Content-Type: {content_type}", f"Content-Length: {length}", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    async def _send_json(self, writer, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        await self._send_head(writer, status, "application/json; charset=utf-8", len(data), headers)
+        writer.write(data); await writer.drain()
+
+    async def _send_file(self, writer, path):
+        # 少しずつ書いて drain で待つので、遅いクライアントに対しても送信バッファは一定以上に増えない
+        content_type = Image.MIME.get(encode.image_format_for(path), "application/octet-stream")
+        await self._send_head(writer, 200, content_type, os.path.getsize(path))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(IO_CHUNK_BYTES), b""): writer.write(chunk); await writer.drain()
+
+
+async def serve(server, host=DEFAULT_HOST, port=DEFAULT_PORT, log=print):
+    await server.start_pool()
+    try:
+        listener = await asyncio.start_server(server.handle, host, port)
+        # SIGTERM (サービスとして動かしたときの停止) でも一時ファイルとワーカーを片付けてから終わる。Windows にはない
+        stopped = asyncio.Event()
+        try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        except (NotImplementedError, AttributeError): pass
+        log(f"http://{host}:{port}/ で待ち受けています ({server.workers} workers, 待ち上限 {server.queue_limit}件)。Ctrl+C で停止します。")
+        async with listener: await stopped.wait()
+        log("停止しました。")
+    finally: server.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cropple serve", description="画像を HTTP で受け取り、切り抜き/拡張/回転して返すローカルサーバーを起動します。")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="待ち受けるアドレス (既定: ローカルのみ)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="待ち受けるポート")
+    batch.add_processing_arguments(parser)
+    parser.add_argument("--format", choices=sorted(batch.OUTPUT_FORMATS), default="png", help="出力形式 (リクエストの format で変えられる)")
+    parser.add_argument("-j", "--workers", type=int, help="ワーカープロセス数 (既定: CPU コア数)")
+    parser.add_argument("--queue-limit", type=int, help="同時に受け付ける画像数の上限。超えた分は 503 (既定: ワーカー数の2倍)")
+    parser.add_argument("--max-upload", type=float, default=DEFAULT_MAX_UPLOAD_MB, metavar="MB", help="受け付ける画像の最大サイズ")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help=f"拡張後の画像がこれを超える場合は帯ごとに書き出して作業メモリを抑える (目安: {stream.DEFAULT_MEMORY_BUDGET_MB})")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try: settings = batch.apply_cli_overrides(batch.load_settings_file(args.settings), args)
+    except (OSError, ValueError) as e: print(f"設定エラー: {e}", file=sys.stderr); return 2
+    server = Server(settings, {'mode': args.mode, 'rotate90': args.rotate90, 'angle': args.angle, 'format': args.format}, args.workers, args.queue_limit, args.max_upload, args.memory_budget)
+    try: asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt: print("停止しました。")
+    except OSError as e: print(f"起動できません: {e}", file=sys.stderr); return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
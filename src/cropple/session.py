@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import os
+import threading
+
+from PIL import Image
+
+from . import core, loader, timing
+
+# 複数の画像を順に扱うセッション (複数ファイル・フォルダのドロップ、ダイアログでの複数選択)。
+# フィルムストリップのサムネイルはスレッドプールで作り、今の画像の次の ahead 枚は全解像度のデコードと
+# 表示用の縮小 (JPEG は縮小デコード) まで裏で済ませておく。先読みした全解像度の画像は合計 memory_cap バイトまでで、
+# 入りきらない画像は表示用の縮小だけを作る (全解像度は開いたときに遅延デコード)。
+# 結果は Future で受け取り、PhotoImage はメインスレッドで作る (Tk はスレッドから触れない)。
+# 画像ごとの操作列 (回転・切り抜きなど) はセッションが覚えておき、戻ってきたときに元に戻す。設定は画像をまたいで引き継ぐ。
+
+DEFAULT_PREFETCH_AHEAD = 2
+DEFAULT_PREFETCH_MB = 512
+DEFAULT_THUMBNAIL_WORKERS = 2
+THUMBNAIL_SIZE = 96
+
+
+def expand_paths(paths):
+    # フォルダは直下の画像を名前順に展開する。画像以外と重複は除く (順番は渡された順)
+    images = []; seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            try: names = sorted(os.listdir(path))
+            except OSError: continue
+            candidates = [os.path.join(path, name) for name in names if not name.startswith(".")]
+        else: candidates = [path]
+        for candidate in candidates:
+            key = os.path.abspath(candidate)
+            if key in seen or not os.path.isfile(candidate) or not candidate.lower().endswith(core.IMAGE_EXTENSIONS): continue
+            seen.add(key); images.append(candidate)
+    return images
+
+
+def make_thumbnail(path, size=THUMBNAIL_SIZE):
+    # thumbnail は JPEG なら縮小デコードを使う
+    with Image.open(path) as image:
+        image.thumbnail((size, size))
+        return core.normalize_image_mode(image)
+
+
+class Prefetched:
+    # 先読みの結果。image は全解像度 (メモリの上限を超える場合は None)、draft は表示用の縮小
+    __slots__ = ("path", "image", "draft", "nbytes")
+
+    def __init__(self, path, image, draft, nbytes):
+        self.path = path; self.image = image; self.draft = draft; self.nbytes = nbytes
+
+
+class Prefetcher:
+    def __init__(self, max_size, ahead=DEFAULT_PREFETCH_AHEAD, memory_cap_bytes=DEFAULT_PREFETCH_MB * 1024 * 1024):
+        from concurrent.futures import ThreadPoolExecutor # セッションを始めたときだけ読み込む
+        self.max_size = max_size; self.ahead = ahead; self.memory_cap_bytes = memory_cap_bytes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cropple-prefetch") # 1枚ずつ、近いものから順に
+        self._futures = OrderedDict() # パス -> Future
+        self._lock = threading.Lock()
+        self._reserved_bytes = 0 # 先読み済み (と実行中) の全解像度の合計
+
+    def _reserve(self, nbytes):
+        with self._lock:
+            if self._reserved_bytes + nbytes > self.memory_cap_bytes: return False
+            self._reserved_bytes += nbytes; return True
+
+    def _release(self, nbytes):
+        with self._lock: self._reserved_bytes -= nbytes
+
+    def _load(self, path):
+        with timing.stage("prefetch"):
+            image = loader.open_image(path)
+            nbytes = image.width * image.height * len(image.getbands())
+            if not self._reserve(nbytes): image = None; nbytes = 0
+            try:
+                draft = loader.open_draft(path, self.max_size)
+                if image is not None:
+                    with timing.stage("decode"): image.load()
+                if draft is None:
+                    full = image if image is not None else loader.open_image(path)
+                    draft = core.make_proxy(full, core.fit_scale(full.size, self.max_size))
+            except BaseException:
+                if nbytes: self._release(nbytes)
+                raise
+            return Prefetched(path, image, draft, nbytes)
+
+    def update(self, paths):
+        # paths (近い順) を先読みの対象にし、外れたものは捨てる
+        paths = list(paths)[:self.ahead]
+        for path in [path for path in self._futures if path not in paths]: self._discard(self._futures.pop(path))
+        for path in paths:
+            if path not in self._futures: self._futures[path] = self._executor.submit(self._load, path)
+
+    def _discard(self, future):
+        # 実行中のものは終わってから予約を返す
+        if future.cancel(): return
+        def release(done):
+            if done.exception() is None and done.result().nbytes: self._release(done.result().nbytes)
+        future.add_done_callback(release)
+
+    def take(self, path):
+        # 先読み済みなら結果を返して先読みの対象から外す。実行中なら終わるのを待つ。まだ始まっていなければ None
+        future = self._futures.pop(path, None)
+        if future is None or future.cancel(): return None
+        try: result = future.result()
+        except Exception: return None
+        if result.nbytes: self._release(result.nbytes)
+        return result
+
+    def close(self):
+        for future in self._futures.values(): self._discard(future)
+        self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Session:
+    def __init__(self, paths, max_size, ahead=DEFAULT_PREFETCH_AHEAD, memory_cap_bytes=DEFAULT_PREFETCH_MB * 1024 * 1024, thumbnail_size=THUMBNAIL_SIZE):
+        from concurrent.futures import ThreadPoolExecutor
+        self.paths = list(paths); self.index = 0; self.thumbnail_size = thumbnail_size
+        self._ops = {} # パス -> その画像の操作列
+        self.prefetcher = Prefetcher(max_size, ahead, memory_cap_bytes)
+        self._thumbnail_executor = ThreadPoolExecutor(max_workers=DEFAULT_THUMBNAIL_WORKERS, thread_name_prefix="cropple-thumbnail")
+        self.thumbnails = [self._thumbnail_executor.submit(make_thumbnail, path, thumbnail_size) for path in self.paths] # paths と同じ順の Future
+
+    def __len__(self): return len(self.paths)
+
+    @property
+    def current_path(self): return self.paths[self.index]
+
+    def remember_ops(self, path, ops):
+        if ops: self._ops[path] = tuple(ops)
+        else: self._ops.pop(path, None)
+
+    def ops_for(self, path): return self._ops.get(path, ())
+
+    def upcoming(self):
+        # 先読みする順番: 次の画像から順に (最後まで行ったら前の画像)
+        return self.paths[self.index + 1:] + self.paths[:self.index][::-1]
+
+    def select(self, index):
+        # index の画像に移り、先読み済みならその結果を返す (なければ None)
+        self.index = index
+        prefetched = self.prefetcher.take(self.current_path)
+        self.prefetcher.update(self.upcoming())
+        return prefetched
+
+    def close(self):
+        self.prefetcher.close()
+        self._thumbnail_executor.shutdown(wait=False, cancel_futures=True)
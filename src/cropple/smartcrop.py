@@ -0,0 +1,77 @@
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+from itertools import accumulate
+
+from . import core, timing
+
+# 指定比率の切り抜き範囲を画像の内容から自動で提案する。
+# 縮小した画像 (長辺 SALIENCY_MAX_SIDE 程度) で輪郭の強さと局所エントロピーから「目立ち度」の地図を作り、
+# その累積和テーブル (summed-area table) を引くことで、候補の窓1つあたり定数時間で窓内の合計を求める。
+# 窓は指定比率で最大のサイズ (compute_center_crop_box と同じ) に固定し、目立ち度の合計が最大の位置を選ぶ。
+# 結果は元画像の座標へ戻して返すので、GUI の表示用画像でもバッチの原寸画像でもそのまま使える。
+
+SALIENCY_MAX_SIDE = 256
+ENTROPY_CELL = 8 # 局所エントロピーを求める升目の画素数 (縮小画像上)
+ENTROPY_SCALE = 32 # エントロピー (0-8 bit) を 0-255 に広げる係数
+CENTER_BIAS = 1e-3 # 合計がほぼ同じ位置なら中央寄りを選ぶための重み (全体の合計に対する割合)
+
+
+def saliency_map(image, max_side=SALIENCY_MAX_SIDE):
+    # 目立ち度の L 画像。透明な部分は目立たないものとして扱う
+    proxy = core.make_proxy(image, core.fit_scale(image.size, (max_side, max_side)), core.RESAMPLE_BILINEAR)
+    gray = proxy.convert("L")
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    # Pillow のフィルタは外周1画素を元の値のまま残すので、輪郭なしとして消す (画像の端が目立つ扱いにならないように)
+    if edges.width > 2 and edges.height > 2: edges = ImageOps.expand(edges.crop((1, 1, edges.width - 1, edges.height - 1)), 1, 0)
+    else: edges = Image.new("L", edges.size)
+    cols = -(-gray.width // ENTROPY_CELL); rows = -(-gray.height // ENTROPY_CELL)
+    entropy = Image.new("L", (cols, rows))
+    entropy.putdata([min(255, int(gray.crop((col * ENTROPY_CELL, row * ENTROPY_CELL, (col + 1) * ENTROPY_CELL, (row + 1) * ENTROPY_CELL)).entropy() * ENTROPY_SCALE))
+                     for row in range(rows) for col in range(cols)])
+    entropy = entropy.resize((cols * ENTROPY_CELL, rows * ENTROPY_CELL), core.RESAMPLE_BILINEAR).crop((0, 0) + gray.size)
+    saliency = ImageChops.add(edges, entropy, scale=2.0).filter(ImageFilter.BoxBlur(1))
+    if 'A' in proxy.mode: saliency = ImageChops.multiply(saliency, proxy.getchannel('A'))
+    return saliency
+
+
+def summed_area_table(image):
+    # L 画像の累積和。table[y][x] は (0, 0)-(x, y) の矩形 (右下端を含まない) の合計
+    width, height = image.size; data = image.tobytes()
+    table = [[0] * (width + 1)]
+    for y in range(height):
+        above = table[-1]
+        table.append([0] + [a + b for a, b in zip(above[1:], accumulate(data[y * width:(y + 1) * width]))])
+    return table
+
+
+def window_sum(table, box):
+    x0, y0, x1, y1 = box
+    return table[y1][x1] - table[y0][x1] - table[y1][x0] + table[y0][x0]
+
+
+def best_window(table, window_size):
+    # 窓の合計が最大となる左上 (同程度なら中央に近い方)。窓は縮小画像上の画素単位
+    height = len(table) - 1; width = len(table[0]) - 1
+    win_w = min(width, window_size[0]); win_h = min(height, window_size[1])
+    center_x = (width - win_w) / 2; center_y = (height - win_h) / 2
+    bias = CENTER_BIAS * max(1, table[height][width])
+    best = None; best_score = None
+    for y in range(height - win_h + 1):
+        row_top = table[y]; row_bottom = table[y + win_h]
+        for x in range(width - win_w + 1):
+            score = row_bottom[x + win_w] - row_top[x + win_w] - row_bottom[x] + row_top[x] - bias * (abs(x - center_x) + abs(y - center_y))
+            if best_score is None or score > best_score: best = (x, y); best_score = score
+    return best
+
+
+@timing.timed("smartcrop")
+def suggest_crop_box(image, aspect_tuple, proxy=None, max_side=SALIENCY_MAX_SIDE):
+    # image の座標での切り抜き範囲 (指定比率で最大のサイズ)。
+    # proxy (image を縮小した表示用画像や縮小デコード結果) を渡すと目立ち度はそちらから求め、image はサイズしか使わない
+    full_box = core.compute_center_crop_box(image.size, aspect_tuple)
+    crop_w = full_box[2] - full_box[0]; crop_h = full_box[3] - full_box[1]
+    if (crop_w, crop_h) == tuple(image.size): return full_box
+    saliency = saliency_map(proxy if proxy is not None else image, max_side)
+    scale_x = saliency.width / image.width; scale_y = saliency.height / image.height
+    x, y = best_window(summed_area_table(saliency), (max(1, round(crop_w * scale_x)), max(1, round(crop_h * scale_y))))
+    left = max(0, min(image.width - crop_w, round(x / scale_x))); top = max(0, min(image.height - crop_h, round(y / scale_y)))
+    return left, top, left + crop_w, top + crop_h
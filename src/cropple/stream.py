@@ -0,0 +1,132 @@
+from PIL import Image, ImageChops
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from . import core, encode, timing
+
+# 巨大な画像 (パノラマ・スキャンなど) 向けの、拡張結果を帯ごとに書き出す保存処理。
+# core.extend_strips で出力を上から数百行ずつ作り、PNG はその場で圧縮して書き込む。
+# JPEG (と透過付き TIFF) は帯を生の画素ファイルへ追記してからメモリマップし、エンコーダにはマップ上の画像を渡す。
+# 常駐するのは元画像・余白用の縮小ぼかし素材・1帯分の作業領域だけで、作業領域は memory_budget_mb に収める。
+
+DEFAULT_MEMORY_BUDGET_MB = core.DEFAULT_MEMORY_BUDGET_MB
+MIN_STRIP_ROWS = 16
+STRIP_BYTES_PER_PIXEL = 24 # 帯・元画像の切り出し・余白・フィルタ済みの行などを合わせた1画素あたりの概算
+PNG_COLOR_TYPES = {"L": 0, "LA": 4, "RGB": 2, "RGBA": 6}
+RELEASE_STEP_BYTES = 64 * 1024 # マップ済みページを手放す間隔 (出力バイト数)
+
+
+def extended_size(size, aspect_tuple, position="center"):
+    layout = core.compute_extend_layout(size, aspect_tuple, position)
+    return (layout[0], layout[1]) if layout else tuple(size)
+
+
+def should_stream(size, aspect_tuple, position="center", memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    # 一括で作った場合の出力画像 (Pillow 内部は1画素4バイト) が予算を超えるなら帯ごとに書き出す
+    if not aspect_tuple or not memory_budget_mb: return False
+    final_w, final_h = extended_size(size, aspect_tuple, position)
+    return final_w * final_h * 4 > memory_budget_mb * 1024 * 1024
+
+
+def strip_rows_for(width, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    return max(MIN_STRIP_ROWS, int(memory_budget_mb * 1024 * 1024) // max(1, width * STRIP_BYTES_PER_PIXEL))
+
+
+def _check_cancel(cancel_event):
+    if cancel_event is not None and cancel_event.is_set(): raise encode.SaveCancelled()
+
+
+def _write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data))); f.write(chunk_type); f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+
+def _png_rows(strip, previous_row, filter_type):
+    # 帯を PNG の行データ (行頭にフィルタ種別の1バイト) にする。filter_type 2 (Up) は真上の行との差分
+    width, rows = strip.size
+    if filter_type == 2:
+        above = Image.new(strip.mode, strip.size)
+        if previous_row is not None: above.paste(previous_row, (0, 0))
+        if rows > 1: above.paste(strip.crop((0, 0, width, rows - 1)), (0, 1))
+        strip = ImageChops.subtract_modulo(strip, above)
+    data = strip.tobytes()
+    row_bytes = len(data) // rows
+    out = bytearray(rows * (row_bytes + 1))
+    for row in range(rows):
+        start = row * (row_bytes + 1)
+        out[start] = filter_type
+        out[start + 1:start + 1 + row_bytes] = data[row * row_bytes:(row + 1) * row_bytes]
+    return out
+
+
+def write_png_strips(f, size, mode, strips, compress_level=6, cancel_event=None):
+    # (y, 帯画像) を上から順に受け取り、1本の zlib ストリームとして IDAT に書き出す
+    f.write(b"\x89PNG\r\n\x1a\n")
+    _write_png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, PNG_COLOR_TYPES[mode], 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    filter_type = 2 if compress_level > 0 else 0
+    previous_row = None
+    for _, strip in strips:
+        _check_cancel(cancel_event)
+        data = compressor.compress(_png_rows(strip, previous_row, filter_type))
+        if data: _write_png_chunk(f, b"IDAT", data)
+        previous_row = strip.crop((0, strip.height - 1, strip.width, strip.height))
+    _write_png_chunk(f, b"IDAT", compressor.flush())
+    _write_png_chunk(f, b"IEND", b"")
+
+
+def _map_mode(mode, image_format):
+    # メモリマップできて (1画素1または4バイト)、エンコーダが変換せずに受け取れるモード。なければ None
+    if mode == "L" and image_format in ("JPEG", "TIFF"): return "L"
+    if image_format == "JPEG": return "RGBX"
+    if image_format == "TIFF" and 'A' in mode: return "RGBA"
+    return None
+
+
+def _save_mapped(strips, size, map_mode, save_path, encoder_settings, progress, cancel_event):
+    # 帯を保存先と同じディレクトリの一時ファイルへ生の画素として追記し、メモリマップしてエンコードする。
+    # マップしたページはファイルに裏付けられているので、エンコード中も定期的に手放して RSS を抑える
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(save_path))) as raw:
+        for _, strip in strips:
+            _check_cancel(cancel_event)
+            raw.write((strip if strip.mode == map_mode else strip.convert(map_mode)).tobytes())
+        raw.flush()
+        mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        released = [0]
+        def on_progress(bytes_written):
+            if hasattr(mapped, 'madvise') and bytes_written - released[0] >= RELEASE_STEP_BYTES:
+                mapped.madvise(mmap.MADV_DONTNEED); released[0] = bytes_written
+            if progress: progress(bytes_written)
+        try:
+            image = Image.frombuffer(map_mode, size, mapped, "raw", map_mode, 0, 1)
+            encode.save_image(image, save_path, encoder_settings, on_progress, cancel_event)
+            del image
+        finally:
+            # 例外のトレースバックが画像を参照している間は閉じられない (その場合は GC に任せる)
+            try: mapped.close()
+            except BufferError: pass
+    return save_path
+
+
+@timing.timed("stream")
+def save_extended(source_image, save_path, aspect_tuple, blur_radius_val=core.DEFAULT_BLUR_RADIUS, position="center", encoder_settings=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                  progress=None, cancel_event=None, fill_mode="blur"):
+    # core.extend_image + encode.save_image と同じ結果を、出力全体を確保せずに保存する
+    size = extended_size(source_image.size, aspect_tuple, position)
+    strips = core.extend_strips(source_image, aspect_tuple, blur_radius_val, position, strip_rows_for(size[0], memory_budget_mb), fill_mode)
+    image_format = encode.image_format_for(save_path, 'PNG')
+    if image_format == "PNG" and source_image.mode in PNG_COLOR_TYPES:
+        compress_level = int(encode.encoder_settings_from(encoder_settings or {})['png_compress_level'])
+        with encode.atomic_output(save_path) as tmp_path, open(tmp_path, 'wb') as raw:
+            write_png_strips(encode.ProgressFile(raw, progress, cancel_event), size, source_image.mode, strips, compress_level, cancel_event)
+        return save_path
+    map_mode = _map_mode(source_image.mode, image_format)
+    if map_mode is not None: return _save_mapped(strips, size, map_mode, save_path, encoder_settings, progress, cancel_event)
+    # WebP などエンコーダが変換済みの全画素を要求する形式は、出力1枚分だけ確保して保存する
+    extended = Image.new(source_image.mode, size)
+    for y, strip in strips:
+        _check_cancel(cancel_event); extended.paste(strip, (0, y))
+    return encode.save_image(extended, save_path, encoder_settings, progress, cancel_event)
@@ -0,0 +1,131 @@
+from collections import deque
+import functools
+import json
+import os
+import threading
+import time
+
+# 処理段階ごとの計測。stage("encode") の with ブロックや @timed("resize") を付けた関数の所要時間を測り、
+# 入れ子の一番外側 (ボタン操作1回など) を「操作」として、直下の段階ごとの内訳を last_operation で返す。
+# record=True のときは Chrome のトレース形式 (chrome://tracing, Perfetto) で書き出せるよう区間も記録する。
+# 無効時の stage は共有の何もしないコンテキストマネージャを返すだけなので、常に組み込んだままでよい。
+
+MAX_EVENTS = 20000 # 記録する区間の上限 (古いものから捨てる)
+
+STAGE_LABELS = {
+    "decode": "デコード", "draft": "縮小デコード", "resize": "縮小", "proxy": "プレビュー縮小",
+    "blur": "ぼかし", "fill": "余白", "extend": "拡張", "rotate": "回転", "geometry": "回転・切り抜き",
+    "encode": "エンコード", "stream": "分割書き出し", "lossless": "可逆変換", "frames": "全フレーム", "smartcrop": "おすすめ範囲", "refine": "高画質化", "prefetch": "先読み",
+    "spill": "一時ファイルへ退避", "fault": "読み戻し",
+    "startup": "起動", "load": "画像読み込み", "render": "再描画", "preview": "プレビュー", "save": "保存", "process": "画像処理",
+}
+
+_enabled = False
+_recording = False
+_events = deque(maxlen=MAX_EVENTS) # (名前, 開始[秒], 所要時間[秒], pid, tid, args)
+_local = threading.local()
+_lock = threading.Lock()
+_last_operation = None # (通し番号, 名前, 所要時間[秒], [(段階名, 合計秒), ...])
+_operation_count = 0
+_EPOCH_OFFSET = time.time() - time.perf_counter() # プロセスをまたいで並べられるよう壁時計に揃える
+
+
+def configure(enabled=True, record=False):
+    global _enabled, _recording
+    _enabled = bool(enabled or record); _recording = bool(record)
+
+
+def is_enabled():
+    return _enabled
+
+
+class _NullSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc_info): return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "args", "start", "children")
+
+    def __init__(self, name, args):
+        self.name = name; self.args = args; self.children = {}
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None: stack = _local.stack = []
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        stack = _local.stack; stack.pop()
+        if stack: parent = stack[-1]; parent.children[self.name] = parent.children.get(self.name, 0.0) + duration
+        else: _finish_operation(self.name, duration, list(self.children.items()))
+        if _recording: _events.append((self.name, self.start + _EPOCH_OFFSET, duration, os.getpid(), threading.get_ident(), self.args))
+        return False
+
+
+def stage(name, **args):
+    # with stage("blur", radius=70): ... 。args はトレースにだけ残る
+    if not _enabled: return _NULL_SPAN
+    return _Span(name, args or None)
+
+
+def timed(name):
+    # 関数全体を stage(name) で囲むデコレータ
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled: return func(*args, **kwargs)
+            with _Span(name, None): return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _finish_operation(name, duration, children):
+    global _last_operation, _operation_count
+    with _lock:
+        _operation_count += 1
+        _last_operation = (_operation_count, name, duration, children)
+
+
+def last_operation():
+    # 直近に終わった操作 (どのスレッドでもよい)。GUI は通し番号の変化を見て表示を更新する
+    return _last_operation
+
+
+def format_operation(operation):
+    # "保存 1.23s (拡張 0.41s / エンコード 0.78s)"
+    if not operation: return ""
+    _, name, duration, children = operation
+    text = f"{STAGE_LABELS.get(name, name)} {duration:.2f}s"
+    if children: text += " (" + " / ".join(f"{STAGE_LABELS.get(child, child)} {seconds:.2f}s" for child, seconds in children) + ")"
+    return text
+
+
+def events():
+    return list(_events)
+
+
+def add_events(new_events):
+    # 別プロセス (バッチのワーカーなど) で記録した区間を取り込む
+    _events.extend(tuple(event) for event in new_events)
+
+
+def reset():
+    global _last_operation
+    _events.clear(); _last_operation = None
+
+
+def export_chrome_trace(path, trace_events=None):
+    # Chrome のトレースイベント形式 (完了イベント "X", 時刻はマイクロ秒)
+    trace = {'displayTimeUnit': "ms", 'traceEvents': [
+        dict({'name': name, 'cat': "cropple", 'ph': "X", 'ts': round(start * 1e6, 1), 'dur': round(duration * 1e6, 1), 'pid': pid, 'tid': tid},
+             **({'args': args} if args else {}))
+        for name, start, duration, pid, tid, args in (events() if trace_events is None else trace_events)]}
+    with open(path, 'w') as f: json.dump(trace, f)
+    return len(trace['traceEvents'])
@@ -0,0 +1,194 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from . import batch, core, stream
+
+# 監視フォルダに置かれた画像を、保存済みの設定で次々に処理し続ける常駐モード (cropple watch)。
+# Linux では inotify で「書き込みを終えて閉じた」「別の場所から移動してきた」ファイルだけを拾う。
+# それ以外の環境 (または inotify が使えない場合) はディレクトリを定期的に走査し、
+# サイズと更新時刻が走査2回分変わらず、settle 秒以上経ったファイルを書き込み完了とみなす。
+# 処理は batch.process_file をプロセスプールで実行し、処理待ち (投入済み) の件数は queue_limit までに抑える。
+# 上限に達している間は新しいファイルを読みに行かない (inotify のイベントはカーネル側に溜まり、溢れたら走査し直す)。
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len (この後に len バイトのファイル名)
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_REPORT_INTERVAL = 30.0
+
+
+def _is_image_name(name):
+    # 隠しファイル・書き込み途中の一時ファイル (xxx.png.1234.part など) は拡張子で除かれる
+    return not name.startswith(".") and name.lower().endswith(core.IMAGE_EXTENSIONS)
+
+
+def scan_images(directories):
+    paths = []
+    for directory in directories:
+        try: names = sorted(os.listdir(directory))
+        except OSError: continue
+        paths.extend(os.path.join(directory, name) for name in names if _is_image_name(name) and os.path.isfile(os.path.join(directory, name)))
+    return paths
+
+
+class InotifyWatcher:
+    # 書き込みを終えたファイルだけを返す (IN_CLOSE_WRITE / IN_MOVED_TO)。Linux 以外では OSError
+    def __init__(self, directories):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libc_name: raise OSError("inotify is not available")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        for directory in directories:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0: errno = ctypes.get_errno(); self.close(); raise OSError(errno, f"inotify_add_watch failed: {directory}")
+            self._directories[wd] = directory
+
+    def poll(self, timeout):
+        if not select.select([self._fd], [], [], timeout)[0]: return []
+        try: data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError: return []
+        paths = []; offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0")); offset += name_len
+            # 処理が追いつかずカーネルのキューが溢れた: 取りこぼしがあるので全体を走査し直す
+            if mask & IN_Q_OVERFLOW: return scan_images(self._directories.values())
+            if wd in self._directories and _is_image_name(name): paths.append(os.path.join(self._directories[wd], name))
+        return paths
+
+    def close(self):
+        if self._fd >= 0: os.close(self._fd); self._fd = -1
+
+
+class PollingWatcher:
+    # 定期的な走査で、サイズと更新時刻が落ち着いたファイルを返す
+    def __init__(self, directories, interval=DEFAULT_POLL_INTERVAL, settle_seconds=DEFAULT_SETTLE_SECONDS, include_existing=False):
+        self._directories = list(directories); self._interval = interval; self._settle_seconds = settle_seconds
+        self._previous = {}; self._reported = {}
+        if not include_existing: self._reported = self._scan()
+
+    def _scan(self):
+        signatures = {}
+        for path in scan_images(self._directories):
+            try: st = os.stat(path)
+            except OSError: continue
+            signatures[path] = (st.st_size, st.st_mtime_ns)
+        return signatures
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self._interval))
+        current = self._scan(); now_ns = time.time_ns(); paths = []
+        for path, signature in current.items():
+            if self._reported.get(path) == signature or self._previous.get(path) != signature: continue
+            if now_ns - signature[1] < self._settle_seconds * 1e9: continue
+            self._reported[path] = signature; paths.append(path)
+        self._previous = current
+        return paths
+
+    def close(self): pass
+
+
+def open_watcher(directories, use_polling=False, interval=DEFAULT_POLL_INTERVAL, settle_seconds=DEFAULT_SETTLE_SECONDS, include_existing=False, log=print):
+    # 戻り値: (watcher, 起動時に処理するパスのリスト)
+    if not use_polling:
+        try: return InotifyWatcher(directories), (scan_images(directories) if include_existing else [])
+        except (OSError, AttributeError) as e: log(f"inotify を使えないため定期走査で監視します: {e}")
+    return PollingWatcher(directories, interval, settle_seconds, include_existing), []
+
+
+def _is_up_to_date(src_path, dst_path):
+    try: return os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+    except OSError: return False
+
+
+def watch(directories, output_dir, settings, mode="extend", quarter_turns=0, rotation_angle=0.0, output_format="png", suffix="", workers=None, queue_limit=None,
+          overwrite=False, memory_budget_mb=None, use_polling=False, poll_interval=DEFAULT_POLL_INTERVAL, settle_seconds=DEFAULT_SETTLE_SECONDS,
+          include_existing=False, report_interval=DEFAULT_REPORT_INTERVAL, stop_event=None, log=print):
+    # stop_event (threading.Event など) がセットされるか Ctrl+C で終了する。戻り値: (成功数, 失敗リスト[(path, error)])
+    os.makedirs(output_dir, exist_ok=True)
+    workers = max(1, workers or os.cpu_count() or 1); queue_limit = max(workers, queue_limit or workers * 2)
+    watcher, pending = open_watcher(directories, use_polling, poll_interval, settle_seconds, include_existing, log)
+    pending = deque(pending); in_flight = {}
+    done = 0; failures = []; started = last_report = time.perf_counter(); done_at_report = 0
+
+    def collect(futures):
+        nonlocal done
+        for future in futures:
+            src = in_flight.pop(future)
+            try: _, dst, elapsed = future.result(); done += 1; log(f"{src} -> {dst} ({elapsed:.2f}s)")
+            except Exception as e: failures.append((src, e)); log(f"失敗: {src}: {e}")
+
+    log(f"監視を開始しました: {', '.join(directories)} -> {output_dir} ({workers} workers, 待ち上限 {queue_limit}件)")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            try:
+                while stop_event is None or not stop_event.is_set():
+                    collect([future for future in in_flight if future.done()])
+                    while pending and len(in_flight) < queue_limit:
+                        src = pending.popleft()
+                        if src in in_flight.values(): continue
+                        dst = batch.build_output_path(src, output_dir, output_format, suffix)
+                        if not overwrite and _is_up_to_date(src, dst): continue
+                        in_flight[executor.submit(batch.process_file, src, dst, settings, mode, quarter_turns, rotation_angle, memory_budget_mb)] = src
+                    now = time.perf_counter()
+                    if report_interval and now - last_report >= report_interval:
+                        log(f"処理済み {done}件 (失敗 {len(failures)}件), 直近 {(done - done_at_report) / (now - last_report):.2f} images/s, 処理中 {len(in_flight)}件, 待ち {len(pending)}件")
+                        last_report = now; done_at_report = done
+                    # 上限まで投入済みなら新しいファイルは読まずに完了を待つ (背圧)
+                    if len(in_flight) >= queue_limit: collect(wait(list(in_flight), timeout=poll_interval, return_when=FIRST_COMPLETED).done); continue
+                    pending.extend(watcher.poll(poll_interval))
+            except KeyboardInterrupt: log("停止します。処理中の画像が終わるのを待っています...")
+            collect(wait(list(in_flight)).done)
+    finally: watcher.close()
+    total = time.perf_counter() - started
+    log(f"終了: {done}件成功, {len(failures)}件失敗, {total:.1f}s ({done / total if total > 0 else 0:.2f} images/s)")
+    return done, failures
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cropple watch", description="フォルダを監視し、置かれた画像を保存済みの設定で処理し続けます。")
+    parser.add_argument("directories", nargs="+", help="監視するディレクトリ (サブディレクトリは監視しない)")
+    parser.add_argument("-o", "--output-dir", required=True, help="出力ディレクトリ (監視するディレクトリとは別にする)")
+    batch.add_processing_arguments(parser)
+    parser.add_argument("--format", choices=sorted(batch.OUTPUT_FORMATS), default="png", help="出力形式 (same は入力と同じ拡張子)")
+    parser.add_argument("--suffix", default="", help="出力ファイル名に付ける接尾辞")
+    parser.add_argument("-j", "--workers", type=int, help="ワーカープロセス数 (既定: CPU コア数)")
+    parser.add_argument("--queue-limit", type=int, help="同時に投入する画像数の上限 (既定: ワーカー数の2倍)")
+    parser.add_argument("--existing", action="store_true", help="起動時に既にある画像も処理する")
+    parser.add_argument("--overwrite", action="store_true", help="入力より新しい出力があっても処理し直す")
+    parser.add_argument("--poll", action="store_true", help="inotify を使わず定期走査で監視する")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="走査・状態確認の間隔 (秒)")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS, help="定期走査時、更新が止まってから処理するまでの秒数")
+    parser.add_argument("--report-interval", type=float, default=DEFAULT_REPORT_INTERVAL, help="処理速度を表示する間隔 (秒, 0 で表示しない)")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help=f"拡張後の画像がこれを超える場合は帯ごとに書き出して作業メモリを抑える (目安: {stream.DEFAULT_MEMORY_BUDGET_MB})")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try: settings = batch.apply_cli_overrides(batch.load_settings_file(args.settings), args)
+    except (OSError, ValueError) as e: print(f"設定エラー: {e}", file=sys.stderr); return 2
+    missing = [d for d in args.directories if not os.path.isdir(d)]
+    if missing: print(f"ディレクトリが見つかりません: {', '.join(missing)}", file=sys.stderr); return 2
+    if any(os.path.abspath(d) == os.path.abspath(args.output_dir) for d in args.directories):
+        print("出力ディレクトリは監視するディレクトリと別にしてください。", file=sys.stderr); return 2
+    watch(args.directories, args.output_dir, settings, args.mode, args.rotate90, args.angle, args.format, args.suffix, args.workers, args.queue_limit,
+          args.overwrite, args.memory_budget, args.poll, args.poll_interval, args.settle, args.existing, args.report_interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
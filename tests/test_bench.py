@@ -0,0 +1,44 @@
+import json
+import os
+
+from cropple import bench
+
+
+def _baseline(**results):
+    return {'results': {case_id: {'seconds': seconds, 'peak_mb': peak_mb} for case_id, (seconds, peak_mb) in results.items()}}
+
+
+def test_compare_time_tolerance():
+    baseline = _baseline(a=(1.0, None), b=(0.001, None))
+    limit = 1.0 * 1.25 + bench.TIME_SLACK_SECONDS
+    assert bench.compare_results({'a': {'seconds': limit - 1e-6, 'peak_mb': None}}, baseline) == []
+    regressions = bench.compare_results({'a': {'seconds': limit + 1e-3, 'peak_mb': None}}, baseline)
+    assert len(regressions) == 1 and regressions[0].startswith("a: 時間")
+    assert bench.compare_results({'a': {'seconds': 1.6, 'peak_mb': None}}, baseline, tolerance=0.7) == []
+    # 短いケースは計測誤差の分だけ余裕を持たせる
+    assert bench.compare_results({'b': {'seconds': 0.001 + bench.TIME_SLACK_SECONDS * 0.9, 'peak_mb': None}}, baseline) == []
+
+
+def test_compare_memory_tolerance():
+    baseline = _baseline(a=(1.0, 100.0))
+    limit = 100.0 * 1.25 + bench.MEMORY_SLACK_MB
+    assert bench.compare_results({'a': {'seconds': 1.0, 'peak_mb': limit - 0.1}}, baseline) == []
+    regressions = bench.compare_results({'a': {'seconds': 1.0, 'peak_mb': limit + 0.1}}, baseline)
+    assert len(regressions) == 1 and regressions[0].startswith("a: メモリ")
+    assert bench.compare_results({'a': {'seconds': 1.0, 'peak_mb': 150.0}}, baseline, memory_tolerance=0.5) == []
+    # どちらかでピークメモリを計測していなければ時間だけを比べる
+    assert bench.compare_results({'a': {'seconds': 1.0, 'peak_mb': None}}, baseline) == []
+    assert [message.split(" ")[1] for message in bench.compare_results({'a': {'seconds': 2.0, 'peak_mb': 500.0}}, baseline)] == ["時間", "メモリ"]
+
+
+def test_compare_skips_unknown_cases():
+    assert bench.compare_results({'new': {'seconds': 100.0, 'peak_mb': 100.0}}, _baseline(a=(1.0, 1.0))) == []
+
+
+def test_committed_baseline_covers_default_cases():
+    # 既定の計測ケースはすべて、リポジトリのベースラインと比較される
+    with open(bench.DEFAULT_BASELINE_PATH) as f: baseline = json.load(f)
+    cases = bench.build_cases() + bench.build_startup_cases()
+    assert {case[0] for case in cases} <= set(baseline['results'])
+    assert bench.build_parser().parse_args([]).baseline == bench.DEFAULT_BASELINE_PATH
+    assert os.path.isfile(bench.DEFAULT_BASELINE_PATH)
@@ -0,0 +1,36 @@
+from PIL import Image
+
+from cropple import buffers
+
+
+def _image(mode, size=(64, 64)):
+    return Image.new(mode, size)
+
+
+def test_held_buffer_is_not_spilled():
+    pool = buffers.BufferPool(budget_bytes=0)
+    held = _image("RGB"); pinned = pool.register(held); pool.hold(held)
+    other = _image("RGB"); released = pool.register(other) # 使う側が参照していても hold しなければ退避する
+    pool.register(_image("RGB"))
+    assert not pinned.is_spilled and released.is_spilled
+    assert pool.resident_bytes() == 2 * 64 * 64 * 3
+    # hold を置き換えると、前に持っていた画像は退避できる
+    pool.hold(pool.register(_image("RGB")).get())
+    assert pinned.is_spilled
+    restored = released.get(); pool.hold(restored)
+    pool.register(_image("RGB")); pool.register(_image("RGB"))
+    assert not released.is_spilled and released.peek() is restored
+    released.release(); pool.hold()
+    assert pool.resident_bytes() == 64 * 64 * 3 # 直近の1枚だけ
+
+
+def test_fault_in_restores_pixels():
+    for mode in ("L", "LA", "RGB", "RGBA"):
+        pool = buffers.BufferPool(budget_bytes=0)
+        image = Image.effect_noise((32, 16), 64).convert(mode); expected = image.tobytes()
+        buffer = pool.register(image); del image
+        pool.register(_image(mode))
+        assert buffer.is_spilled
+        restored = buffer.get()
+        assert restored.mode == mode and restored.tobytes() == expected
+        assert restored.readonly == (mode in buffers.MAPPED_MODES) # mmap を共有するのは MAPPED_MODES だけ
@@ -0,0 +1,74 @@
+from PIL import Image
+import pytest
+
+from cropple import core, edits
+
+
+@pytest.mark.parametrize("mode", ["L", "LA", "RGB", "RGBA"])
+@pytest.mark.parametrize("fill_mode", core.EXTEND_FILL_MODES)
+def test_extend_keeps_mode(mode, fill_mode):
+    image = Image.effect_noise((120, 80), 40).convert(mode)
+    extended = core.extend_image(image, (1, 1), 10, "center", fill_mode=fill_mode)
+    assert extended.mode == mode and extended.size == (120, 120)
+    strips = list(core.extend_strips(image, (1, 1), 10, "center", strip_rows=16, fill_mode=fill_mode))
+    assert sum(strip.height for _, strip in strips) == 120 and all(strip.mode == mode for _, strip in strips)
+
+
+@pytest.mark.parametrize("mode", ["L", "LA"])
+def test_grayscale_rotate_and_process(mode):
+    image = Image.effect_noise((120, 80), 40).convert(mode)
+    rotated = core.rotate_free(image, 12, "color", "#ffffff")
+    assert rotated.mode == mode and rotated.getpixel((0, 0)) in (255, (255, 255))
+    assert edits.process_image(image, dict(core.DEFAULT_SETTINGS), "extend", 1, 7.5).mode == mode
+
+
+def test_fill_color_for_mode():
+    assert core.fill_color_for_mode("L", (200, 200, 200)) == 200
+    assert core.fill_color_for_mode("LA", (0, 0, 0), 0) == (0, 0)
+    assert core.fill_color_for_mode("RGBA", (1, 2, 3)) == (1, 2, 3, 255)
+    assert core.fill_color_for_mode("RGB", (1, 2, 3)) == (1, 2, 3)
+
+
+def _extend(fill_mode, aspect, position="center", mode="RGB"):
+    image = Image.effect_noise((60, 40), 80).convert(mode)
+    return image, core.extend_image(image, aspect, 10, position, fill_mode=fill_mode)
+
+
+def test_mirror_fill():
+    # 余白は端の帯を折り返したもの (余白に接する行・列は端の行・列と同じ)
+    image, extended = _extend("mirror", (1, 1)) # 上下に 10 行ずつ
+    assert extended.crop((0, 0, 60, 10)).tobytes() == image.crop((0, 0, 60, 10)).transpose(core.FLIP_TOP_BOTTOM).tobytes()
+    assert extended.crop((0, 50, 60, 60)).tobytes() == image.crop((0, 30, 60, 40)).transpose(core.FLIP_TOP_BOTTOM).tobytes()
+    assert extended.crop((0, 9, 60, 10)).tobytes() == image.crop((0, 0, 60, 1)).tobytes()
+    image, extended = _extend("mirror", (2, 1), "left") # 右に 20 列
+    assert extended.crop((60, 0, 80, 40)).tobytes() == image.crop((40, 0, 60, 40)).transpose(core.FLIP_LEFT_RIGHT).tobytes()
+    assert extended.crop((60, 0, 61, 40)).tobytes() == image.crop((59, 0, 60, 40)).tobytes()
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_stretch_fill(mode):
+    # 余白のどの行 (列) も、端の1画素の行 (列) と同じ
+    image, extended = _extend("stretch", (1, 1), mode=mode)
+    for y in list(range(10)) + list(range(50, 60)):
+        edge = 0 if y < 10 else 39
+        assert extended.crop((0, y, 60, y + 1)).tobytes() == image.crop((0, edge, 60, edge + 1)).tobytes()
+    image, extended = _extend("stretch", (2, 1), "right") # 左に 20 列
+    for x in range(20): assert extended.crop((x, 0, x + 1, 40)).tobytes() == image.crop((0, 0, 1, 40)).tobytes()
+
+
+def test_mean_fill():
+    # 上下の余白の各列 (左右の余白は各行) は一定の色で、その列 (行) の端の帯 (余白の半分の厚み) の平均
+    image, extended = _extend("mean", (1, 1), "top") # 下に 20 行、帯は 10 行
+    pixels = image.load(); filled = extended.load()
+    for x in range(60):
+        column = {filled[x, y] for y in range(40, 60)}
+        assert len(column) == 1
+        expected = [sum(pixels[x, y][band] for y in range(30, 40)) / 10 for band in range(3)]
+        assert all(abs(value - mean) <= 0.5 + 1e-9 for value, mean in zip(column.pop(), expected))
+    image, extended = _extend("mean", (2, 1)) # 左右に 10 列、帯は 5 列
+    pixels = image.load(); filled = extended.load()
+    for y in range(40):
+        row = {filled[x, y] for x in range(10)}
+        assert len(row) == 1
+        expected = [sum(pixels[x, y][band] for x in range(5)) / 5 for band in range(3)]
+        assert all(abs(value - mean) <= 0.5 + 1e-9 for value, mean in zip(row.pop(), expected))
@@ -0,0 +1,98 @@
+from PIL import Image
+
+import pytest
+
+from cropple import core, display, loader
+
+
+def _noise(size):
+    return Image.effect_noise(size, 80).convert("RGB")
+
+
+def _assemble(tiles, image, scale, view_box, get):
+    # 見えているタイルを表示上の位置に並べ、view_box の範囲を切り出す
+    visible = tiles.visible_tiles(image, scale, view_box)
+    canvas = Image.new("RGB", tiles.view_size(image, scale))
+    for tx, ty in visible: canvas.paste(get(tx, ty).image, (tx * tiles.tile_size, ty * tiles.tile_size))
+    return visible, canvas.crop(view_box)
+
+
+@pytest.mark.parametrize("scale, view_box, source_box", [
+    (2.0, (300, 100, 900, 700), (150, 50, 450, 350)),
+    (0.5, (100, 60, 400, 300), (200, 120, 800, 600)),
+])
+def test_tiles_cover_visible_region(scale, view_box, source_box):
+    image = _noise((1000, 800))
+    tiles = display.TileCache(display.DisplayCache())
+    visible, shown = _assemble(tiles, image, scale, view_box, lambda tx, ty: tiles.get(image, scale, tx, ty))
+    # 作るのは view_box に掛かるタイルだけ
+    size = tiles.tile_size
+    assert all(tx * size < view_box[2] and (tx + 1) * size > view_box[0] and ty * size < view_box[3] and (ty + 1) * size > view_box[1] for tx, ty in visible)
+    region = image.crop(source_box)
+    expected = region.resize(shown.size, core.RESAMPLE_NEAREST) if scale >= 1.0 else region.reduce(2)
+    assert shown.tobytes() == expected.tobytes()
+
+
+def test_visible_tiles_clip_to_view():
+    image = _noise((300, 200))
+    tiles = display.TileCache(display.DisplayCache())
+    view_w, view_h = tiles.view_size(image, 2.0) # 600x400 -> 3x2 タイル
+    assert tiles.visible_tiles(image, 2.0, (-500, -500, 5000, 5000)) == [(tx, ty) for ty in range(2) for tx in range(3)]
+    assert tiles.visible_tiles(image, 2.0, (view_w - 1, view_h - 1, view_w + 100, view_h + 100)) == [(2, 1)]
+    assert tiles.visible_tiles(image, 0.1, (0, 0, 1000, 1000)) == [(0, 0)]
+
+
+def test_tile_cache_lru_cap():
+    assert display.MAX_TILES == 128
+    image = _noise((200, 200))
+    tiles = display.TileCache(display.DisplayCache(), tile_size=8)
+    keys = [(tx, ty) for ty in range(25) for tx in range(25)][:display.MAX_TILES + 2]
+    first = tiles.get(image, 1.0, *keys[0])
+    for tx, ty in keys[1:display.MAX_TILES]: tiles.get(image, 1.0, tx, ty)
+    assert tiles.get(image, 1.0, *keys[0]) is first # 使ったタイルは最近使ったものとして残る
+    for tx, ty in keys[display.MAX_TILES:]: tiles.get(image, 1.0, tx, ty)
+    assert len(tiles._entries) == display.MAX_TILES
+    assert tiles._peek(image, 1.0, *keys[0]) is first
+    assert tiles._peek(image, 1.0, *keys[1]) is None and tiles._peek(image, 1.0, *keys[2]) is None
+
+
+@pytest.fixture
+def jpeg(tmp_path):
+    path = str(tmp_path / "photo.jpg"); _noise((2048, 1536)).save(path, quality=90)
+    return path
+
+
+@pytest.mark.parametrize("scale", [2.0, 0.5])
+def test_quick_tile_from_draft_keeps_image_undecoded(jpeg, scale):
+    image = loader.open_image(jpeg); draft = loader.open_draft(jpeg, (512, 384))
+    assert image._im is None and draft.size == (512, 384)
+    tiles = display.TileCache(display.DisplayCache())
+    entry = tiles.quick(image, scale, 1, 1, base=draft)
+    # 仮のタイルは縮小デコード版から作り、GUI のスレッドで全解像度のデコードを起こさない
+    assert image._im is None and entry.refine is not None and entry.image.size == (tiles.tile_size, tiles.tile_size)
+    refined = entry.refine()
+    assert refined.refine is None and tiles.quick(image, scale, 1, 1, base=draft) is refined
+    # 本来のタイルは仮のタイルを経由しない場合と同じ画素 (拡大は NEAREST、縮小はミップマップから LANCZOS)
+    size = tiles.tile_size; view = tiles.view_size(image, scale)
+    full = image.resize(view, core.RESAMPLE_NEAREST) if scale >= 1.0 else image.reduce(2)
+    assert refined.image.tobytes() == full.crop((size, size, 2 * size, 2 * size)).tobytes()
+
+
+def test_quick_tile_without_smaller_source_is_exact():
+    # 縮小版がなければ (デコード済みの画像なので) 本来のタイルをそのまま返す
+    image = _noise((300, 200))
+    tiles = display.TileCache(display.DisplayCache())
+    entry = tiles.quick(image, 2.0, 0, 0)
+    assert entry.refine is None and tiles.quick(image, 2.0, 0, 0) is entry
+    assert entry.image.tobytes() == image.resize((600, 400), core.RESAMPLE_NEAREST).crop((0, 0, 256, 256)).tobytes()
+
+
+def test_display_quick_refines_to_lanczos():
+    image = _noise((1000, 800)); cache = display.DisplayCache()
+    entry = cache.quick(image, (300, 240))
+    assert entry.refine is not None and cache.peek(image, (300, 240)) is None # 仮のエントリはキャッシュしない
+    assert entry.image.tobytes() == image.resize((300, 240), core.RESAMPLE_NEAREST).tobytes()
+    refined = entry.refine()
+    assert refined.refine is None and cache.quick(image, (300, 240)) is refined
+    level = image.reduce(2) # 300x240 以上で最小の段
+    assert refined.image.tobytes() == level.resize((300, 240), core.RESAMPLE_LANCZOS).tobytes()
@@ -0,0 +1,45 @@
+import random
+
+from PIL import Image
+
+from cropple import edits
+
+FILL = (255, 0, 0)
+
+
+def _sequential(image, ops):
+    # まとめずに1操作ずつ描画した結果 (まとめた描画の基準)
+    for op in ops: image = edits.apply_op(image, op)
+    return image
+
+
+def _fill_pixels(image):
+    return sum(count for count, color in image.getcolors(image.width * image.height) if color == FILL)
+
+
+def test_crop_then_rotate_fills_corners():
+    image = Image.new("RGB", (400, 300), (0, 0, 255))
+    ops = [("crop", (100, 50, 300, 250)), ("rotate", 10.0, "color", "#ff0000")]
+    folded = edits.render_ops(image, ops); sequential = _sequential(image, ops)
+    assert folded.size == sequential.size
+    assert _fill_pixels(folded) == _fill_pixels(sequential) > 0
+
+
+def test_folded_geometry_matches_sequential():
+    # 単色の画像で、余白になる画素の数が1操作ずつ描画した場合と (補間される境界を除いて) 一致すること
+    rng = random.Random(6)
+    image = Image.new("RGB", (160, 120), (0, 0, 255))
+    for _ in range(200):
+        ops = []
+        for _ in range(rng.randint(1, 4)):
+            kind = rng.choice(("transpose", "rotate", "crop"))
+            if kind == "transpose": ops.append(("transpose", rng.randint(1, 3)))
+            elif kind == "rotate": ops.append(("rotate", round(rng.uniform(-45, 45), 1), "color", "#ff0000"))
+            else:
+                width, height = edits.geometry_output_size(image.size, ops)
+                left = rng.randint(0, width // 2); top = rng.randint(0, height // 2)
+                ops.append(("crop", (left, top, rng.randint(left + 1, width), rng.randint(top + 1, height))))
+        folded = edits.render_ops(image, ops); sequential = _sequential(image, ops)
+        assert folded.size == sequential.size, ops
+        border = 4 * (folded.width + folded.height)
+        assert abs(_fill_pixels(folded) - _fill_pixels(sequential)) <= border, ops
@@ -0,0 +1,36 @@
+from PIL import Image
+import os
+import threading
+
+import pytest
+
+from cropple import core, encode, export
+
+RATIOS = [(1, 1), (4, 5), (16, 9), (9, 16), (100, 191), (3, 1)]
+
+
+@pytest.mark.parametrize("fill_mode", core.EXTEND_FILL_MODES)
+@pytest.mark.parametrize("position", ["center", "top", "right"])
+@pytest.mark.parametrize("blur_radius", [0, 6, 40])
+def test_export_set_matches_extend_image(tmp_path, fill_mode, position, blur_radius):
+    # 余白の素材を比率間で共有しても、比率ごとに単独で extend_image した結果と同じ画素になること
+    image = Image.effect_noise((300, 200), 80).convert("RGB")
+    targets = [(ratio, str(tmp_path / f"{ratio[0]}x{ratio[1]}.png")) for ratio in RATIOS]
+    assert export.export_set(image, targets, blur_radius, position, workers=2, fill_mode=fill_mode) == [path for _, path in targets]
+    for ratio, path in targets:
+        expected = core.extend_image(image, ratio, blur_radius, position, fill_mode=fill_mode)
+        with Image.open(path) as saved: assert saved.tobytes() == expected.tobytes(), ratio
+
+
+def test_cancelled_export_leaves_nothing(tmp_path):
+    image = Image.effect_noise((300, 200), 80).convert("RGB")
+    targets = [(ratio, str(tmp_path / f"{ratio[0]}x{ratio[1]}.png")) for ratio in RATIOS]
+    cancel_event = threading.Event()
+    # 最初の書き込みでキャンセルする (書き込み途中のファイルも、まだ始まっていない比率も残らない)
+    with pytest.raises(encode.SaveCancelled):
+        export.export_set(image, targets, 6, workers=1, progress=lambda n: cancel_event.set(), cancel_event=cancel_event)
+    assert os.listdir(tmp_path) == []
+
+
+def test_export_paths():
+    assert export.export_paths("out/photo.png", ["1:1", "1:1.91"]) == {"1:1": "out/photo_1x1.png", "1:1.91": "out/photo_1x1.91.png"}
@@ -0,0 +1,72 @@
+from PIL import Image
+import random
+import threading
+import time
+
+import pytest
+
+from cropple import batch, core, frames, loader
+
+COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+DURATIONS = [100, 200, 300]
+
+
+def _frames():
+    return [Image.new("RGB", (40, 30), color) for color in COLORS]
+
+
+def _read_frames(path):
+    with Image.open(path) as image:
+        result = []
+        for index in range(image.n_frames):
+            image.seek(index); result.append((image.convert("RGB").copy(), image.info.get('duration')))
+        return result, image.info.get('loop')
+
+
+def test_gif_round_trip(tmp_path):
+    src = str(tmp_path / "anim.gif"); dst = str(tmp_path / "out.gif")
+    first, *rest = _frames()
+    first.save(src, save_all=True, append_images=rest, duration=DURATIONS, loop=2)
+    batch.process_file(src, dst, dict(core.DEFAULT_SETTINGS, aspect_choice="1:1"), "crop")
+    saved, loop = _read_frames(dst)
+    assert loop == 2 and [duration for _, duration in saved] == DURATIONS
+    assert [frame.size for frame, _ in saved] == [(30, 30)] * 3
+    assert [frame.getpixel((15, 15)) for frame, _ in saved] == COLORS
+
+
+def test_tiff_round_trip(tmp_path):
+    src = str(tmp_path / "pages.tif"); dst = str(tmp_path / "out.tif")
+    first, *rest = _frames()
+    first.save(src, save_all=True, append_images=rest)
+    batch.process_file(src, dst, dict(core.DEFAULT_SETTINGS, aspect_choice="1:1", extend_fill="stretch"), "extend", 1)
+    saved, _ = _read_frames(dst)
+    assert [frame.size for frame, _ in saved] == [(40, 40)] * 3 # 90°回転で 30x40 -> 1:1 へ拡張
+    assert [frame.getpixel((20, 20)) for frame, _ in saved] == COLORS
+
+
+@pytest.mark.parametrize("workers, window", [(1, 1), (4, 3), (3, 8)])
+def test_map_ordered_keeps_order(workers, window):
+    # フレーム数が先読みの上限より多くても、結果は入力の順番どおりで、先読みは window 件まで
+    rng = random.Random(window); lock = threading.Lock(); pulled = [0]; yielded = [0]; ahead = []
+    def items():
+        for index in range(30):
+            with lock: pulled[0] += 1; ahead.append(pulled[0] - yielded[0])
+            yield index
+    def work(index):
+        time.sleep(rng.random() * 0.002); return index * 10
+    results = []
+    for value in frames._map_ordered(work, items(), workers, window):
+        with lock: yielded[0] += 1
+        results.append(value)
+    assert results == [index * 10 for index in range(30)]
+    assert max(ahead) <= window
+
+
+def test_open_image_keeps_animation_flag(tmp_path):
+    # パレット (GIF) などをモード変換した画像でも、ファイルを開き直さずに複数フレームか判定できる
+    first, *rest = _frames()
+    first.save(tmp_path / "anim.gif", save_all=True, append_images=rest); first.save(tmp_path / "still.gif")
+    first.convert("P").save(tmp_path / "pages.tif", save_all=True, append_images=[frame.convert("P") for frame in rest])
+    assert frames.is_animated(loader.open_image(str(tmp_path / "anim.gif")))
+    assert frames.is_animated(loader.open_image(str(tmp_path / "pages.tif")))
+    assert not frames.is_animated(loader.open_image(str(tmp_path / "still.gif")))
@@ -0,0 +1,140 @@
+import json
+import os
+import random
+import sys
+
+from PIL import Image
+
+from cropple import core, edits, lossless
+
+MCU = (16, 16)
+
+
+def _noise(size):
+    return Image.effect_noise(size, 64).convert("RGB")
+
+
+def _apply_plan(image, plan):
+    # jpegtran -rotate -> -crop と同じ順に画素で行う
+    quarter_turns, box = plan
+    image = core.transpose_quarter_turns(image, quarter_turns)
+    return image.crop(box) if box else image
+
+
+def _random_ops(rng, size, aligned):
+    ops = []
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.5: ops.append(("transpose", rng.randint(1, 3))); continue
+        width, height = edits.geometry_output_size(size, ops)
+        step = MCU[0] if aligned else 1
+        left = rng.randrange(0, width // 2 + 1, step); top = rng.randrange(0, height // 2 + 1, step)
+        ops.append(("crop", (left, top, rng.randint(left + 1, width), rng.randint(top + 1, height))))
+    return ops
+
+
+def test_plan_matches_render_ops():
+    # 可逆に保存できると判定した操作列は、画素で描画した結果と一致すること
+    rng = random.Random(13)
+    image = _noise((64, 48)); planned = 0
+    for _ in range(300):
+        ops = _random_ops(rng, image.size, aligned=rng.random() < 0.5)
+        plan = lossless.plan_transform(image.size, MCU, ops)
+        if plan is None: continue
+        planned += 1
+        assert _apply_plan(image, plan).tobytes() == edits.render_ops(image, ops).tobytes(), ops
+    assert planned > 50
+
+
+def test_plan_every_quarter_turn():
+    image = _noise((64, 48))
+    for quarter_turns in range(4):
+        width, height = edits.geometry_output_size(image.size, [("transpose", quarter_turns)] if quarter_turns else [])
+        ops = ([("transpose", quarter_turns)] if quarter_turns else []) + [("crop", (16, 16, width, height))]
+        plan = lossless.plan_transform(image.size, MCU, ops)
+        assert plan == (quarter_turns, (16, 16, width, height))
+        assert _apply_plan(image, plan).tobytes() == edits.render_ops(image, ops).tobytes()
+
+
+def test_plan_rejects_unaligned():
+    # 切り抜きの左上が MCU の境界にない / 回転で半端な MCU が左上に来る / 可逆にできない操作
+    assert lossless.plan_transform((64, 48), MCU, [("crop", (3, 0, 40, 40))]) is None
+    assert lossless.plan_transform((64, 50), MCU, [("transpose", 1)]) is None
+    assert lossless.plan_transform((70, 48), MCU, [("transpose", 3)]) is None
+    assert lossless.plan_transform((70, 50), MCU, [("transpose", 2)]) is None
+    assert lossless.plan_transform((70, 50), MCU, [("crop", (16, 16, 60, 40))]) == (0, (16, 16, 60, 40))
+    assert lossless.plan_transform((64, 48), MCU, [("rotate", 5.0, "color", "#ffffff")]) is None
+
+
+def test_plan_snap_keeps_size():
+    rng = random.Random(31)
+    image = _noise((64, 48))
+    for _ in range(300):
+        ops = _random_ops(rng, image.size, aligned=False)
+        plan = lossless.plan_transform(image.size, MCU, ops, snap=True)
+        if plan is None or plan[1] is None: continue
+        quarter_turns, box = plan
+        assert box[0] % MCU[0] == 0 and box[1] % MCU[1] == 0, ops
+        assert (box[2] - box[0], box[3] - box[1]) == edits.geometry_output_size(image.size, ops), ops
+        if lossless.plan_transform(image.size, MCU, ops) is not None:
+            assert lossless.plan_transform(image.size, MCU, ops) == plan
+
+
+FAKE_JPEGTRAN = """#!{python}
+import json, os, shutil, sys
+args = sys.argv[1:]
+with open(os.environ["FAKE_JPEGTRAN_LOG"], "w") as log: json.dump(args, log)
+if os.environ.get("FAKE_JPEGTRAN_FAIL"): sys.exit(1)
+shutil.copyfile(args[-1], args[args.index("-outfile") + 1])
+"""
+
+
+def _fake_jpegtran(tmp_path, monkeypatch):
+    script = tmp_path / "jpegtran"
+    script.write_text(FAKE_JPEGTRAN.format(python=sys.executable)); script.chmod(0o755)
+    log = tmp_path / "argv.json"
+    monkeypatch.setenv(lossless.JPEGTRAN_ENV, str(script)); monkeypatch.setenv("FAKE_JPEGTRAN_LOG", str(log))
+    return log
+
+
+def _jpeg(tmp_path):
+    src = tmp_path / "src.jpg"
+    _noise((64, 48)).save(src, quality=90, subsampling=2) # 4:2:0 (MCU 16x16)
+    return str(src)
+
+
+def test_save_lossless_runs_jpegtran(tmp_path, monkeypatch):
+    log = _fake_jpegtran(tmp_path, monkeypatch); src = _jpeg(tmp_path)
+    save_path = str(tmp_path / "out.jpg")
+    ops = [("transpose", 1), ("crop", (16, 0, 48, 32))] # 回転後 (48x64) の座標での切り抜き
+    assert lossless.save_lossless(src, ops, save_path) == save_path
+    args = json.loads(log.read_text())
+    assert args[:3] == ["-copy", "none", "-perfect"]
+    assert args[args.index("-rotate") + 1] == "90"
+    assert args[args.index("-crop") + 1] == "32x32+16+0"
+    assert args[args.index("-outfile") + 1].endswith(".part") and args[-1] == src
+    with open(save_path, "rb") as saved, open(src, "rb") as original: assert saved.read() == original.read()
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+def test_save_lossless_snap_crop(tmp_path, monkeypatch):
+    log = _fake_jpegtran(tmp_path, monkeypatch); src = _jpeg(tmp_path)
+    ops = [("crop", (20, 4, 52, 36))]
+    assert lossless.save_lossless(src, ops, str(tmp_path / "out.jpg")) is None
+    assert lossless.save_lossless(src, ops, str(tmp_path / "out.jpg"), snap=True) is not None
+    args = json.loads(log.read_text())
+    assert "-rotate" not in args and args[args.index("-crop") + 1] == "32x32+16+0"
+
+
+def test_save_lossless_falls_back(tmp_path, monkeypatch):
+    _fake_jpegtran(tmp_path, monkeypatch); src = _jpeg(tmp_path)
+    save_path = str(tmp_path / "out.jpg")
+    # 可逆にできない操作・JPEG 以外への保存は jpegtran を呼ばずに None
+    assert lossless.save_lossless(src, [("rotate", 3.0, "color", "#ffffff")], save_path) is None
+    assert lossless.save_lossless(src, [("transpose", 1)], str(tmp_path / "out.png")) is None
+    # jpegtran が失敗したら保存先にも一時ファイルにも何も残さない
+    monkeypatch.setenv("FAKE_JPEGTRAN_FAIL", "1")
+    assert lossless.save_lossless(src, [("transpose", 1)], save_path) is None
+    assert not os.path.exists(save_path)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+    monkeypatch.delenv(lossless.JPEGTRAN_ENV); monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    assert lossless.save_lossless(src, [("transpose", 1)], save_path) is None
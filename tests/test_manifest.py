@@ -0,0 +1,89 @@
+from PIL import Image
+import os
+
+import pytest
+
+from cropple import batch, core, manifest
+
+SETTINGS = dict(core.DEFAULT_SETTINGS, aspect_choice="1:1", extend_fill="stretch")
+
+
+def _inputs(tmp_path, count=3):
+    src_dir = tmp_path / "src"; src_dir.mkdir()
+    paths = []
+    for index in range(count):
+        path = str(src_dir / f"{index}.png"); Image.new("RGB", (40, 30), (index * 60, 0, 0)).save(path); paths.append(path)
+    return paths
+
+
+def _run(paths, out_dir, settings=SETTINGS, **kwargs):
+    logs = []
+    done, failures = batch.run_batch(paths, str(out_dir), settings, workers=1, log=logs.append, manifest_path=str(out_dir / core.MANIFEST_NAME), **kwargs)
+    assert not failures
+    return done, [line for line in logs if line.startswith("スキップ")]
+
+
+def test_skips_unchanged_outputs(tmp_path):
+    paths = _inputs(tmp_path); out_dir = tmp_path / "out"
+    assert _run(paths, out_dir) == (3, [])
+    done, skipped = _run(paths, out_dir, memory_budget_mb=0.001) # 作業メモリの予算は出力を変えない
+    assert done == 0 and len(skipped) == 3
+
+
+def test_reruns_touched_or_deleted_outputs(tmp_path):
+    paths = _inputs(tmp_path); out_dir = tmp_path / "out"
+    _run(paths, out_dir)
+    outputs = sorted(str(out_dir / name) for name in os.listdir(out_dir) if name.endswith(".png"))
+    st = os.stat(outputs[0]); os.utime(outputs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    os.remove(outputs[1])
+    assert _run(paths, out_dir)[0] == 2
+    # 入力の内容が変わった場合も作り直す (更新時刻だけ変わって内容が同じなら省く)
+    Image.new("RGB", (40, 30), (0, 0, 255)).save(paths[2])
+    assert _run(paths, out_dir)[0] == 1
+    os.utime(paths[0], ns=(0, 0))
+    assert _run(paths, out_dir)[0] == 0
+
+
+def test_settings_change_reruns(tmp_path):
+    paths = _inputs(tmp_path, 1); out_dir = tmp_path / "out"
+    _run(paths, out_dir)
+    assert _run(paths, out_dir, dict(SETTINGS, extend_fill="mean"))[0] == 1
+    assert _run(paths, out_dir, dict(SETTINGS, extend_fill="mean", png_compress_level=1))[0] == 1
+
+
+def test_settings_key():
+    key = manifest.settings_key(SETTINGS)
+    assert manifest.settings_key(dict(SETTINGS, memory_budget=64)) == key
+    assert manifest.settings_key(dict(SETTINGS, aspect_choice="カスタム", aspect_w="32", aspect_h="32")) == key # 同じ比率
+    assert manifest.settings_key(dict(SETTINGS, blur_radius=5)) == key # stretch ではぼかし半径を使わない
+    assert manifest.settings_key(dict(SETTINGS, rotation_fill_color="#000000")) == key # 回転しなければ余白色を使わない
+    for changed in (dict(SETTINGS, extend_fill="mirror"), dict(SETTINGS, extend_position="top"), dict(SETTINGS, jpeg_quality=80),
+                    dict(SETTINGS, webp_method=0), dict(SETTINGS, aspect_choice="16:9")):
+        assert manifest.settings_key(changed) != key
+    assert manifest.settings_key(SETTINGS, "crop") != key and manifest.settings_key(SETTINGS, quarter_turns=1) != key
+    assert manifest.settings_key(SETTINGS, rotation_angle=5) != manifest.settings_key(dict(SETTINGS, rotation_fill_color="#000000"), rotation_angle=5)
+
+
+def test_lru_eviction(tmp_path):
+    paths = _inputs(tmp_path); out_dir = tmp_path / "out"
+    assert _run(paths, out_dir, max_cache_entries=2)[0] == 3
+    # 記録は新しい2件だけ残り、記録から落ちた最初の出力は作り直す
+    done, skipped = _run(paths, out_dir, max_cache_entries=2)
+    assert done == 1 and len(skipped) == 2
+    cache = manifest.Manifest(str(out_dir / core.MANIFEST_NAME), 2)
+    assert len(cache._outputs) == 2 and len(cache._sources) == 2
+
+
+def test_resume_after_interrupt(tmp_path):
+    paths = _inputs(tmp_path); out_dir = tmp_path / "out"
+    finished = []
+    def interrupt_second(line):
+        # 2件目の処理が終わったところで中断する (1件目だけが記録済み)
+        if "->" in line:
+            finished.append(line)
+            if len(finished) == 2: raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        batch.run_batch(paths, str(out_dir), SETTINGS, workers=1, log=interrupt_second, manifest_path=str(out_dir / core.MANIFEST_NAME))
+    assert os.path.exists(out_dir / core.MANIFEST_NAME) # finally で保存済み
+    done, skipped = _run(paths, out_dir)
+    assert done == 2 and len(skipped) == 1
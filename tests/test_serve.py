@@ -0,0 +1,109 @@
+from PIL import Image
+import asyncio
+import io
+import json
+
+import pytest
+
+from cropple import core, serve
+
+BASE = dict(core.DEFAULT_SETTINGS)
+
+
+@pytest.mark.parametrize("query", [
+    "unknown=1", "aspect=16:0", "aspect=abc", "mode=zoom", "format=bmp", "extend_fill=smear", "extend_position=middle",
+    "blur_radius=wide", "rotate90=x", "angle=", "jpeg_optimize=maybe", "rotation_fill_color=%23ggg",
+])
+def test_parse_rejects_bad_params(query):
+    with pytest.raises(ValueError): serve.parse_request_params(BASE, query)
+
+
+def test_parse_defaults_and_overrides():
+    # 指定しなかったものは起動時の設定と defaults、指定したものは型を揃えて上書き
+    settings, mode, quarter_turns, angle, output_format, filename = serve.parse_request_params(BASE, "", {'mode': "crop", 'format': "jpg"})
+    assert (settings, mode, quarter_turns, angle, output_format, filename) == (BASE, "crop", 0, 0.0, "jpg", "")
+    settings, mode, quarter_turns, angle, output_format, filename = serve.parse_request_params(
+        BASE, "aspect=7:5&blur_radius=12&extend_fill=mirror&jpeg_optimize=on&rotate90=3&angle=-2.5&format=WEBP&filename=a.png")
+    assert settings['aspect_choice'] == "カスタム" and (settings['aspect_w'], settings['aspect_h']) == ("7", "5")
+    assert settings['blur_radius'] == 12 and settings['extend_fill'] == "mirror" and settings['jpeg_optimize'] is True
+    assert (mode, quarter_turns, angle, output_format, filename) == ("extend", 3, -2.5, "webp", "a.png")
+    assert serve.parse_request_params(BASE, "aspect=1:1")[0]['aspect_choice'] == "1:1"
+    assert BASE == core.DEFAULT_SETTINGS # 起動時の設定は書き換えない
+
+
+def test_percentile():
+    values = list(range(1, 11))
+    assert [serve.percentile(values, pct) for pct in (50, 90, 99, 100)] == [5, 9, 10, 10]
+    assert serve.percentile([7], 50) == 7 and serve.percentile([], 50) is None
+
+
+def test_metrics_snapshot():
+    metrics = serve.Metrics(window=4)
+    for ms in (10, 20, 30, 40, 50): metrics.observe(200, latency=ms / 1000, queue_wait=0.0, process=ms / 2000)
+    metrics.observe(503)
+    snapshot = metrics.snapshot(2, 4, 1)
+    assert snapshot['requests'] == 6 and snapshot['statuses'] == {'200': 5, '503': 1}
+    assert snapshot['latency'] == {'count': 4, 'p50_ms': 30.0, 'p90_ms': 50.0, 'p99_ms': 50.0} # 直近 window 件だけ
+    assert snapshot['process']['p50_ms'] == 15.0 and snapshot['in_flight'] == 1
+
+
+async def _read_response(reader):
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+    lines = head.decode('latin-1').split("\r\n")
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:] if line)}
+    body = await asyncio.wait_for(reader.readexactly(int(headers['content-length'])), 30)
+    return int(lines[0].split()[1]), headers, body
+
+
+async def _request(port, method, target, body=b"", headers=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    lines = [f"{method} {target} HTTP/1.1", "Host: localhost"] + [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+    try: return await _read_response(reader)
+    finally: writer.close()
+
+
+async def _with_server(scenario, queue_limit=None):
+    server = serve.Server(dict(core.DEFAULT_SETTINGS), workers=1, queue_limit=queue_limit, log=lambda *args: None)
+    await server.start_pool()
+    try:
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0) # 空いているポート
+        async with listener: return await scenario(server, listener.sockets[0].getsockname()[1])
+    finally: server.close()
+
+
+def _png_bytes(size=(40, 30)):
+    data = io.BytesIO(); Image.new("RGB", size, (10, 200, 30)).save(data, "PNG")
+    return data.getvalue()
+
+
+def test_process_round_trip():
+    async def scenario(server, port):
+        body = _png_bytes()
+        status, headers, data = await _request(port, "POST", "/process?aspect=1:1&extend_fill=stretch&format=jpg", body, {'Content-Length': len(body)})
+        assert status == 200 and headers['content-type'] == "image/jpeg"
+        with Image.open(io.BytesIO(data)) as image: assert image.format == "JPEG" and image.size == (40, 40)
+        assert (await _request(port, "POST", "/process?mode=zoom", body, {'Content-Length': len(body)}))[0] == 400
+        assert (await _request(port, "POST", "/process", body))[0] == 411
+        assert (await _request(port, "POST", "/process", b"not an image", {'Content-Length': 12}))[0] == 415
+        assert (await _request(port, "GET", "/process"))[0] == 405
+        status, _, data = await _request(port, "GET", "/metrics")
+        metrics = json.loads(data)
+        assert status == 200 and metrics['statuses'] == {'200': 1, '400': 1, '405': 1, '411': 1, '415': 1} and metrics['latency']['count'] == 1
+    asyncio.run(_with_server(scenario))
+
+
+def test_queue_limit_rejects_before_reading_body():
+    async def scenario(server, port):
+        # 1件目は本文を送りきらずに受け付け済みのまま止めておく
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST /process HTTP/1.1\r\nContent-Length: 100000\r\n\r\n" + b"x" * 10); await writer.drain()
+        for _ in range(100):
+            if server._accepted: break
+            await asyncio.sleep(0.01)
+        assert server._accepted == 1
+        # 2件目は本文を1バイトも送らなくても 503 が返る (本文を待たない)
+        status, headers, data = await _request(port, "POST", "/process", headers={'Content-Length': 100000})
+        assert status == 503 and headers['retry-after'] == "1" and json.loads(data)['error']
+        writer.close()
+    asyncio.run(_with_server(scenario, queue_limit=1))
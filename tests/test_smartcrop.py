@@ -0,0 +1,64 @@
+from PIL import Image, ImageDraw
+import random
+
+import pytest
+
+from cropple import smartcrop
+
+
+def _scene(size, blob_center):
+    # 平らな背景に、細かい模様の塊を1つ置いた画像
+    image = Image.new("RGB", size, (120, 130, 140))
+    rng = random.Random(15); draw = ImageDraw.Draw(image)
+    cx, cy = blob_center
+    for _ in range(400):
+        x = cx + rng.randint(-30, 30); y = cy + rng.randint(-30, 30)
+        draw.rectangle((x, y, x + 3, y + 3), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    return image
+
+
+@pytest.mark.parametrize("size", [(640, 360), (360, 640), (500, 500), (1200, 300)])
+@pytest.mark.parametrize("aspect", [(1, 1), (9, 16), (16, 9), (4, 5)])
+def test_box_has_aspect_and_stays_inside(size, aspect):
+    image = _scene(size, (size[0] // 4, size[1] // 3))
+    left, top, right, bottom = smartcrop.suggest_crop_box(image, aspect)
+    assert 0 <= left < right <= size[0] and 0 <= top < bottom <= size[1]
+    # 指定比率で最大のサイズ (どちらかの辺は画像いっぱい)
+    assert abs((right - left) / (bottom - top) - aspect[0] / aspect[1]) < 2 / min(right - left, bottom - top)
+    assert right - left == size[0] or bottom - top == size[1]
+
+
+def test_picks_off_centre_blob():
+    image = _scene((800, 400), (680, 200))
+    left, top, right, bottom = smartcrop.suggest_crop_box(image, (1, 1))
+    assert left <= 680 - 30 and 680 + 33 <= right and left > 200 # 中央 (200-600) ではなく右の塊を含む位置
+    proxy = image.resize((200, 100))
+    assert smartcrop.suggest_crop_box(image, (1, 1), proxy=proxy)[0] > 200
+
+
+def test_flat_image_stays_centred():
+    image = Image.new("RGB", (800, 400), (50, 50, 50))
+    assert smartcrop.suggest_crop_box(image, (1, 1)) == (200, 0, 600, 400)
+
+
+def _brute_force_best(values, width, height, window):
+    win_w, win_h = window
+    sums = {(x, y): sum(values[(y + dy) * width + x + dx] for dy in range(win_h) for dx in range(win_w))
+            for y in range(height - win_h + 1) for x in range(width - win_w + 1)}
+    return sums, max(sums.values())
+
+
+def test_best_window_matches_brute_force():
+    rng = random.Random(48)
+    for _ in range(30):
+        width, height = rng.randint(1, 12), rng.randint(1, 12)
+        values = [rng.randrange(256) for _ in range(width * height)]
+        image = Image.new("L", (width, height)); image.putdata(values)
+        table = smartcrop.summed_area_table(image)
+        window = (rng.randint(1, width), rng.randint(1, height))
+        sums, best_sum = _brute_force_best(values, width, height, window)
+        for (x, y), total in sums.items():
+            assert smartcrop.window_sum(table, (x, y, x + window[0], y + window[1])) == total
+        x, y = smartcrop.best_window(table, window)
+        # 中央寄りの重みは全体の合計の CENTER_BIAS 倍なので、選んだ窓は最大値からその分しか離れない
+        assert sums[(x, y)] >= best_sum - smartcrop.CENTER_BIAS * max(1, sum(values)) * (width + height)
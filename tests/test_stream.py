@@ -0,0 +1,49 @@
+from PIL import Image, ImageChops
+import pytest
+
+from cropple import core, encode, stream
+
+ASPECTS = [(9, 16), (16, 9), (1, 1), (3, 1)]
+EXACT_FILL_MODES = ("stretch", "mean") # 素材を NEAREST で拡大するので帯ごとに作っても一致する
+
+
+def _noise(mode, size=(90, 60)):
+    return Image.effect_noise(size, 80).convert(mode)
+
+
+def _max_difference(a, b):
+    assert a.size == b.size and a.mode == b.mode
+    extrema = ImageChops.difference(a, b).getextrema()
+    return max(high for _, high in extrema) if isinstance(extrema[0], tuple) else extrema[1]
+
+
+def _reassemble(strips, size, mode):
+    image = Image.new(mode, size)
+    for y, strip in strips: image.paste(strip, (0, y))
+    return image
+
+
+@pytest.mark.parametrize("fill_mode", core.EXTEND_FILL_MODES)
+@pytest.mark.parametrize("position", core.EXTEND_POSITIONS)
+@pytest.mark.parametrize("aspect", ASPECTS)
+def test_extend_strips_matches_extend_image(fill_mode, position, aspect):
+    image = _noise("RGB")
+    expected = core.extend_image(image, aspect, 8, position, fill_mode=fill_mode)
+    for strip_rows in (1, 7, 64):
+        strips = core.extend_strips(image, aspect, 8, position, strip_rows, fill_mode=fill_mode)
+        tolerance = 0 if fill_mode in EXACT_FILL_MODES else core.STRIP_TOLERANCE
+        assert _max_difference(_reassemble(strips, expected.size, "RGB"), expected) <= tolerance
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+@pytest.mark.parametrize("ext", [".png", ".jpg", ".tif", ".webp"])
+def test_save_extended_round_trip(tmp_path, mode, ext):
+    # 帯ごとに書き出した結果が、extend_image -> save_image と同じ画素になること (16行ずつの帯になる予算で)
+    image = _noise(mode)
+    reference_path = str(tmp_path / ("reference" + ext)); save_path = str(tmp_path / ("streamed" + ext))
+    encode.save_image(core.extend_image(image, (1, 1), 8, "center", fill_mode="stretch"), reference_path)
+    assert stream.strip_rows_for(90, 0.001) == stream.MIN_STRIP_ROWS
+    assert stream.save_extended(image, save_path, (1, 1), 8, "center", memory_budget_mb=0.001, fill_mode="stretch") == save_path
+    with Image.open(reference_path) as reference, Image.open(save_path) as saved:
+        assert saved.size == (90, 90) and saved.mode == reference.mode
+        assert _max_difference(saved.convert(reference.mode), reference) == 0
@@ -0,0 +1,75 @@
+import json
+import threading
+import time
+
+import pytest
+
+from cropple import timing
+
+
+@pytest.fixture(autouse=True)
+def _reset_timing():
+    timing.reset(); yield
+    timing.configure(enabled=False); timing.reset()
+
+
+def test_nested_stage_breakdown():
+    timing.configure()
+    with timing.stage("save"):
+        with timing.stage("extend"):
+            with timing.stage("blur"): time.sleep(0.01) # 孫の段階は子の内訳に含まれる
+        for _ in range(2):
+            with timing.stage("encode"): time.sleep(0.005)
+    count, name, duration, children = timing.last_operation()
+    assert name == "save" and [child for child, _ in children] == ["extend", "encode"]
+    seconds = dict(children)
+    assert seconds['extend'] >= 0.01 and seconds['encode'] >= 0.01 and duration >= seconds['extend'] + seconds['encode']
+    assert timing.format_operation(timing.last_operation()).startswith("保存 ")
+    assert "(拡張 " in timing.format_operation(timing.last_operation())
+    with timing.stage("render"): pass
+    assert timing.last_operation()[0] == count + 1 and timing.last_operation()[3] == []
+
+
+def test_operations_are_per_thread():
+    # 別のスレッドの段階は、そのスレッドの操作になる (実行中の操作の内訳に混ざらない)
+    timing.configure()
+    with timing.stage("save"):
+        worker = threading.Thread(target=lambda: timing.timed("refine")(time.sleep)(0.001)); worker.start(); worker.join()
+        assert timing.last_operation()[1] == "refine"
+        with timing.stage("encode"): pass
+    assert timing.last_operation()[1] == "save" and [child for child, _ in timing.last_operation()[3]] == ["encode"]
+
+
+def test_ring_buffer_cap():
+    timing.configure(record=True)
+    for index in range(timing.MAX_EVENTS + 10):
+        with timing.stage("resize", index=index): pass
+    recorded = timing.events()
+    assert len(recorded) == timing.MAX_EVENTS and recorded[0][5] == {'index': 10} and recorded[-1][5] == {'index': timing.MAX_EVENTS + 9}
+
+
+def test_export_chrome_trace(tmp_path):
+    timing.configure(record=True)
+    with timing.stage("process", path="a.png"):
+        with timing.stage("decode"): pass
+    timing.add_events([("encode", 1.0, 0.5, 123, 456, None)]) # 別プロセスの区間
+    path = str(tmp_path / "trace.json")
+    assert timing.export_chrome_trace(path) == 3
+    with open(path) as f: trace = json.load(f)
+    events = trace['traceEvents']
+    assert [event['name'] for event in events] == ["decode", "process", "encode"] # 終わった順
+    assert all(event['ph'] == "X" and event['cat'] == "cropple" and event['dur'] >= 0 for event in events)
+    assert events[1]['args'] == {'path': "a.png"} and 'args' not in events[0]
+    assert events[2] == {'name': "encode", 'cat': "cropple", 'ph': "X", 'ts': 1e6, 'dur': 5e5, 'pid': 123, 'tid': 456}
+    assert events[1]['ts'] <= events[0]['ts'] and events[0]['ts'] + events[0]['dur'] <= events[1]['ts'] + events[1]['dur'] + 1
+
+
+def test_disabled_records_nothing():
+    timing.configure(enabled=False)
+    assert not timing.is_enabled()
+    # 無効時の stage は共有の何もしないコンテキストマネージャで、timed は元の関数をそのまま呼ぶだけ
+    assert timing.stage("blur", radius=1) is timing.stage("encode")
+    with timing.stage("save"):
+        with timing.stage("encode"): pass
+    assert timing.timed("resize")(lambda value: value * 2)(21) == 42
+    assert timing.last_operation() is None and timing.events() == []
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+import pytest
+
+from cropple import batch, core, watch
+
+
+def _set_mtime(path, seconds_ago):
+    mtime_ns = time.time_ns() - int(seconds_ago * 1e9); os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_polling_waits_until_file_is_stable(tmp_path):
+    watcher = watch.PollingWatcher([str(tmp_path)], interval=0, settle_seconds=1.0)
+    path = str(tmp_path / "a.png")
+    # 1回目の書き込み: 初めて見たファイルはまだ返さない
+    with open(path, 'wb') as f: f.write(b"x" * 100)
+    _set_mtime(path, 10)
+    assert watcher.poll(0) == []
+    # 2回目の書き込み: サイズと更新時刻が変わったので返さない
+    with open(path, 'ab') as f: f.write(b"y" * 100)
+    _set_mtime(path, 9)
+    assert watcher.poll(0) == []
+    # 走査2回分変わらず settle 秒以上経ったので返す (1回だけ)
+    assert watcher.poll(0) == [path]
+    assert watcher.poll(0) == []
+
+
+def test_polling_waits_for_settle_seconds(tmp_path):
+    watcher = watch.PollingWatcher([str(tmp_path)], interval=0, settle_seconds=60)
+    path = str(tmp_path / "b.png")
+    with open(path, 'wb') as f: f.write(b"x")
+    assert watcher.poll(0) == [] and watcher.poll(0) == [] # 変わっていなくても更新直後は返さない
+    _set_mtime(path, 120)
+    assert watcher.poll(0) == [] and watcher.poll(0) == [path]
+
+
+def test_polling_ignores_existing_and_partial_files(tmp_path):
+    existing = tmp_path / "old.png"; existing.write_bytes(b"x"); _set_mtime(existing, 100)
+    (tmp_path / "c.png.123.part").write_bytes(b"x"); _set_mtime(tmp_path / "c.png.123.part", 100)
+    watcher = watch.PollingWatcher([str(tmp_path)], interval=0, settle_seconds=0)
+    assert watcher.poll(0) == [] and watcher.poll(0) == []
+    assert watch.PollingWatcher([str(tmp_path)], interval=0, settle_seconds=0, include_existing=True).poll(0) == []
+
+
+def test_inotify_overflow_rescans(tmp_path):
+    try: watcher = watch.InotifyWatcher([str(tmp_path)])
+    except OSError: pytest.skip("inotify is not available")
+    try:
+        for name in ("b.png", "a.jpg", "notes.txt"): (tmp_path / name).write_bytes(b"x")
+        # カーネルのキューが溢れた通知 (IN_Q_OVERFLOW) を差し込み、取りこぼし分を走査し直すこと
+        read_fd, write_fd = os.pipe(); os.close(watcher._fd); watcher._fd = read_fd
+        os.write(write_fd, watch.INOTIFY_EVENT_HEADER.pack(-1, watch.IN_Q_OVERFLOW, 0, 0)); os.close(write_fd)
+        assert watcher.poll(1) == [str(tmp_path / "a.jpg"), str(tmp_path / "b.png")]
+    finally: watcher.close()
+
+
+class _EndlessWatcher:
+    # poll のたびに新しいファイルを1つ返す
+    def __init__(self, directory):
+        self.directory = directory; self.polls = 0
+
+    def poll(self, timeout):
+        self.polls += 1; time.sleep(timeout)
+        return [os.path.join(self.directory, f"{self.polls}.png")]
+
+    def close(self): pass
+
+
+def test_queue_limit_stops_polling(tmp_path, monkeypatch):
+    # 投入済みが queue_limit に達している間は新しいファイルを読みに行かない
+    watcher = _EndlessWatcher(str(tmp_path)); release = threading.Event(); stop = threading.Event()
+    def process_file(src, dst, *args):
+        release.wait(10); return src, dst, 0.0
+    monkeypatch.setattr(watch, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(batch, "process_file", process_file)
+    monkeypatch.setattr(watch, "open_watcher", lambda *args: (watcher, []))
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(done=watch.watch([str(tmp_path)], str(tmp_path / "out"), dict(core.DEFAULT_SETTINGS), workers=1, queue_limit=2,
+                                                                           poll_interval=0.01, report_interval=0, stop_event=stop, log=lambda *args: None)))
+    thread.start()
+    try:
+        time.sleep(0.3)
+        assert watcher.polls == 2
+    finally:
+        release.set(); stop.set(); thread.join(10)
+    assert result['done'][0] >= 2 and not result['done'][1]